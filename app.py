@@ -1,53 +1,653 @@
 # Import libraries
 import os
-from flask import Flask, request, abort, jsonify
+import time
+from itertools import chain
+from flask import Flask, Response, g, request, abort, jsonify, json, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
+from datetime import date
+from sqlalchemy import tuple_, or_
 from sqlalchemy.orm import aliased
-from models import setup_db, Profile, Skill, Endorsement
-from auth import AuthError, requires_auth
+from models import db, setup_db, use_replica, use_primary, Profile, Skill, Endorsement, SkillRanking, bulk_insert, user_profile_json
+from auth import AuthError, requires_auth, check_permissions, token_cache
+from graph import trust_graph
+from recommendations import recommendation_cache, recommend
+from search import search_matches
+from autocomplete import skill_index, MAX_SUGGESTIONS
+from response_cache import response_cache
+from pool import pool_stats
+from metrics import request_metrics, metric_lines, timed_encoder, query_budget
 from jose import jwt
 
+# Keyset pagination settings for listing endpoints. Requests without
+# pagination parameters get up to MAX_PAGE_LIMIT rows, so small tables keep
+# returning everything in a single response.
+DEFAULT_PAGE_LIMIT = int(os.environ.get('DEFAULT_PAGE_LIMIT', 100))
+MAX_PAGE_LIMIT = int(os.environ.get('MAX_PAGE_LIMIT', 1000))
+
+# Read keyset pagination parameters (limit, after) from the query string
+def get_page_params():
+    limit = request.args.get('limit', None)
+    after = request.args.get('after', None)
+    paginated = limit is not None or after is not None
+
+    try:
+        if limit is not None:
+            limit = int(limit)
+        elif paginated:
+            limit = DEFAULT_PAGE_LIMIT
+        else:
+            limit = MAX_PAGE_LIMIT
+        if after is not None:
+            after = int(after)
+    except ValueError:
+        abort(422)
+
+    if limit < 1:
+        abort(422)
+
+    return min(limit, MAX_PAGE_LIMIT), after, paginated
+
+# Fetch one page of rows ordered by id, starting right after the given id.
+# Filtering on the primary key keeps the cost of any page constant, unlike
+# OFFSET. One extra row is requested to know whether a next page exists.
+def paginate(query, id_column, limit, after):
+    if after is not None:
+        query = query.filter(id_column > after)
+    rows = query.order_by(id_column).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1].id
+
+    return rows, next_cursor
+
+# Add the cursor to a listing response when paginating
+def page_response(body, paginated, next_cursor):
+    if paginated or next_cursor is not None:
+        body['next_cursor'] = next_cursor
+    return jsonify(body)
+
+# Read a sparse fieldset from the fields parameter, a comma-separated list
+# of the available fields, returned in their usual order. The id is always
+# included, as pages follow it. Every field is returned when the parameter
+# is missing, and error 422 for unknown fields.
+def get_fields(available):
+    fields = request.args.get('fields', None)
+    if fields is None:
+        return list(available)
+
+    fields = {field.strip() for field in fields.split(',')} - {''}
+    if not fields or not fields <= set(available):
+        abort(422)
+    return [field for field in available if field == 'id' or field in fields]
+
+# Columns of a model holding the given fields, so that only the fields
+# returned are read from the database
+def field_columns(model, fields):
+    return [getattr(model, field) for field in model.FIELDS if field in fields]
+
+# Number of skills of each user, or users of each skill, in the endorsement
+# summaries of batch gets
+SUMMARY_LIMIT = 10
+
+# Read the ids parameter of a batch get, a comma-separated list of ids, in
+# the order given and without duplicates. Error 422 if an id is invalid,
+# for more than MAX_PAGE_LIMIT ids, or when combined with pagination.
+def get_ids():
+    if any(param in request.args for param in ('limit', 'after', 'stream')):
+        abort(422)
+    try:
+        ids = list(dict.fromkeys(int(id) for id in request.args['ids'].split(',')))
+    except ValueError:
+        abort(422)
+    if len(ids) > MAX_PAGE_LIMIT:
+        abort(422)
+    return ids
+
+# Whether a batch get includes endorsement summaries (include=endorsements)
+def include_summaries():
+    include = request.args.get('include', None)
+    if include not in (None, 'endorsements'):
+        abort(422)
+    return include is not None
+
+# Batch get of the rows of a model with the given ids, in one query, in the
+# order of the ids, and with the ids not found. With include=endorsements,
+# each row gets the summary rows of its id, read by summarize in one more
+# query: (id, ...) rows, where the key of the id is given by owner.
+def batch_response(model, fields, collection, summarize, owner):
+    ids = get_ids()
+    summaries = include_summaries()
+
+    rows = db.session.query(*field_columns(model, fields))\
+        .filter(model.id.in_(ids))\
+        .all()
+    found = {row.id: row._asdict() for row in rows}
+    if (len(found) == 0):
+        abort(404)
+
+    if summaries:
+        for item in found.values():
+            item['endorsements'] = []
+        for row in summarize(list(found), SUMMARY_LIMIT):
+            summary = row._asdict()
+            found[summary.pop(owner)]['endorsements'].append(summary)
+
+    return jsonify({
+        'success':True,
+        collection: [found[id] for id in ids if id in found],
+        'num_' + collection: len(found),
+        'missing_ids': [id for id in ids if id not in found]
+    })
+
+# Statements of a listing: one, plus one for the endorsement summaries of a
+# batch get
+def listing_budget():
+    return 2 if 'ids' in request.args and 'include' in request.args else 1
+
+# Response cache tags of a listing: batch gets with endorsement summaries
+# show the names of the skills or users endorsed
+def listing_tags(collection):
+    def tags():
+        return [collection] + (['names'] if 'include' in request.args else [])
+    return tags
+
+# Seconds the reads of a client go to the primary database after its last
+# write, so it sees its own writes despite the replication lag. Kept in a
+# cookie for browsers, and in a response header holding the time the pin
+# expires, for API clients without cookies to send back. Either works
+# whichever process serves the next request.
+REPLICA_PIN_SECONDS = int(os.environ.get('REPLICA_PIN_SECONDS', 10))
+PRIMARY_PIN_COOKIE = 'endorsa_primary'
+PRIMARY_PIN_HEADER = 'Endorsa-Primary-Until'
+
+# Fail requests running more SQL statements than their route's budget,
+# instead of only logging them (see metrics.query_budget)
+QUERY_BUDGET_STRICT = os.environ.get('QUERY_BUDGET_STRICT', 'false').lower() in ('1', 'true', 'yes')
+
+# Number of users returned by the skill leaderboard
+DEFAULT_TOP_LIMIT = 10
+MAX_TOP_LIMIT = 100
+
+# Maximum number of endorsements in a trust path
+DEFAULT_PATH_DEPTH = 6
+MAX_PATH_DEPTH = 10
+
+# Number of skill name suggestions returned by default
+DEFAULT_SUGGESTIONS = 10
+
+# Number of search results per page, and maximum length of a search query
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_QUERY_LENGTH = 200
+
+# Rows fetched per database round trip and written per chunk when streaming
+STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', 1000))
+
+# Read the streaming format (json or ndjson) from the query string
+def get_stream_format():
+    stream_format = request.args.get('stream', None)
+    if stream_format is not None and stream_format not in ('json', 'ndjson'):
+        abort(422)
+    return stream_format
+
+# Stream every row of a query as JSON or NDJSON chunks. Rows are read with a
+# server-side cursor (yield_per) and written as they arrive, so memory stays
+# flat whatever the number of rows. The JSON format keeps the shape of the
+# regular listing response, with the count written at the end.
+def stream_response(query, id_column, after, serialize, stream_format, collection, count_key):
+    if after is not None:
+        query = query.filter(id_column > after)
+    rows = iter(query.order_by(id_column).yield_per(STREAM_BATCH_SIZE))
+
+    # Check for an empty result before the response status is sent
+    first_row = next(rows, None)
+    if first_row is None:
+        abort(404)
+
+    def generate():
+        num_rows = 0
+        chunk = []
+        if stream_format == 'json':
+            yield '{"success": true, "%s": [' % collection
+
+        for row in chain([first_row], rows):
+            item = json.dumps(serialize(row))
+            if stream_format == 'ndjson':
+                chunk.append(item + '\n')
+            else:
+                chunk.append(',' + item if num_rows else item)
+            num_rows += 1
+
+            if len(chunk) >= STREAM_BATCH_SIZE:
+                yield ''.join(chunk)
+                chunk = []
+
+        if chunk:
+            yield ''.join(chunk)
+        if stream_format == 'json':
+            yield '], "%s": %d}' % (count_key, num_rows)
+
+    mimetype = 'application/x-ndjson' if stream_format == 'ndjson' else 'application/json'
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+# Batch create settings: maximum items per request, and rows per INSERT
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 50000))
+BATCH_CHUNK_SIZE = int(os.environ.get('BATCH_CHUNK_SIZE', 1000))
+
+# Batch validators: turn one request item into a table row, or raise
+# ValueError with the reason why the item is rejected
+def required_string(item, field):
+    value = item.get(field)
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError(f'{field} is required')
+    return value
+
+def optional_string(item, field):
+    value = item.get(field, None)
+    if value is not None and not isinstance(value, str):
+        raise ValueError(f'{field} must be a string')
+    return value
+
+# Integers must fit the INTEGER columns, or the whole chunk would fail to
+# insert. Booleans and fractional numbers are not silently converted.
+MAX_INTEGER = 2**31 - 1
+
+def optional_integer(item, field):
+    value = item.get(field, None)
+    if value is None:
+        return None
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        raise ValueError(f'{field} must be an integer')
+    try:
+        value = int(value)
+    except (ValueError, TypeError, OverflowError):
+        raise ValueError(f'{field} must be an integer')
+    if not -MAX_INTEGER - 1 <= value <= MAX_INTEGER:
+        raise ValueError(f'{field} is out of range')
+    return value
+
+def required_integer(item, field):
+    if item.get(field) is None:
+        raise ValueError(f'{field} is required')
+    return optional_integer(item, field)
+
+def user_row(item):
+    return {
+        'first_name': required_string(item, 'first_name'),
+        'last_name': required_string(item, 'last_name'),
+        'location': optional_string(item, 'location'),
+        'description': optional_string(item, 'description'),
+        'contact': optional_integer(item, 'contact')
+    }
+
+def skill_row(item):
+    return {
+        'name': required_string(item, 'name'),
+        'description': optional_string(item, 'description')
+    }
+
+def endorsement_row(item):
+    return {
+        'giver_id': required_integer(item, 'giver_id'),
+        'receiver_id': required_integer(item, 'receiver_id'),
+        'skill_id': required_integer(item, 'skill_id'),
+        'creation_date': date.today()
+    }
+
+# Reject endorsements pointing to missing users or skills, or already
+# existing, with one query per referenced table for the whole chunk
+def check_endorsements(rows, errors):
+    profile_ids = {row[k] for _, row in rows for k in ('giver_id', 'receiver_id')}
+    skill_ids = {row['skill_id'] for _, row in rows}
+    keys = [(row['giver_id'], row['receiver_id'], row['skill_id']) for _, row in rows]
+
+    found_profiles = {id for (id,) in Profile.query.with_entities(Profile.id)
+        .filter(Profile.id.in_(profile_ids))}
+    found_skills = {id for (id,) in Skill.query.with_entities(Skill.id)
+        .filter(Skill.id.in_(skill_ids))}
+    existing = set(Endorsement.query
+        .with_entities(Endorsement.giver_id, Endorsement.receiver_id, Endorsement.skill_id)
+        .filter(tuple_(Endorsement.giver_id, Endorsement.receiver_id, Endorsement.skill_id).in_(keys)))
+
+    valid = []
+    for index, row in rows:
+        key = (row['giver_id'], row['receiver_id'], row['skill_id'])
+        if row['giver_id'] not in found_profiles or row['receiver_id'] not in found_profiles:
+            errors[index] = 'user not found'
+        elif row['skill_id'] not in found_skills:
+            errors[index] = 'skill not found'
+        elif key in existing:
+            errors[index] = 'endorsement already exists'
+        else:
+            existing.add(key)
+            valid.append((index, row))
+    return valid
+
+# Validate a JSON array of items and insert the valid ones in chunks of
+# multi-row INSERT statements, all in a single transaction. Returns the
+# result of each item, in request order.
+def create_batch(model, items, to_row, check=None):
+    if not isinstance(items, list) or len(items) == 0 or len(items) > MAX_BATCH_SIZE:
+        abort(422)
+
+    errors = {}
+    rows = []
+    for index, item in enumerate(items):
+        try:
+            if not isinstance(item, dict):
+                raise ValueError('item must be an object')
+            rows.append((index, to_row(item)))
+        except (ValueError, TypeError) as e:
+            errors[index] = str(e)
+
+    created = {}
+    for start in range(0, len(rows), BATCH_CHUNK_SIZE):
+        chunk = rows[start:start + BATCH_CHUNK_SIZE]
+        if check:
+            chunk = check(chunk, errors)
+        ids = bulk_insert(model, [row for _, row in chunk])
+        created.update(zip([index for index, _ in chunk], ids))
+    db.session.commit()
+
+    results = []
+    for index in range(len(items)):
+        if index in created:
+            results.append({'index': index, 'success': True, 'id': created[index]})
+        else:
+            results.append({'index': index, 'success': False, 'error': errors[index]})
+
+    return {
+        'success': True,
+        'results': results,
+        'num_created': len(created),
+        'num_failed': len(items) - len(created)
+    }
+
+# Query budget of a batch route: per chunk of rows, the given number of
+# validation queries plus the insert, which takes two statements on
+# PostgreSQL and one per row on other databases (see bulk_insert)
+def batch_budget(checks_per_chunk):
+    def budget():
+        items = request.get_json(silent=True)
+        num_items = len(items) if isinstance(items, list) else 0
+        chunks = -(-num_items // BATCH_CHUNK_SIZE)
+        if db.engine.dialect.name == 'postgresql':
+            return chunks * (checks_per_chunk + 2)
+        return chunks * checks_per_chunk + num_items
+    return budget
+
+# Query budget of the search route, per kind searched: the search and the
+# rows of the page on PostgreSQL. Other databases also check whether the
+# in-memory index is up to date, and rebuild it if not (see search.py).
+def search_budget():
+    kinds = 1 if request.args.get('type') else 2
+    if db.engine.dialect.name == 'postgresql':
+        return 2 * kinds
+    return 3 * kinds
+
+# Validators of the detail of a profile or skill, from its version: an ETag
+# and a Last-Modified date. Returns None if there is no row with this id.
+def get_validators(model, id):
+    row = db.session.query(model.version, model.updated_at)\
+        .filter(model.id == id)\
+        .one_or_none()
+    if row == None:
+        return None
+    return f'{row.version}-{row.updated_at:%Y%m%d%H%M%S%f}', row.updated_at
+
+# Whether the client already has the current version, going by If-None-Match
+# or, when it is not sent, If-Modified-Since
+def not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since.replace(tzinfo=None)
+    return False
+
+# Add validators to a response. Clients must revalidate before reusing it.
+def add_validators(response, etag, last_modified):
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+# Response cache tag of a user or skill detail. Ids come from the URL, so
+# they are normalized to match the tags invalidated by the write routes.
+def detail_tag(kind, id):
+    try:
+        return f'{kind}:{int(id)}'
+    except ValueError:
+        return f'{kind}:{id}'
+
+# Response cache tags affected by endorsements created or deleted, given as
+# (giver_id, receiver_id, skill_id) rows. Listings show endorsement counters.
+def endorsement_tags(endorsements):
+    tags = ['users', 'skills']
+    for giver_id, receiver_id, skill_id in endorsements:
+        tags += [f'user:{giver_id}', f'user:{receiver_id}', f'skill:{skill_id}']
+    return tags
+
+# Endorsements matching a condition, as (giver_id, receiver_id, skill_id) rows
+def find_endorsements(condition):
+    return Endorsement.query.filter(condition)\
+        .with_entities(Endorsement.giver_id, Endorsement.receiver_id, Endorsement.skill_id)\
+        .all()
+
+# Fields of the user and skill details: the columns of the user or skill,
+# and their lists of endorsements
+USER_DETAIL_FIELDS = Profile.FIELDS + ('endorsements_received', 'endorsements_given')
+SKILL_DETAIL_FIELDS = Skill.FIELDS + ('endorsements',)
+
+# Detailed user profile built from ORM queries: user info, endorsements
+# received (with giver's name and skill name) and endorsements given.
+# Portable path used on databases other than PostgreSQL, and for sparse
+# fieldsets, where only the fields and lists requested are queried.
+def get_user_profile(id, fields=USER_DETAIL_FIELDS):
+    user = db.session.query(*field_columns(Profile, fields))\
+        .filter(Profile.id == id)\
+        .one_or_none()
+    if user == None:
+        return None
+    profile = {
+        'success':True,
+        'user': user._asdict()
+    }
+
+    # Get endorsements received, with giver's name and last name, and skill name
+    if 'endorsements_received' in fields:
+        endorsements_received = Endorsement.query\
+            .filter(Endorsement.receiver_id == id)\
+            .with_entities(Endorsement.giver_id, Endorsement.skill_id, Endorsement.creation_date)\
+            .join(Profile, Endorsement.giver_id==Profile.id)\
+            .add_columns(Profile.first_name,Profile.last_name)\
+            .join(Skill)\
+            .add_columns(Skill.name)\
+            .order_by(Endorsement.id)
+        profile['endorsements_received'] = [e._asdict() for e in endorsements_received]
+
+    # Get endorsements given
+    if 'endorsements_given' in fields:
+        endorsements_given = Endorsement.query\
+            .filter(Endorsement.giver_id == id)\
+            .with_entities(Endorsement.receiver_id, Endorsement.skill_id, Endorsement.creation_date)\
+            .join(Profile, Endorsement.receiver_id==Profile.id)\
+            .add_columns(Profile.first_name,Profile.last_name)\
+            .join(Skill)\
+            .add_columns(Skill.name)\
+            .order_by(Endorsement.id)
+        profile['endorsements_given'] = [e._asdict() for e in endorsements_given]
+
+    return profile
+
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
     db = setup_db(app)
+
+    # Time every request, with its SQL, auth and serialization time. As
+    # after_request hooks run in reverse order of registration, the metrics
+    # hooks are registered before any other, CORS included, so that
+    # finish_metrics runs last.
+    app.json_encoder = timed_encoder(app.json_encoder)
+    app.config['QUERY_BUDGET_STRICT'] = QUERY_BUDGET_STRICT
+
+    # Whether the client wrote recently, going by the pin cookie or header.
+    # Header values that are not a time in seconds are ignored.
+    def pinned_to_primary():
+        if PRIMARY_PIN_COOKIE in request.cookies:
+            return True
+        try:
+            return float(request.headers.get(PRIMARY_PIN_HEADER, 0)) > time.time()
+        except ValueError:
+            return False
+
+    @app.before_request
+    def start_metrics():
+        request_metrics.start()
+
+    @app.after_request
+    def finish_metrics(response):
+        return request_metrics.finish(response)
+
     CORS(app)
 
     # Use the after_request decorator to set Access-Control-Allow
     # CORS Headers 
     @app.after_request
     def after_request(response):
-        response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,true')
+        response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,true,' + PRIMARY_PIN_HEADER)
         response.headers.add('Access-Control-Allow-Methods', 'GET,PATCH,PUT,POST,DELETE,OPTIONS')
+        response.headers.add('Access-Control-Expose-Headers', PRIMARY_PIN_HEADER)
+
+        # Pin the next reads of a client to the primary after a write
+        if app.config['DATABASE_REPLICAS'] and response.status_code < 400 and \
+                request.method not in ('GET', 'HEAD', 'OPTIONS'):
+            response.set_cookie(PRIMARY_PIN_COOKIE, '1', max_age=REPLICA_PIN_SECONDS,
+                httponly=True, samesite='Lax')
+            response.headers[PRIMARY_PIN_HEADER] = str(int(time.time()) + REPLICA_PIN_SECONDS)
         return response
 
+    # Reads of GET requests go to a replica, unless the client wrote recently
+    @app.before_request
+    def route_reads():
+        g.pinned_to_primary = pinned_to_primary()
+        if request.method in ('GET', 'HEAD') and not g.pinned_to_primary:
+            use_replica()
+        else:
+            use_primary()
+
     @app.route('/', methods = ['GET'])
+    @query_budget(0)
     def welcome():
         return "Welcome to Endorsa! More info in https://github.com/jaimeam/endorsa"
 
+    # Get hit ratio and size of the response cache
+    @app.route('/cache/stats', methods=['GET'])
+    @query_budget(0)
+    @requires_auth('read:user')
+    def cache_stats(jwt):
+        return jsonify({
+            'success':True,
+            'response_cache': response_cache.stats(),
+            'skill_autocomplete': skill_index.stats(),
+            'token_cache': token_cache.stats()
+        })
+
+    # Request timings per route, response cache, recommendations cache, token
+    # cache and connection pool counters of this process, in Prometheus text
+    # format
+    @app.route('/metrics', methods=['GET'])
+    @query_budget(0)
+    def metrics():
+        cache = response_cache.stats()
+        recommendations = recommendation_cache.stats()
+        tokens = token_cache.stats()
+        pool = pool_stats.stats(db.engine.pool)
+
+        lines = request_metrics.lines()
+        lines += metric_lines('endorsa_response_cache_hits_total', 'counter',
+            'Responses served from the response cache',
+            [({'route': route}, counts['hits']) for route, counts in cache['routes'].items()])
+        lines += metric_lines('endorsa_response_cache_misses_total', 'counter',
+            'Responses not found in the response cache',
+            [({'route': route}, counts['misses']) for route, counts in cache['routes'].items()])
+        lines += metric_lines('endorsa_recommendation_cache_hits_total', 'counter',
+            'Recommendations served from cache', [({}, recommendations['hits'])])
+        lines += metric_lines('endorsa_recommendation_cache_misses_total', 'counter',
+            'Recommendations computed', [({}, recommendations['misses'])])
+        lines += metric_lines('endorsa_token_cache_hits_total', 'counter',
+            'Access tokens found verified in the token cache', [({}, tokens['hits'])])
+        lines += metric_lines('endorsa_token_cache_misses_total', 'counter',
+            'Access tokens verified against the signing keys', [({}, tokens['misses'])])
+        lines += metric_lines('endorsa_db_pool_checkouts_total', 'counter',
+            'Connections checked out from the pool', [({}, pool['checkouts'])])
+        lines += metric_lines('endorsa_db_pool_exhausted_total', 'counter',
+            'Checkouts made with every connection in use', [({}, pool['exhausted'])])
+        lines += metric_lines('endorsa_db_pool_timeouts_total', 'counter',
+            'Checkouts that timed out waiting for a connection', [({}, pool['timeouts'])])
+        lines += metric_lines('endorsa_db_pool_wait_seconds_total', 'counter',
+            'Time spent waiting for a connection', [({}, pool_stats.wait_total)])
+        if 'checked_out' in pool:
+            lines += metric_lines('endorsa_db_pool_connections', 'gauge',
+                'Connections of the pool by state', [
+                    ({'state': 'checked_out'}, pool['checked_out']),
+                    ({'state': 'checked_in'}, pool['checked_in'])])
+
+        return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+    @app.route('/db/stats', methods=['GET'])
+    @query_budget(0)
+    @requires_auth('read:user')
+    def db_stats(jwt):
+        return jsonify({
+            'success':True,
+            'pool': pool_stats.stats(db.engine.pool)
+        })
+
     # Get full list of users
     @app.route('/users', methods=['GET'])
+    @query_budget(listing_budget)
     @requires_auth('read:user')
+    @response_cache.cached(listing_tags('users'))
     def get_users(jwt):
-        users = [user.format() for user in Profile.query.all()]
+        fields = get_fields(Profile.FIELDS)
+        # Batch get of the users with the given ids
+        if 'ids' in request.args:
+            return batch_response(Profile, fields, 'users', SkillRanking.top_skills, 'receiver_id')
+
+        limit, after, paginated = get_page_params()
+        stream_format = get_stream_format()
+        users = Profile.query.with_entities(*field_columns(Profile, fields))
+        if stream_format:
+            return stream_response(users, Profile.id, after,
+                lambda user: user._asdict(), stream_format, 'users', 'num_users')
+
+        users, next_cursor = paginate(users, Profile.id, limit, after)
+        users = [user._asdict() for user in users]
 
         if (len(users) == 0):
             abort(404)
 
-        return jsonify({
+        return page_response({
         'success':True,
         'users':users,
         'num_users':len(users)
-        })
+        }, paginated, next_cursor)
     
     # Delete all users
     @app.route('/users', methods=['DELETE'])
+    @query_budget(2)
     @requires_auth('edit:user')
     def delete_all_users(jwt):
         # Delete all rows from model Profile
         num_deleted_rows = db.session.query(Profile).delete()
         db.session.commit()
+        trust_graph.invalidate()
+        skill_index.invalidate()
+        recommendation_cache.clear()
+        response_cache.clear()
 
         if (len(Profile.query.all()) != 0):
             abort(422)
@@ -59,6 +659,7 @@ def create_app(test_config=None):
     
     # Create a new user via POST
     @app.route('/users', methods=['POST'])
+    @query_budget(2)
     @requires_auth('edit:user')
     def post_new_user(jwt):
         try:
@@ -81,6 +682,7 @@ def create_app(test_config=None):
 
             # Create new entry in database
             new_user.insert()
+            response_cache.invalidate(['users'])
 
             return jsonify({
                 'success':True,
@@ -90,46 +692,145 @@ def create_app(test_config=None):
             db.session.rollback()
             abort(422)
     
+    # Create many users at once from a JSON array
+    @app.route('/users/batch', methods=['POST'])
+    @query_budget(batch_budget(0))
+    @requires_auth('edit:user')
+    def post_new_users_batch(jwt):
+        items = request.get_json()
+        try:
+            body = create_batch(Profile, items, user_row)
+            response_cache.invalidate(['users'])
+            return jsonify(body)
+        except:
+            db.session.rollback()
+            abort(422)
+
     # Get detailed info of a selected user, including info on endorsements
     @app.route('/users/<id>', methods=['GET'])
+    @query_budget(4)
     @requires_auth('read:user')
+    @response_cache.cached(lambda id: [detail_tag('user', id), 'names'])
     def user_profile(jwt,id):
+        fields = get_fields(USER_DETAIL_FIELDS)
         try:
-            user = Profile.query.filter(Profile.id == id).one_or_none()
+            id = int(id)
+
+            # Look up the version first, so the profile is only built if the
+            # client does not have it already
+            validators = get_validators(Profile, id)
             # Raise error if no user is found with this ID
-            if user == None:
+            if validators == None:
                 abort(404)
+            if not_modified(*validators):
+                return add_validators(Response(status=304), *validators)
+
+            # On PostgreSQL the whole profile is assembled by the database in
+            # a single query and sent back as is, without building Python objects
+            if db.engine.dialect.name == 'postgresql' and 'fields' not in request.args:
+                profile = user_profile_json(id)
+                # Raise error if no user is found with this ID
+                if profile == None:
+                    abort(404)
+                return add_validators(Response(profile, mimetype='application/json'), *validators)
 
-            # Get endorsements received, with giver's name and last name, and skill name
-            endorsements_received = Endorsement.query\
-                .filter(Endorsement.receiver_id == id)\
-                .with_entities(Endorsement.giver_id, Endorsement.skill_id, Endorsement.creation_date)\
-                .join(Profile, Endorsement.giver_id==Profile.id)\
-                .add_columns(Profile.first_name,Profile.last_name)\
-                .join(Skill)\
-                .add_columns(Skill.name)
-
-            # Get endorsements given
-            endorsements_given = Endorsement.query\
-                .filter(Endorsement.giver_id == id)\
-                .with_entities(Endorsement.receiver_id, Endorsement.skill_id, Endorsement.creation_date)\
-                .join(Profile, Endorsement.receiver_id==Profile.id)\
-                .add_columns(Profile.first_name,Profile.last_name)\
-                .join(Skill)\
-                .add_columns(Skill.name)
+            profile = get_user_profile(id, fields)
+            # Raise error if no user is found with this ID
+            if profile == None:
+                abort(404)
 
             # Return all info
+            return add_validators(jsonify(profile), *validators)
+        except:
+            abort(404)
+    
+    # Get the shortest chain of endorsements from a user to another one,
+    # optionally for a single skill
+    @app.route('/users/<id>/path/<other_id>', methods=['GET'])
+    @query_budget(6)
+    @requires_auth('read:user')
+    def trust_path(jwt,id,other_id):
+        try:
+            id = int(id)
+            other_id = int(other_id)
+        except ValueError:
+            abort(404)
+
+        try:
+            skill_id = request.args.get('skill_id', None)
+            if skill_id is not None:
+                skill_id = int(skill_id)
+            max_depth = int(request.args.get('max_depth', DEFAULT_PATH_DEPTH))
+        except ValueError:
+            abort(422)
+        if max_depth < 1 or max_depth > MAX_PATH_DEPTH:
+            abort(422)
+
+        try:
+            users = {user.id: user for user in Profile.query.filter(Profile.id.in_([id, other_id]))}
+            # Raise error if any of the users is not found
+            if id not in users or other_id not in users:
+                abort(404)
+
+            trust_graph.sync()
+            path = trust_graph.shortest_path(id, other_id, skill_id, max_depth)
+            # Raise error if the users are not connected
+            if path == None:
+                abort(404)
+
+            # Get names of all users in the path
+            users = {user.id: user for user in Profile.query
+                .filter(Profile.id.in_(path))
+                .with_entities(Profile.id, Profile.first_name, Profile.last_name)}
+
             return jsonify({
                 'success':True,
-                'user': user.format(),
-                'endorsements_received': [e._asdict() for e in endorsements_received],
-                'endorsements_given': [e._asdict() for e in endorsements_given]
+                'path': [users[user_id]._asdict() for user_id in path],
+                'length': len(path) - 1
             })
         except:
             abort(404)
-    
+
+    # Get users to ask about a skill: those endorsed for it by the users the
+    # selected user has endorsed, scored by number of paths and recency
+    @app.route('/users/<id>/recommendations', methods=['GET'])
+    @query_budget(4)
+    @requires_auth('read:user')
+    def user_recommendations(jwt,id):
+        try:
+            skill_id = int(request.args['skill_id'])
+            limit = int(request.args.get('limit', DEFAULT_TOP_LIMIT))
+        except (KeyError, ValueError):
+            abort(422)
+        if limit < 1:
+            abort(422)
+
+        try:
+            user = Profile.query.filter(Profile.id == id).one_or_none()
+            skill = Skill.query.filter(Skill.id == skill_id).one_or_none()
+            # Raise error if the user or the skill is not found
+            if user == None or skill == None:
+                abort(404)
+
+            candidates = recommend(user.id, skill.id)[:min(limit, MAX_TOP_LIMIT)]
+
+            # Get names of the candidates
+            names = {p.id: p for p in Profile.query
+                .filter(Profile.id.in_([c['id'] for c in candidates]))
+                .with_entities(Profile.id, Profile.first_name, Profile.last_name)}
+
+            return jsonify({
+                'success':True,
+                'skill': skill.format(),
+                'recommendations': [dict(c, **names[c['id']]._asdict())
+                    for c in candidates if c['id'] in names]
+            })
+        except:
+            abort(404)
+
     # Modify a selected user via PATCH
     @app.route('/users/<id>', methods=['PATCH'])
+    @query_budget(3)
     @requires_auth('edit:user')
     def patch_user(jwt,id):
         try:
@@ -159,6 +860,9 @@ def create_app(test_config=None):
                 user.contact = new_contact
 
             user.update()
+            # Names of users are shown along with their endorsements
+            response_cache.invalidate(['users', f'user:{user.id}']
+                + (['names'] if new_first_name or new_last_name else []))
 
             return jsonify({
                 'success':True,
@@ -171,6 +875,7 @@ def create_app(test_config=None):
     
     # Delete a selected user
     @app.route('/users/<id>', methods=['DELETE'])
+    @query_budget(3)
     @requires_auth('edit:user')
     def delete_user(jwt,id):
         try:
@@ -179,7 +884,14 @@ def create_app(test_config=None):
             if user == None:
                 abort(404)
             
+            # Endorsements of the user are deleted along with it
+            endorsements = find_endorsements(or_(Endorsement.giver_id == user.id,
+                Endorsement.receiver_id == user.id))
             user.delete()
+            for giver_id, receiver_id, skill_id in endorsements:
+                trust_graph.remove_edge(giver_id, receiver_id, skill_id)
+            recommendation_cache.clear()
+            response_cache.invalidate(['users', f'user:{user.id}'] + endorsement_tags(endorsements))
 
             return jsonify({
                 'success':True,
@@ -191,26 +903,46 @@ def create_app(test_config=None):
     
     # Get full list of skills
     @app.route('/skills', methods=['GET'])
+    @query_budget(listing_budget)
     @requires_auth('read:skill')
+    @response_cache.cached(listing_tags('skills'))
     def get_skills(jwt):
-        skills = [skill.format() for skill in Skill.query.all()]
+        fields = get_fields(Skill.FIELDS)
+        # Batch get of the skills with the given ids
+        if 'ids' in request.args:
+            return batch_response(Skill, fields, 'skills', SkillRanking.top_receivers, 'skill_id')
+
+        limit, after, paginated = get_page_params()
+        stream_format = get_stream_format()
+        skills = Skill.query.with_entities(*field_columns(Skill, fields))
+        if stream_format:
+            return stream_response(skills, Skill.id, after,
+                lambda skill: skill._asdict(), stream_format, 'skills', 'num_skills')
+
+        skills, next_cursor = paginate(skills, Skill.id, limit, after)
+        skills = [skill._asdict() for skill in skills]
 
         if (len(skills) == 0):
             abort(404)
 
-        return jsonify({
+        return page_response({
         'success':True,
         'skills':skills,
         'num_skills':len(skills)
-        })
+        }, paginated, next_cursor)
 
     # Delete all skills
     @app.route('/skills', methods=['DELETE'])
+    @query_budget(2)
     @requires_auth('edit:skill')
     def delete_all_skills(jwt):
         # Delete all rows from model Skill
         num_deleted_rows = db.session.query(Skill).delete()
         db.session.commit()
+        trust_graph.invalidate()
+        skill_index.invalidate()
+        recommendation_cache.clear()
+        response_cache.clear()
 
         if (len(Skill.query.all()) != 0):
             db.session.rollback()
@@ -223,6 +955,7 @@ def create_app(test_config=None):
 
     # Create a new skill via POST
     @app.route('/skills', methods=['POST'])
+    @query_budget(2)
     @requires_auth('edit:skill')
     def post_new_skill(jwt):
         try:
@@ -239,6 +972,8 @@ def create_app(test_config=None):
 
             # Create new entry in database
             new_skill.insert()
+            skill_index.add(new_skill.id, new_skill.name)
+            response_cache.invalidate(['skills'])
             
             return jsonify({
                 'success':True,
@@ -248,15 +983,76 @@ def create_app(test_config=None):
             db.session.rollback()
             abort(422)
 
+    # Create many skills at once from a JSON array
+    @app.route('/skills/batch', methods=['POST'])
+    @query_budget(batch_budget(0))
+    @requires_auth('edit:skill')
+    def post_new_skills_batch(jwt):
+        items = request.get_json()
+        try:
+            body = create_batch(Skill, items, skill_row)
+            for result in body['results']:
+                if result['success']:
+                    skill_index.add(result['id'], items[result['index']]['name'])
+            response_cache.invalidate(['skills'])
+            return jsonify(body)
+        except:
+            db.session.rollback()
+            abort(422)
+
+    # Suggest skills whose name, or any word of it, starts with the text
+    # typed so far, most endorsed first. Served from an in-memory index.
+    @app.route('/skills/autocomplete', methods=['GET'])
+    @query_budget(1)
+    @requires_auth('read:skill')
+    def skill_autocomplete(jwt):
+        prefix = request.args.get('q', '').strip()
+        try:
+            limit = int(request.args.get('limit', DEFAULT_SUGGESTIONS))
+        except ValueError:
+            abort(422)
+        if not prefix or limit < 1:
+            abort(422)
+
+        skill_index.sync()
+        suggestions = skill_index.suggest(prefix, min(limit, MAX_SUGGESTIONS))
+
+        if (len(suggestions) == 0):
+            abort(404)
+
+        return jsonify({
+            'success':True,
+            'suggestions': [{'id': id, 'name': name, 'num_endorsements': num_endorsements}
+                for id, name, num_endorsements in suggestions]
+        })
+
     # Get detailed info of a selected Skill, including info on endorsements
     @app.route('/skills/<id>', methods=['GET'])
+    @query_budget(3)
     @requires_auth('read:skill')
+    @response_cache.cached(lambda id: [detail_tag('skill', id), 'names'])
     def skill_profile(jwt,id):
+        fields = get_fields(SKILL_DETAIL_FIELDS)
         try:
-            skill = Skill.query.filter(Skill.id == id).one_or_none()
+            validators = get_validators(Skill, id)
+            # Raise error if no skill is found with this ID
+            if validators == None:
+                abort(404)
+            if not_modified(*validators):
+                return add_validators(Response(status=304), *validators)
+
+            skill = db.session.query(*field_columns(Skill, fields))\
+                .filter(Skill.id == id)\
+                .one_or_none()
             # Raise error if no user is found with this ID
             if skill == None:
                 abort(404)
+            body = {
+                'success':True,
+                'skill': skill._asdict()
+            }
+            if 'endorsements' not in fields:
+                return add_validators(jsonify(body), *validators)
 
             # Create aliases to deal with ambiguous Profile for receivers and givers
             ProfileG = aliased(Profile)
@@ -272,16 +1068,47 @@ def create_app(test_config=None):
                 .add_columns(ProfileR.first_name.label('receiver_first_name'),ProfileR.last_name.label('receiver_last_name'))
 
             # Return all info
+            body['endorsements'] = [e._asdict() for e in endorsements]
+            return add_validators(jsonify(body), *validators)
+        except:
+            abort(404)
+
+    # Get the users most endorsed for a selected skill, ties broken by the
+    # most recent endorsement, or by trust score. Read from the precomputed
+    # skill ranking.
+    @app.route('/skills/<id>/top', methods=['GET'])
+    @query_budget(2)
+    @requires_auth('read:skill')
+    @response_cache.cached(lambda id: [detail_tag('skill', id), 'names'])
+    def skill_top(jwt,id):
+        try:
+            limit = int(request.args.get('limit', DEFAULT_TOP_LIMIT))
+        except ValueError:
+            abort(422)
+        sort = request.args.get('sort', 'endorsements')
+        if limit < 1 or sort not in ('endorsements', 'trust'):
+            abort(422)
+
+        try:
+            skill = Skill.query.filter(Skill.id == id).one_or_none()
+            # Raise error if no skill is found with this ID
+            if skill == None:
+                abort(404)
+
+            ranking = SkillRanking.trusted if sort == 'trust' else SkillRanking.top
+            top = ranking(skill.id, min(limit, MAX_TOP_LIMIT))
+
             return jsonify({
                 'success':True,
                 'skill': skill.format(),
-                'endorsements': [e._asdict() for e in endorsements]
+                'top': [e._asdict() for e in top]
             })
         except:
             abort(404)
 
     # Modify a selected skill via PATCH
     @app.route('/skills/<id>', methods=['PATCH'])
+    @query_budget(3)
     @requires_auth('edit:skill')
     def patch_skill(jwt,id):
         try:
@@ -302,6 +1129,10 @@ def create_app(test_config=None):
                 skill.description = new_description
 
             skill.update()
+            if new_name:
+                skill_index.add(skill.id, skill.name, skill.num_endorsements)
+            response_cache.invalidate(['skills', f'skill:{skill.id}']
+                + (['names'] if new_name else []))
             return jsonify({
                 'success':True,
                 'skill': skill.format()
@@ -312,6 +1143,7 @@ def create_app(test_config=None):
 
     # Delete a selected skill
     @app.route('/skills/<id>', methods=['DELETE'])
+    @query_budget(3)
     @requires_auth('edit:skill')
     def delete_skill(jwt,id):
         try:
@@ -321,7 +1153,13 @@ def create_app(test_config=None):
             if skill == None:
                 abort(404)
             
+            endorsements = find_endorsements(Endorsement.skill_id == skill.id)
             skill.delete()
+            for giver_id, receiver_id, skill_id in endorsements:
+                trust_graph.remove_edge(giver_id, receiver_id, skill_id)
+            skill_index.remove(skill.id)
+            recommendation_cache.clear()
+            response_cache.invalidate(['skills', f'skill:{skill.id}'] + endorsement_tags(endorsements))
 
             return jsonify({
                 'success':True,
@@ -333,43 +1171,72 @@ def create_app(test_config=None):
 
     # Get full list of endorsements
     @app.route('/endorsements', methods=['GET'])
+    @query_budget(1)
     @requires_auth('read:endorsement')
     def get_endorsements(jwt):
+        limit, after, paginated = get_page_params()
+        stream_format = get_stream_format()
+
+        # Create aliases to deal with ambiguous Profile for receivers and givers
+        ProfileG = aliased(Profile)
+        ProfileR = aliased(Profile)
+
+        # Full info of endorsements with users info, of which the fields
+        # requested are selected
+        columns = {
+            'id': Endorsement.id,
+            'giver_id': Endorsement.giver_id,
+            'receiver_id': Endorsement.receiver_id,
+            'creation_date': Endorsement.creation_date,
+            'giver_first_name': ProfileG.first_name.label('giver_first_name'),
+            'giver_last_name': ProfileG.last_name.label('giver_last_name'),
+            'receiver_first_name': ProfileR.first_name.label('receiver_first_name'),
+            'receiver_last_name': ProfileR.last_name.label('receiver_last_name'),
+            'name': Skill.name
+        }
+        fields = get_fields(list(columns))
         try:
-            endorsements = [endorsement.format() for endorsement in Endorsement.query.all()]
+            endorsements = Endorsement.query.with_entities(*[columns[field] for field in fields])
 
-            if (len(endorsements) == 0):
-                abort(404)
+            # Join the users and skill only when fields are read from them
+            if {'giver_first_name', 'giver_last_name'} & set(fields):
+                endorsements = endorsements.join(ProfileG, Endorsement.giver_id==ProfileG.id)
+            if {'receiver_first_name', 'receiver_last_name'} & set(fields):
+                endorsements = endorsements.join(ProfileR, Endorsement.receiver_id==ProfileR.id)
+            if 'name' in fields:
+                endorsements = endorsements.join(Skill, Endorsement.skill_id==Skill.id)
 
-            # Create aliases to deal with ambiguous Profile for receivers and givers
-            ProfileG = aliased(Profile)
-            ProfileR = aliased(Profile)
+            # Export all endorsements in one streamed response
+            if stream_format:
+                return stream_response(endorsements, Endorsement.id, after,
+                    lambda e: e._asdict(), stream_format, 'endorsements', 'num_endorsements')
 
-            # Query full info of endorsements with users info
-            endorsements = Endorsement.query\
-                .with_entities(Endorsement.giver_id, Endorsement.receiver_id, Endorsement.creation_date)\
-                .join(ProfileG, Endorsement.giver_id==ProfileG.id)\
-                .add_columns(ProfileG.first_name.label('giver_first_name'),ProfileG.last_name.label('giver_last_name'))\
-                .join(ProfileR, Endorsement.receiver_id==ProfileR.id)\
-                .add_columns(ProfileR.first_name.label('receiver_first_name'),ProfileR.last_name.label('receiver_last_name'))\
-                .join(Skill)\
-                .add_columns(Skill.name)
+            endorsements, next_cursor = paginate(endorsements, Endorsement.id, limit, after)
+            endorsements = [e._asdict() for e in endorsements]
 
-            return jsonify({
+            if (len(endorsements) == 0):
+                abort(404)
+
+            return page_response({
             'success':True,
-            'endorsements':[e._asdict() for e in endorsements],
-            'num_endorsements':len([e._asdict() for e in endorsements])
-            })
+            'endorsements':endorsements,
+            'num_endorsements':len(endorsements)
+            }, paginated, next_cursor)
         except:
             abort(404)
 
     # Delete all endorsements
     @app.route('/endorsements', methods=['DELETE'])
+    @query_budget(2)
     @requires_auth('edit:endorsement')
     def delete_all_endorsements(jwt):
         # Delete all rows from model Endorsement
         num_deleted_rows = db.session.query(Endorsement).delete()
         db.session.commit()
+        trust_graph.invalidate()
+        skill_index.invalidate()
+        recommendation_cache.clear()
+        response_cache.clear()
 
         if (len(Endorsement.query.all()) != 0):
             db.session.rollback()
@@ -382,6 +1249,7 @@ def create_app(test_config=None):
 
     # Create a new endorsement via POST
     @app.route('/endorsements', methods=['POST'])
+    @query_budget(2)
     @requires_auth('edit:endorsement')
     def post_new_endorsement(jwt):
         try:
@@ -400,6 +1268,11 @@ def create_app(test_config=None):
 
             # Create new entry in database
             new_endorsement.insert()
+            trust_graph.add_edge(new_endorsement.id, new_endorsement.giver_id,
+                new_endorsement.receiver_id, new_endorsement.skill_id)
+            recommendation_cache.invalidate(new_endorsement.giver_id)
+            response_cache.invalidate(endorsement_tags([(new_endorsement.giver_id,
+                new_endorsement.receiver_id, new_endorsement.skill_id)]))
 
             return jsonify({
                 'success':True,
@@ -409,8 +1282,32 @@ def create_app(test_config=None):
             db.session.rollback()
             abort(422)
 
+    # Create many endorsements at once from a JSON array
+    @app.route('/endorsements/batch', methods=['POST'])
+    @query_budget(batch_budget(3))
+    @requires_auth('edit:endorsement')
+    def post_new_endorsements_batch(jwt):
+        items = request.get_json()
+        try:
+            body = create_batch(Endorsement, items, endorsement_row, check_endorsements)
+            created = []
+            for result, item in zip(body['results'], items):
+                if result['success']:
+                    row = endorsement_row(item)
+                    trust_graph.add_edge(result['id'], row['giver_id'],
+                        row['receiver_id'], row['skill_id'])
+                    recommendation_cache.invalidate(row['giver_id'])
+                    created.append((row['giver_id'], row['receiver_id'], row['skill_id']))
+            if created:
+                response_cache.invalidate(endorsement_tags(created))
+            return jsonify(body)
+        except:
+            db.session.rollback()
+            abort(422)
+
     # Delete a selected endorsement
     @app.route('/endorsements/<id>', methods=['DELETE'])
+    @query_budget(2)
     @requires_auth('edit:endorsement')
     def delete_endorsement(jwt, id):
         try:
@@ -421,6 +1318,11 @@ def create_app(test_config=None):
                 abort(404)
             
             endorsement.delete()
+            trust_graph.remove_edge(endorsement.giver_id, endorsement.receiver_id,
+                endorsement.skill_id)
+            recommendation_cache.invalidate(endorsement.giver_id)
+            response_cache.invalidate(endorsement_tags([(endorsement.giver_id,
+                endorsement.receiver_id, endorsement.skill_id)]))
 
             return jsonify({
                 'success':True,
@@ -430,6 +1332,61 @@ def create_app(test_config=None):
             db.session.rollback()
             abort(422)
 
+    # Search users and skills by name, location and description, ranked by
+    # relevance. Results are paginated by position, as they are not sorted
+    # by id.
+    @app.route('/search', methods=['GET'])
+    @query_budget(search_budget)
+    @requires_auth('read:user')
+    @response_cache.cached(lambda: ['users', 'skills'])
+    def search(jwt):
+        query = request.args.get('q', '').strip()
+        kind = request.args.get('type', None)
+        if not query or len(query) > MAX_SEARCH_QUERY_LENGTH or \
+                kind not in (None, 'users', 'skills'):
+            abort(422)
+        kinds = [kind] if kind else ['users', 'skills']
+        if 'skills' in kinds:
+            check_permissions('read:skill', jwt)
+
+        limit, after, paginated = get_page_params()
+        if not paginated:
+            limit = DEFAULT_SEARCH_LIMIT
+        offset = after or 0
+        if offset < 0:
+            abort(422)
+
+        matches = search_matches(query, kinds, offset + limit + 1)
+        next_cursor = offset + limit if len(matches) > offset + limit else None
+        matches = matches[offset:offset + limit]
+
+        # Rows of the page, in one query per kind
+        rows = {}
+        for kind, model in (('users', Profile), ('skills', Skill)):
+            ids = [id for match_kind, id, _ in matches if match_kind == kind]
+            if ids:
+                rows[kind] = {row.id: row for row in model.query.filter(model.id.in_(ids))}
+
+        results = []
+        for kind, id, score in matches:
+            row = rows[kind].get(id)
+            # Skip rows deleted since they were matched
+            if row is not None:
+                results.append({
+                    'type': kind[:-1],
+                    'score': round(score, 4),
+                    kind[:-1]: row.format()
+                })
+
+        if (len(results) == 0):
+            abort(404)
+
+        return page_response({
+        'success':True,
+        'results':results,
+        'num_results':len(results)
+        }, paginated, next_cursor)
+
     # Error handlers
     @app.errorhandler(404)
     def not_found(error):
@@ -457,7 +1414,17 @@ def create_app(test_config=None):
 
     return app
 
-app = create_app()
+# Work done once in the process that forks the workers (gunicorn --preload,
+# see gunicorn.conf.py): load the endorsement graph and the skill autocomplete
+# index, which the workers share, and close the connections opened meanwhile,
+# as the workers open their own
+def preload(app):
+    with app.app_context():
+        trust_graph.load()
+        skill_index.load()
+        db.session.remove()
+        db.get_engine(app).dispose()
+    return app
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    create_app().run(debug=True)
\ No newline at end of file
@@ -1,9 +1,16 @@
 # Library for role-based authentication using Auth0 JWT tokens
 
+import hashlib
 import json
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
 from flask import request, _request_ctx_stack, abort
 from functools import wraps
 from jose import jwt
+from metrics import add_timing
 from urllib.request import urlopen
 import os
 
@@ -12,6 +19,21 @@ AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN', 'jaimeam.eu.auth0.com')
 ALGORITHMS = os.environ.get('ALGORITHMS', ['RS256'])
 API_AUDIENCE = os.environ.get('API_AUDIENCE', 'endorsa')
 
+# JWKS location and caching. JWKS_URL also accepts file:// URLs, which is
+# handy to point the app at a local key set. When JWKS_TTL is not set, the
+# Cache-Control max-age sent by the identity provider is used instead.
+JWKS_URL = os.environ.get('JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+JWKS_TTL = os.environ.get('JWKS_TTL', None)
+JWKS_DEFAULT_TTL = 600
+JWKS_REFRESH_MARGIN = int(os.environ.get('JWKS_REFRESH_MARGIN', 60))
+JWKS_MIN_REFRESH_INTERVAL = int(os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = int(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+
+# Maximum number of verified tokens kept in memory. 0 disables the cache.
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+
+logger = logging.getLogger(__name__)
+
 ## AuthError Exception
 '''
 AuthError Exception
@@ -23,6 +45,223 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+## JWKS key store
+'''
+JWKSKeyStore
+Process-wide cache of the identity provider's public keys, indexed by kid.
+Keys are fetched once and kept until their TTL expires. Shortly before expiry
+a background thread refreshes them, so requests never wait on the network
+except on a cold start. An unknown kid (e.g. after a key rotation) triggers
+a single refetch, rate-limited to one every min_refresh_interval seconds.
+'''
+class JWKSKeyStore:
+    def __init__(self, url, ttl=None, refresh_margin=60, min_refresh_interval=30,
+                 timeout=5, default_ttl=JWKS_DEFAULT_TTL):
+        self.url = url
+        self.ttl = ttl
+        self.default_ttl = default_ttl
+        self.refresh_margin = refresh_margin
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.fetch_count = 0
+
+        self._keys = {}
+        self._expires_at = 0
+        self._last_fetch = None
+        self._refreshing = False
+        self._state_lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+
+    # Parse max-age out of a Cache-Control header, if any
+    @staticmethod
+    def _max_age(cache_control):
+        if not cache_control or 'no-store' in cache_control:
+            return None
+        match = re.search(r'max-age=(\d+)', cache_control)
+        if match:
+            return int(match.group(1))
+        return None
+
+    # Download the key set and keep only the fields needed to verify RS256
+    def _fetch(self):
+        with urlopen(self.url, timeout=self.timeout) as response:
+            jwks = json.loads(response.read())
+            headers = getattr(response, 'headers', None)
+            cache_control = headers.get('Cache-Control') if headers else None
+
+        keys = {}
+        for key in jwks.get('keys', []):
+            if key.get('kty') != 'RSA' or 'kid' not in key:
+                continue
+            keys[key['kid']] = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key.get('use', 'sig'),
+                'n': key['n'],
+                'e': key['e']
+            }
+        return keys, self._max_age(cache_control)
+
+    # Fetch the key set and swap it in. On failure the previous keys are
+    # kept and the next attempt is delayed by min_refresh_interval.
+    # Callers must hold _fetch_lock.
+    def _update(self):
+        now = time.monotonic()
+        self._last_fetch = now
+        self.fetch_count += 1
+        try:
+            keys, max_age = self._fetch()
+        except Exception:
+            logger.exception('Unable to fetch JWKS from %s', self.url)
+            with self._state_lock:
+                self._expires_at = now + self.min_refresh_interval
+            return False
+
+        if self.ttl is not None:
+            ttl = self.ttl
+        elif max_age is not None:
+            ttl = max_age
+        else:
+            ttl = self.default_ttl
+
+        with self._state_lock:
+            self._keys = keys
+            self._expires_at = now + ttl
+        return True
+
+    def refresh(self):
+        with self._fetch_lock:
+            return self._update()
+
+    def _refresh_in_background(self):
+        with self._state_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            finally:
+                with self._state_lock:
+                    self._refreshing = False
+
+        threading.Thread(target=run, name='jwks-refresh', daemon=True).start()
+
+    # Blocking refresh shared by concurrent callers: only the first caller
+    # hits the network, the others wait and reuse its result.
+    def _refresh_if_stale(self, last_seen_fetch):
+        with self._fetch_lock:
+            if self._last_fetch == last_seen_fetch:
+                self._update()
+
+    def get_key(self, kid):
+        now = time.monotonic()
+        last_fetch = self._last_fetch
+
+        if now >= self._expires_at:
+            self._refresh_if_stale(last_fetch)
+        elif (now >= self._expires_at - self.refresh_margin
+                and now - last_fetch >= self.min_refresh_interval):
+            self._refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is not None:
+            return key
+
+        # Unknown kid: the provider may have rotated its keys
+        last_fetch = self._last_fetch
+        if last_fetch is None or time.monotonic() - last_fetch >= self.min_refresh_interval:
+            self._refresh_if_stale(last_fetch)
+            key = self._keys.get(kid)
+        return key
+
+    # Drop cached keys, forcing a fetch on next use
+    def clear(self):
+        with self._state_lock:
+            self._keys = {}
+            self._expires_at = 0
+            self._last_fetch = None
+
+
+jwks_store = JWKSKeyStore(
+    JWKS_URL,
+    ttl=int(JWKS_TTL) if JWKS_TTL else None,
+    refresh_margin=JWKS_REFRESH_MARGIN,
+    min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+    timeout=JWKS_FETCH_TIMEOUT
+)
+
+
+## Verified token cache
+'''
+TokenCache
+Bounded LRU cache of verified JWT payloads, keyed by a SHA-256 hash of the
+token so raw tokens are never kept in memory. Entries expire at the token's
+own exp claim, so a cached token is never accepted past its lifetime.
+'''
+class TokenCache:
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def get(self, token):
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires_at, payload = entry
+            if time.time() >= expires_at:
+                del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return payload
+
+    def set(self, token, payload):
+        # Tokens without an expiration are always verified again
+        expires_at = payload.get('exp')
+        if self.maxsize <= 0 or not isinstance(expires_at, (int, float)):
+            return
+
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (expires_at, payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+token_cache = TokenCache(TOKEN_CACHE_SIZE)
+
+
 ## Auth Header
 
 def get_token_auth_header():
@@ -71,30 +310,22 @@ def check_permissions(permission, payload):
     return True
 
 def verify_decode_jwt(token):
-    # GET THE PUBLIC KEY FROM AUTH0
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-    
+    # TOKENS ALREADY VERIFIED ARE SERVED FROM MEMORY
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+
     # GET THE DATA IN THE HEADER
     unverified_header = jwt.get_unverified_header(token)
     
-    # CHOOSE OUR KEY
-    rsa_key = {}
+    # CHOOSE OUR KEY FROM THE CACHED AUTH0 KEY SET
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = jwks_store.get_key(unverified_header['kid'])
     
     # Finally, verify!!!
     if rsa_key:
@@ -108,6 +339,7 @@ def verify_decode_jwt(token):
                 issuer='https://' + AUTH0_DOMAIN + '/'
             )
 
+            token_cache.set(token, payload)
             return payload
 
         except jwt.ExpiredSignatureError:
@@ -135,12 +367,16 @@ def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
+            start = time.perf_counter()
             try:
-                payload = verify_decode_jwt(token)
-            except:
-                abort(401)
-            check_permissions(permission, payload)
+                token = get_token_auth_header()
+                try:
+                    payload = verify_decode_jwt(token)
+                except:
+                    abort(401)
+                check_permissions(permission, payload)
+            finally:
+                add_timing('auth', time.perf_counter() - start)
             return f(payload, *args, **kwargs)
         return wrapper
     return requires_auth_decorator
@@ -0,0 +1,157 @@
+# In-memory prefix index of skill names, for per-keystroke suggestions
+
+import bisect
+import heapq
+import os
+import re
+import threading
+import time
+import unicodedata
+from array import array
+from models import db, Skill
+
+# Seconds between full reloads, which pick up endorsement counts and skills
+# changed by other processes. Skills created, renamed or deleted through this
+# process are applied to the index right away.
+AUTOCOMPLETE_RELOAD_INTERVAL = int(os.environ.get('AUTOCOMPLETE_RELOAD_INTERVAL', 60))
+
+# Maximum number of suggestions per lookup
+MAX_SUGGESTIONS = 20
+
+# Characters of a name kept in each key, bounding the memory used per skill
+# and the length of prefixes that can be told apart
+KEY_LENGTH = 32
+
+# Prefixes matching more keys than this get their best suggestions computed
+# once and kept until the index changes, instead of ranking every match on
+# each lookup
+SCAN_LIMIT = 256
+
+# Words of a name, each the start of a key
+WORD = re.compile(r'\w+')
+
+
+# Lowercase without accents, so that "resume" matches "Résumé"
+def normalize(value):
+    if value.isascii():
+        return value.lower()
+    value = unicodedata.normalize('NFKD', value.lower())
+    return ''.join(c for c in value if not unicodedata.combining(c))
+
+# Keys of a name: the name from the start of each of its words, so that
+# "learn" suggests "Machine learning"
+def name_keys(name):
+    name = normalize(name)
+    return {name[match.start():match.start() + KEY_LENGTH] for match in WORD.finditer(name)}
+
+
+'''
+SkillIndex
+Sorted array of the keys of every skill name, searched with bisect. The
+keys starting with a prefix are contiguous, and their skills are ranked
+by number of endorsements.
+'''
+class SkillIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset([])
+        self.loaded_at = None
+
+    # Rebuild from (id, name, num_endorsements) rows
+    def _reset(self, rows):
+        self._names = {}
+        self._popularity = {}
+        entries = []
+        for id, name, num_endorsements in rows:
+            self._names[id] = name
+            self._popularity[id] = num_endorsements
+            entries += [(key, id) for key in name_keys(name)]
+        entries.sort()
+        self._keys = [key for key, _ in entries]
+        self._ids = array('l', [id for _, id in entries])
+        self._top = {}
+
+    # Load (id, name, num_endorsements) rows, by default every skill
+    def load(self, rows=None):
+        if rows is None:
+            rows = db.session.query(Skill.id, Skill.name, Skill.num_endorsements).all()
+        with self._lock:
+            self._reset(rows)
+            self.loaded_at = time.monotonic()
+
+    def sync(self):
+        if self.loaded_at is None or \
+                time.monotonic() - self.loaded_at >= AUTOCOMPLETE_RELOAD_INTERVAL:
+            self.load()
+
+    # Force a full reload on next use, after bulk deletes
+    def invalidate(self):
+        self.loaded_at = None
+
+    def _remove(self, id):
+        name = self._names.pop(id, None)
+        if name is None:
+            return
+        self._popularity.pop(id, None)
+        for key in name_keys(name):
+            index = bisect.bisect_left(self._keys, key)
+            while index < len(self._keys) and self._keys[index] == key:
+                if self._ids[index] == id:
+                    del self._keys[index]
+                    del self._ids[index]
+                    break
+                index += 1
+
+    # Add a skill, or update it after a rename
+    def add(self, id, name, num_endorsements=0):
+        with self._lock:
+            if self.loaded_at is None:
+                return
+            self._remove(id)
+            self._names[id] = name
+            self._popularity[id] = num_endorsements
+            for key in name_keys(name):
+                index = bisect.bisect_right(self._keys, key)
+                self._keys.insert(index, key)
+                self._ids.insert(index, id)
+            self._top.clear()
+
+    def remove(self, id):
+        with self._lock:
+            if self.loaded_at is not None:
+                self._remove(id)
+                self._top.clear()
+
+    # Ids of the best skills among the keys from lo to hi, most endorsed first
+    def _rank(self, lo, hi, limit):
+        ids = set(self._ids[lo:hi])
+        return heapq.nsmallest(limit, ids,
+            key=lambda id: (-self._popularity[id], self._names[id], id))
+
+    # Up to limit (id, name, num_endorsements) suggestions for a prefix
+    def suggest(self, prefix, limit):
+        prefix = normalize(prefix)[:KEY_LENGTH]
+        with self._lock:
+            lo = bisect.bisect_left(self._keys, prefix)
+            hi = bisect.bisect_left(self._keys, prefix + '\U0010ffff', lo)
+            if hi - lo > SCAN_LIMIT:
+                top = self._top.get(prefix)
+                if top is None:
+                    top = self._top[prefix] = self._rank(lo, hi, MAX_SUGGESTIONS)
+                ids = top[:limit]
+            else:
+                ids = self._rank(lo, hi, limit)
+            return [(id, self._names[id], self._popularity[id]) for id in ids]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'skills': len(self._names),
+                'keys': len(self._keys),
+                'cached_prefixes': len(self._top),
+                'loaded_seconds_ago': time.monotonic() - self.loaded_at
+                    if self.loaded_at is not None else None
+            }
+
+
+skill_index = SkillIndex()
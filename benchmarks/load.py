@@ -0,0 +1,537 @@
+# Load test of every route: requests per second and p50/p95/p99 latency.
+#
+# Tokens are minted by a local RS256 issuer, whose key set is served by a
+# local JWKS server. Unless --no-seed is given, a synthetic endorsement graph
+# is first imported into the database set in DATABASE_URL, which must be an
+# empty PostgreSQL database with the migrations applied. Rows created by the
+# write routes are deleted at the end. Requests go to the app in this
+# process, or with --url to a running server started with the printed
+# JWKS_URL. Results are saved as JSON, and
+# compared with a previous run with --compare.
+#
+# Usage: python benchmarks/load.py [--profiles 10000] [--skills 500]
+#     [--endorsements 100000] [--requests 500] [--concurrency 8]
+#     [--url http://localhost:5000] [--output results.json] [--compare previous.json]
+
+import argparse
+import base64
+import csv
+import http.client
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+import numpy as np
+import rsa
+from jose import jwt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import auth
+
+PERMISSIONS = ['read:user', 'edit:user', 'read:skill', 'edit:skill',
+    'read:endorsement', 'edit:endorsement']
+
+# Size of the synthetic dataset. Receivers and skills of endorsements are
+# drawn from a Zipf-like distribution with this exponent, so a few users and
+# skills get most endorsements; givers are drawn with half the exponent.
+DEFAULT_PROFILES = 10000
+DEFAULT_SKILLS = 500
+DEFAULT_ENDORSEMENTS = 100000
+DEFAULT_SKEW = 1.0
+
+# Requests sent per route (batch routes get a tenth, with BATCH_SIZE items
+# each), concurrent clients, distinct tokens used and untimed warmup
+# requests per read route
+DEFAULT_REQUESTS = 500
+DEFAULT_CONCURRENCY = 8
+DEFAULT_TOKENS = 20
+DEFAULT_WARMUP = 20
+BATCH_SIZE = 100
+
+# Relative change of p95 latency or throughput reported as a regression
+REGRESSION_THRESHOLD = 0.1
+
+
+def base64url_uint(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+'''
+LocalIssuer
+Stand-in for Auth0: an RSA key pair, its JWKS, and RS256 access tokens with
+the issuer and audience the API expects.
+'''
+class LocalIssuer:
+    def __init__(self, bits=2048):
+        self.public_key, private_key = rsa.newkeys(bits)
+        self.private_pem = private_key.save_pkcs1().decode('ascii')
+        self.kid = uuid.uuid4().hex
+
+    def jwks(self):
+        return {'keys': [{
+            'kty': 'RSA',
+            'kid': self.kid,
+            'use': 'sig',
+            'alg': 'RS256',
+            'n': base64url_uint(self.public_key.n),
+            'e': base64url_uint(self.public_key.e)
+        }]}
+
+    def token(self, permissions=PERMISSIONS, subject='benchmark|1', expires_in=3600):
+        now = int(time.time())
+        claims = {
+            'iss': f'https://{auth.AUTH0_DOMAIN}/',
+            'sub': subject,
+            'aud': auth.API_AUDIENCE,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': list(permissions)
+        }
+        return jwt.encode(claims, self.private_pem, algorithm='RS256', headers={'kid': self.kid})
+
+
+'''
+JWKSServer
+Local HTTP server publishing the key set of a LocalIssuer, to be used as
+JWKS_URL by the API under test.
+'''
+class JWKSServer:
+    def __init__(self, issuer, port=0):
+        body = json.dumps(issuer.jwks()).encode('utf-8')
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Cache-Control', 'public, max-age=600')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', port), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/.well-known/jwks.json'
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='jwks-stub', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# Ids drawn from ids with Zipf-like weights: the i-th most popular id (in a
+# random order of popularity) is drawn with a weight of 1 / i ** exponent
+def skewed_choice(rng, ids, size, exponent):
+    weights = 1.0 / np.arange(1, len(ids) + 1) ** exponent
+    popularity = rng.permutation(ids)
+    return popularity[rng.choice(len(ids), size, p=weights / weights.sum())]
+
+# Write profiles, skills and endorsements CSV files for the importer.
+# Returns the paths of the files and the number of endorsements written,
+# which can be below the number asked for on small graphs.
+def generate_dataset(directory, profiles=DEFAULT_PROFILES, skills=DEFAULT_SKILLS,
+                     endorsements=DEFAULT_ENDORSEMENTS, skew=DEFAULT_SKEW, seed=0):
+    rng = np.random.default_rng(seed)
+    paths = {name: os.path.join(directory, f'{name}.csv')
+        for name in ('profiles', 'skills', 'endorsements')}
+
+    with open(paths['profiles'], 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['id', 'first_name', 'last_name', 'location', 'description', 'contact'])
+        for i in range(1, profiles + 1):
+            writer.writerow([i, f'First{i}', f'Last{i}', f'City {i % 100}',
+                f'Synthetic profile {i}', 600000000 + i])
+
+    with open(paths['skills'], 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['id', 'name', 'description'])
+        for i in range(1, skills + 1):
+            writer.writerow([i, f'Skill {i}', f'Synthetic skill {i}'])
+
+    # Draw extra edges, then drop self-endorsements and duplicates
+    size = int(endorsements * 1.2) + 100
+    profile_ids = np.arange(1, profiles + 1)
+    edges = np.stack([
+        skewed_choice(rng, profile_ids, size, skew / 2),
+        skewed_choice(rng, profile_ids, size, skew),
+        skewed_choice(rng, np.arange(1, skills + 1), size, skew)], axis=1)
+    edges = np.unique(edges[edges[:, 0] != edges[:, 1]], axis=0)
+    edges = rng.permutation(edges)[:endorsements]
+
+    start = datetime.now() - timedelta(days=3 * 365)
+    days = rng.integers(0, 3 * 365, len(edges))
+    with open(paths['endorsements'], 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['giver_id', 'receiver_id', 'skill_id', 'creation_date'])
+        for (giver, receiver, skill), day in zip(edges.tolist(), days.tolist()):
+            writer.writerow([giver, receiver, skill, (start + timedelta(days=day)).date()])
+
+    return paths, len(edges)
+
+
+'''
+AppClient
+Sends requests to the app in the same process, through the Flask test client.
+'''
+class AppClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, token, body=None):
+        response = self.client.open(path, method=method, json=body,
+            headers={'Authorization': 'Bearer ' + token})
+        return response.status_code, response.get_json(silent=True)
+
+'''
+HTTPClient
+Sends requests to a running server over a persistent HTTP connection.
+'''
+class HTTPClient:
+    def __init__(self, url):
+        parts = urlsplit(url)
+        connection_class = http.client.HTTPSConnection if parts.scheme == 'https' \
+            else http.client.HTTPConnection
+        self.connection = connection_class(parts.netloc, timeout=60)
+        self.prefix = parts.path.rstrip('/')
+
+    def request(self, method, path, token, body=None):
+        headers = {'Authorization': 'Bearer ' + token}
+        data = None
+        if body is not None:
+            data = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        self.connection.request(method, self.prefix + path, data, headers)
+        response = self.connection.getresponse()
+        content = response.read()
+        try:
+            return response.status, json.loads(content)
+        except ValueError:
+            return response.status, None
+
+
+'''
+Scenario
+Requests sent to one route: a name, the method, and a function returning
+the (path, body) of each request, called when the scenario starts so it can
+use rows created by the previous ones. collect is called with the body of
+every successful response, e.g. to remember the ids of created rows.
+'''
+class Scenario:
+    def __init__(self, name, method, requests, collect=None):
+        self.name = name
+        self.method = method
+        self.requests = requests
+        self.collect = collect
+
+
+# Scenarios covering every route, reads first. Write routes create rows for
+# the users, skills and endorsements they need, and delete them at the end,
+# so the dataset is left as it was. Routes deleting every row are skipped.
+def build_scenarios(profile_ids, skill_ids, requests=DEFAULT_REQUESTS, skew=DEFAULT_SKEW, seed=0):
+    rng = np.random.default_rng(seed)
+    users = lambda n: skewed_choice(rng, profile_ids, n, skew).tolist()
+    skills = lambda n: skewed_choice(rng, skill_ids, n, skew).tolist()
+    after = lambda ids, n: rng.choice(ids, n).tolist()
+    batches = max(1, requests // 10)
+    created = {'users': [], 'skills': [], 'endorsements': []}
+
+    def collect(kind):
+        def add(data):
+            if 'results' in data:
+                created[kind].extend(r['id'] for r in data['results'] if r['success'])
+            else:
+                created[kind].append(data['user' if kind == 'users' else kind[:-1]]['id'])
+        return add
+
+    # Endorsements given by the users created here, which have none yet
+    def new_endorsements(n):
+        givers = rng.choice(created['users'], n).tolist() if created['users'] else []
+        pairs = {(g, r, s) for g, r, s in zip(givers, users(n), skills(n)) if g != r}
+        return [{'giver_id': g, 'receiver_id': r, 'skill_id': s} for g, r, s in pairs]
+
+    return [
+        Scenario('GET /', 'GET', lambda: [('/', None)] * requests),
+        Scenario('GET /users', 'GET', lambda: [(f'/users?limit=100&after={a}', None)
+            for a in after(profile_ids, requests)]),
+        Scenario('GET /users/<id>', 'GET', lambda: [(f'/users/{u}', None)
+            for u in users(requests)]),
+        Scenario('GET /users/<id>/path/<other_id>', 'GET', lambda: [(f'/users/{u}/path/{o}', None)
+            for u, o in zip(users(requests), users(requests))]),
+        Scenario('GET /users/<id>/recommendations', 'GET', lambda: [
+            (f'/users/{u}/recommendations?skill_id={s}', None)
+            for u, s in zip(users(requests), skills(requests))]),
+        Scenario('GET /users?ids=<50 ids>&include=endorsements', 'GET', lambda: [
+            ('/users?include=endorsements&ids=' + ','.join(map(str, users(50))), None)
+            for _ in range(requests)]),
+        Scenario('GET /skills', 'GET', lambda: [(f'/skills?limit=100&after={a}', None)
+            for a in after(skill_ids, requests)]),
+        Scenario('GET /skills/<id>', 'GET', lambda: [(f'/skills/{s}', None)
+            for s in skills(requests)]),
+        Scenario('GET /skills/<id>/top', 'GET', lambda: [(f'/skills/{s}/top', None)
+            for s in skills(requests)]),
+        Scenario('GET /skills/<id>/top?sort=trust', 'GET', lambda: [(f'/skills/{s}/top?sort=trust', None)
+            for s in skills(requests)]),
+        Scenario('GET /skills/autocomplete?q=<prefix>', 'GET', lambda: [
+            (f'/skills/autocomplete?q=Skill%20{i}', None) for i in rng.integers(1, 100, requests).tolist()]),
+        Scenario('GET /search?q=<name>', 'GET', lambda: [(f'/search?q=Last{i}', None)
+            for i in rng.integers(0, len(profile_ids), requests).tolist()]),
+        Scenario('GET /search?q=<misspelt name>', 'GET', lambda: [(f'/search?q=Lst{i}', None)
+            for i in rng.integers(0, len(profile_ids), requests).tolist()]),
+        Scenario('GET /endorsements', 'GET', lambda: [(f'/endorsements?limit=100&after={a}', None)
+            for a in rng.integers(0, len(profile_ids) * 10, requests).tolist()]),
+        Scenario('GET /cache/stats', 'GET', lambda: [('/cache/stats', None)] * requests),
+        Scenario('GET /db/stats', 'GET', lambda: [('/db/stats', None)] * requests),
+        Scenario('GET /metrics', 'GET', lambda: [('/metrics', None)] * requests),
+
+        Scenario('POST /users', 'POST', lambda: [('/users', {'first_name': 'Bench',
+            'last_name': f'User{i}', 'location': 'Nowhere', 'contact': i}) for i in range(requests)],
+            collect('users')),
+        Scenario('POST /users/batch', 'POST', lambda: [('/users/batch', [{'first_name': 'Bench',
+            'last_name': f'Batch{b}-{i}'} for i in range(BATCH_SIZE)]) for b in range(batches)],
+            collect('users')),
+        Scenario('PATCH /users/<id>', 'PATCH', lambda: [(f'/users/{u}', {'location': 'Somewhere'})
+            for u in created['users'][:requests]]),
+        Scenario('POST /skills', 'POST', lambda: [('/skills', {'name': f'Bench skill {i}',
+            'description': 'Benchmark'}) for i in range(requests)], collect('skills')),
+        Scenario('POST /skills/batch', 'POST', lambda: [('/skills/batch', [{'name': f'Bench skill {b}-{i}'}
+            for i in range(BATCH_SIZE)]) for b in range(batches)], collect('skills')),
+        Scenario('PATCH /skills/<id>', 'PATCH', lambda: [(f'/skills/{s}', {'description': 'Changed'})
+            for s in created['skills'][:requests]]),
+        Scenario('POST /endorsements', 'POST', lambda: [('/endorsements', e)
+            for e in new_endorsements(requests)], collect('endorsements')),
+        Scenario('POST /endorsements/batch', 'POST', lambda: [('/endorsements/batch',
+            new_endorsements(BATCH_SIZE)) for _ in range(batches)]),
+        Scenario('DELETE /endorsements/<id>', 'DELETE', lambda: [(f'/endorsements/{e}', None)
+            for e in created['endorsements']]),
+        # Also deletes the endorsements created in batch
+        Scenario('DELETE /users/<id>', 'DELETE', lambda: [(f'/users/{u}', None)
+            for u in created['users']]),
+        Scenario('DELETE /skills/<id>', 'DELETE', lambda: [(f'/skills/{s}', None)
+            for s in created['skills']])
+    ]
+
+
+# Latency percentiles and throughput of a scenario
+def summarize(latencies, statuses, seconds):
+    latencies = np.array(latencies) * 1000
+    counts = {}
+    for status in statuses:
+        counts[str(status)] = counts.get(str(status), 0) + 1
+    if len(latencies) == 0:
+        return {'requests': 0, 'errors': 0, 'statuses': counts}
+    return {
+        'requests': len(latencies),
+        # Rejected tokens mean the server does not use the local issuer
+        'errors': sum(1 for status in statuses if status in (None, 401, 403) or status >= 500),
+        'statuses': counts,
+        'rps': len(latencies) / seconds if seconds > 0 else None,
+        'mean_ms': float(latencies.mean()),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'max_ms': float(latencies.max())
+    }
+
+# Send the requests of a scenario from concurrency threads, each with its own
+# client, cycling through the tokens. Read scenarios first send warmup
+# requests, which are not timed.
+def run_scenario(make_client, tokens, scenario, concurrency=DEFAULT_CONCURRENCY,
+                 warmup=DEFAULT_WARMUP):
+    requests = scenario.requests()
+    if scenario.method == 'GET' and warmup:
+        client = make_client()
+        for i, (path, body) in enumerate(requests[:warmup]):
+            client.request(scenario.method, path, tokens[i % len(tokens)], body)
+
+    latencies = [None] * len(requests)
+    statuses = [None] * len(requests)
+    counter = itertools.count()
+
+    def work():
+        client = make_client()
+        while True:
+            i = next(counter)
+            if i >= len(requests):
+                return
+            path, body = requests[i]
+            start = time.perf_counter()
+            try:
+                status, data = client.request(scenario.method, path, tokens[i % len(tokens)], body)
+            except Exception:
+                status, data = None, None
+            latencies[i] = time.perf_counter() - start
+            statuses[i] = status
+            if scenario.collect and status == 200 and data:
+                scenario.collect(data)
+
+    threads = [threading.Thread(target=work) for _ in range(min(concurrency, len(requests)))]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, statuses, time.perf_counter() - start)
+
+def report(name, summary):
+    if not summary['requests']:
+        print(f'{name:<38} no requests')
+        return
+    print(f'{name:<38} {summary["requests"]:>6} req {summary["rps"]:>9.1f} req/s  '
+        f'p50 {summary["p50_ms"]:7.2f}  p95 {summary["p95_ms"]:7.2f}  p99 {summary["p99_ms"]:7.2f} ms  '
+        f'{summary["errors"]} errors')
+
+# Run every scenario. Returns the results, ready to be saved as JSON.
+def run_benchmark(make_client, tokens, scenarios, concurrency=DEFAULT_CONCURRENCY,
+                  warmup=DEFAULT_WARMUP, settings=None):
+    routes = {}
+    for scenario in scenarios:
+        routes[scenario.name] = run_scenario(make_client, tokens, scenario, concurrency, warmup)
+        report(scenario.name, routes[scenario.name])
+
+    return {
+        'commit': current_commit(),
+        'created_at': datetime.utcnow().isoformat() + 'Z',
+        'settings': dict(settings or {}, concurrency=concurrency, tokens=len(tokens)),
+        'routes': routes
+    }
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Print the routes whose p95 latency or throughput got worse than previous
+# results by more than threshold. Returns the number of regressions.
+def compare(previous, current, threshold=REGRESSION_THRESHOLD):
+    regressions = 0
+    print(f'Compared with {previous.get("commit") or "previous results"}:')
+    for name, summary in current['routes'].items():
+        before = previous['routes'].get(name)
+        if not before or not before.get('requests') or not summary['requests']:
+            continue
+        p95 = summary['p95_ms'] / before['p95_ms'] - 1 if before['p95_ms'] else 0
+        rps = summary['rps'] / before['rps'] - 1 if before['rps'] else 0
+        regressed = p95 > threshold or rps < -threshold
+        regressions += regressed
+        print(f'{name:<38} p95 {p95:+7.1%}  req/s {rps:+7.1%}{"  REGRESSION" if regressed else ""}')
+    return regressions
+
+
+# Import the synthetic dataset and compute its trust scores
+def seed(db, args):
+    from importer import import_files
+    from models import Profile
+    from trust import compute_trust_scores
+
+    if db.engine.dialect.name != 'postgresql':
+        sys.exit('Seeding requires a PostgreSQL DATABASE_URL, use --no-seed otherwise')
+    if not db.engine.has_table(Profile.__tablename__):
+        sys.exit('The database has no tables: apply the migrations with python manage.py db upgrade')
+    if db.session.query(Profile.query.exists()).scalar():
+        sys.exit('The database is not empty: use a scratch database, '
+            'or --no-seed to benchmark the data already in it')
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths, num_endorsements = generate_dataset(directory, args.profiles, args.skills,
+            args.endorsements, args.skew, args.seed)
+        connection = db.engine.raw_connection()
+        try:
+            import_files(connection, paths['profiles'], paths['skills'], paths['endorsements'])
+            compute_trust_scores(connection, True)
+        finally:
+            connection.close()
+    return num_endorsements
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test every route of the API')
+    parser.add_argument('--profiles', type=int, default=DEFAULT_PROFILES)
+    parser.add_argument('--skills', type=int, default=DEFAULT_SKILLS)
+    parser.add_argument('--endorsements', type=int, default=DEFAULT_ENDORSEMENTS)
+    parser.add_argument('--skew', type=float, default=DEFAULT_SKEW,
+        help='exponent of the popularity of users and skills')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--no-seed', action='store_true',
+        help='benchmark the data already in the database')
+    parser.add_argument('--requests', type=int, default=DEFAULT_REQUESTS, help='requests per route')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--tokens', type=int, default=DEFAULT_TOKENS, help='distinct tokens used')
+    parser.add_argument('--url', default=None, help='URL of a running server')
+    parser.add_argument('--jwks-port', type=int, default=0, help='port of the local JWKS server')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', default=None, help='results of a previous run')
+    args = parser.parse_args()
+
+    from app import create_app
+    from models import db, Profile, Skill
+    from graph import trust_graph
+    from recommendations import recommendation_cache
+    from response_cache import response_cache
+
+    app = create_app()
+    issuer = LocalIssuer()
+    jwks = JWKSServer(issuer, args.jwks_port).start()
+
+    with app.app_context():
+        num_endorsements = None if args.no_seed else seed(db, args)
+
+        # Pick up the imported rows
+        trust_graph.load()
+        recommendation_cache.clear()
+        response_cache.clear()
+        profile_ids = [id for (id,) in db.session.query(Profile.id)]
+        skill_ids = [id for (id,) in db.session.query(Skill.id)]
+        database = db.engine.dialect.name
+        db.session.remove()
+    if not profile_ids or not skill_ids:
+        sys.exit('No users or skills to benchmark')
+
+    if args.url:
+        print(f'The server must be running with JWKS_URL={jwks.url}')
+        make_client = lambda: HTTPClient(args.url)
+    else:
+        auth.jwks_store.url = jwks.url
+        auth.jwks_store.clear()
+        auth.token_cache.clear()
+        make_client = lambda: AppClient(app)
+
+    settings = {
+        'target': args.url or 'in-process',
+        'database': database,
+        'profiles': len(profile_ids),
+        'skills': len(skill_ids),
+        'endorsements': num_endorsements,
+        'skew': args.skew,
+        'seed': args.seed,
+        'requests': args.requests
+    }
+    scenarios = build_scenarios(profile_ids, skill_ids, args.requests, args.skew, args.seed)
+    tokens = [issuer.token(subject=f'benchmark|{i}') for i in range(args.tokens)]
+    try:
+        results = run_benchmark(make_client, tokens, scenarios, args.concurrency, settings=settings)
+    finally:
+        jwks.stop()
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f'Results saved to {args.output}')
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), results)
+
+if __name__ == '__main__':
+    main()
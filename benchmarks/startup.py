@@ -0,0 +1,141 @@
+# Cold-start benchmark: time to import the app, create it and serve its first
+# requests, in fresh processes as started by gunicorn without --preload, and
+# in processes forked from a parent that created and preloaded the app once,
+# as gunicorn workers are with gunicorn.conf.py.
+#
+# The first requests are GET /, GET /users and a trust path between the
+# first two users, against the database set in DATABASE_URL. Tokens are
+# minted by the local issuer of the load test.
+#
+# Usage: python benchmarks/startup.py [--runs 10] [--forks 10]
+
+import argparse
+import importlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# The application object of the app module, whether it is created when the
+# module is imported or by calling create_app
+def get_app(module):
+    app = getattr(module, 'app', None)
+    return app if app is not None else module.create_app()
+
+# Serve the first requests of a process, returning the duration of each
+# in seconds
+def first_requests(app, token):
+    client = app.test_client()
+    headers = {'Authorization': 'bearer ' + token}
+    timings = {}
+
+    start = time.perf_counter()
+    client.get('/')
+    timings['GET /'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    response = client.get('/users', headers=headers)
+    timings['GET /users'] = time.perf_counter() - start
+
+    users = response.get_json().get('users', []) if response.status_code == 200 else []
+    if len(users) >= 2:
+        start = time.perf_counter()
+        client.get(f'/users/{users[0]["id"]}/path/{users[1]["id"]}', headers=headers)
+        timings['GET /users/<id>/path/<other_id>'] = time.perf_counter() - start
+    return timings
+
+# Run in a fresh interpreter by cold_runs: import the app, create it and
+# serve the first requests, printing the timings as JSON
+def child(token):
+    start = time.perf_counter()
+    module = importlib.import_module('app')
+    timings = {'import': time.perf_counter() - start}
+
+    start = time.perf_counter()
+    app = get_app(module)
+    timings['create_app'] = time.perf_counter() - start
+
+    timings.update(first_requests(app, token))
+    print(json.dumps(timings))
+
+def cold_runs(runs, token, jwks_url):
+    env = dict(os.environ, JWKS_URL=jwks_url)
+    results = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', token],
+            env=env, check=True, capture_output=True, text=True).stdout
+        timings = json.loads(output.strip().splitlines()[-1])
+        timings['process'] = time.perf_counter() - start
+        results.append(timings)
+    return results
+
+# Create the app once, then serve the first requests in forked processes
+def fork_runs(forks, token, jwks_url):
+    import auth
+    auth.jwks_store.url = jwks_url
+    module = importlib.import_module('app')
+    app = get_app(module)
+    if hasattr(module, 'preload'):
+        module.preload(app)
+
+    results = []
+    for _ in range(forks):
+        read_end, write_end = os.pipe()
+        start = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_end)
+            try:
+                timings = {'fork': time.perf_counter() - start}
+                timings.update(first_requests(app, token))
+                os.write(write_end, json.dumps(timings).encode('utf-8'))
+            finally:
+                os._exit(0)
+        os.close(write_end)
+        with os.fdopen(read_end) as pipe:
+            output = pipe.read()
+        os.waitpid(pid, 0)
+        timings = json.loads(output)
+        timings['process'] = time.perf_counter() - start
+        results.append(timings)
+    return results
+
+def report(title, results):
+    print(title)
+    for name in results[0]:
+        values = [1000 * timings[name] for timings in results if name in timings]
+        print(f'  {name:<34} median {statistics.median(values):9.1f} ms'
+            f'   max {max(values):9.1f} ms')
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the cold start of the app')
+    parser.add_argument('--runs', type=int, default=10, help='fresh processes started')
+    parser.add_argument('--forks', type=int, default=10,
+        help='processes forked from a preloaded app (0 to skip)')
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child(args.child)
+
+    from benchmarks.load import LocalIssuer, JWKSServer
+    issuer = LocalIssuer()
+    jwks = JWKSServer(issuer).start()
+    token = issuer.token()
+    try:
+        report(f'Fresh processes ({args.runs} runs)', cold_runs(args.runs, token, jwks.url))
+        if args.forks:
+            report(f'Forked from a preloaded app ({args.forks} runs)',
+                fork_runs(args.forks, token, jwks.url))
+    finally:
+        jwks.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# Benchmark of GET /users/<id>: ORM path (three queries, rows materialized in
+# Python) versus the single PostgreSQL json_build_object query.
+#
+# Seeds a user with N endorsements received and N given in the database set
+# in DATABASE_URL, times both paths and removes the seeded rows afterwards.
+#
+# Usage: python benchmarks/user_profile.py [--endorsements 10000] [--repeat 20]
+
+import argparse
+import os
+import statistics
+import sys
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import jsonify
+from app import create_app, get_user_profile
+from models import db, Profile, Skill, Endorsement, user_profile_json
+
+
+# Create one target user, plus enough other users and skills to give it
+# the requested number of endorsements in both directions
+def seed(num_endorsements):
+    num_skills = 100
+    num_peers = max(1, num_endorsements // num_skills)
+
+    target = Profile('Bench', 'Target', None, None, None)
+    peers = [Profile('Bench', f'Peer {i}', None, None, None) for i in range(num_peers)]
+    skills = [Skill(f'Bench skill {i}', None) for i in range(num_skills)]
+    db.session.add_all([target] + peers + skills)
+    db.session.commit()
+
+    today = date.today()
+    rows = []
+    for peer in peers:
+        for skill in skills:
+            rows.append({'giver_id': peer.id, 'receiver_id': target.id,
+                'skill_id': skill.id, 'creation_date': today})
+            rows.append({'giver_id': target.id, 'receiver_id': peer.id,
+                'skill_id': skill.id, 'creation_date': today})
+    db.session.execute(Endorsement.__table__.insert(), rows)
+    db.session.commit()
+
+    return target, peers, skills
+
+def cleanup(target, peers, skills):
+    profile_ids = [target.id] + [peer.id for peer in peers]
+    Endorsement.query.filter(Endorsement.giver_id.in_(profile_ids))\
+        .delete(synchronize_session=False)
+    Endorsement.query.filter(Endorsement.receiver_id.in_(profile_ids))\
+        .delete(synchronize_session=False)
+    Profile.query.filter(Profile.id.in_(profile_ids)).delete(synchronize_session=False)
+    Skill.query.filter(Skill.id.in_([skill.id for skill in skills]))\
+        .delete(synchronize_session=False)
+    db.session.commit()
+
+# Time a callable, returning the duration of each run in milliseconds
+def measure(fn, repeat):
+    fn()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+def report(name, timings, size):
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    print(f'{name:<12} mean {statistics.mean(timings):8.2f} ms   '
+        f'p50 {statistics.median(timings):8.2f} ms   p95 {p95:8.2f} ms   '
+        f'{size / 1024:8.1f} KiB')
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark GET /users/<id> queries')
+    parser.add_argument('--endorsements', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with create_app().test_request_context():
+        if db.engine.dialect.name != 'postgresql':
+            sys.exit('This benchmark requires a PostgreSQL DATABASE_URL')
+
+        target, peers, skills = seed(args.endorsements)
+        try:
+            orm = lambda: jsonify(get_user_profile(target.id)).get_data()
+            single = lambda: user_profile_json(target.id)
+
+            print(f'User {target.id} with {args.endorsements} endorsements '
+                f'received and given, {args.repeat} runs')
+            report('orm', measure(orm, args.repeat), len(orm()))
+            report('json_agg', measure(single, args.repeat), len(single()))
+        finally:
+            db.session.rollback()
+            cleanup(target, peers, skills)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,329 @@
+# In-memory index of the endorsement graph, for trust path queries
+
+import os
+import threading
+import time
+from array import array
+from flask import current_app
+from sqlalchemy import func
+from models import db, Profile, Endorsement, EndorsementDeletion
+
+# Seconds between checks for endorsements created or deleted by other
+# processes, and between full reloads, which compact the changes into the
+# arrays. The reload interval must stay under a day, the time deletions are
+# kept in the endorsement_deletion log.
+TRUST_GRAPH_SYNC_INTERVAL = int(os.environ.get('TRUST_GRAPH_SYNC_INTERVAL', 5))
+TRUST_GRAPH_RELOAD_INTERVAL = int(os.environ.get('TRUST_GRAPH_RELOAD_INTERVAL', 600))
+TRUST_GRAPH_BATCH_SIZE = 10000
+# Endorsement ids below the highest one seen that may still show up, from
+# transactions that got their id earlier but committed later. Each sync reads
+# the endorsements of this trailing window of ids again; later commits are
+# only picked up by the next reload.
+TRUST_GRAPH_LATE_IDS = int(os.environ.get('TRUST_GRAPH_LATE_IDS', 1000))
+
+'''
+Adjacency
+One direction of the graph in compressed sparse row form. The neighbours of
+user id u are targets[offsets[u]:offsets[u + 1]], and skills holds the skill
+of each of those edges. Profile ids are used directly as row numbers.
+'''
+class Adjacency:
+    def __init__(self, size):
+        self.offsets = array('l')
+        self.grow(size)
+        self.targets = array('i')
+        self.skills = array('i')
+
+    # Make room for user ids up to size
+    def grow(self, size):
+        missing = size + 2 - len(self.offsets)
+        if missing > 0:
+            self.offsets.frombytes(bytes(self.offsets.itemsize * missing))
+
+    # Build from (source, target, skill) rows sorted by source
+    @staticmethod
+    def from_sorted_rows(rows, size):
+        adjacency = Adjacency(size)
+        offsets = adjacency.offsets
+        for source, target, skill in rows:
+            if source + 1 >= len(offsets):
+                adjacency.grow(source)
+            offsets[source + 1] += 1
+            adjacency.targets.append(target)
+            adjacency.skills.append(skill)
+        for i in range(1, len(offsets)):
+            offsets[i] += offsets[i - 1]
+        return adjacency
+
+    def neighbours(self, node):
+        if node + 1 >= len(self.offsets):
+            return (), ()
+        start, end = self.offsets[node], self.offsets[node + 1]
+        return self.targets[start:end], self.skills[start:end]
+
+'''
+TrustGraph
+Directed graph of endorsements (giver -> receiver, per skill). The bulk of
+the edges live in two compact Adjacency arrays (outgoing and incoming),
+loaded from the database by the first query of each process. Edges written
+since the last load, by this process or others (going by the endorsement
+ids and the deletion log), are kept in a small overlay, merged on the next
+full reload. Reloads after the first one run in a background thread, and
+swap the arrays in when done.
+'''
+class TrustGraph:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Held by the thread reloading or syncing the graph
+        self._sync_lock = threading.Lock()
+        self._reset(Adjacency(0), Adjacency(0), 0)
+        self.loaded_at = None
+        self.synced_at = None
+        # Bumped by invalidate, so that a reload started before is not used
+        self._generation = 0
+        # Thread running the current background reload, if any
+        self.reloader = None
+
+    # max_endorsement_id is the highest id in the arrays, and late_ids the ids
+    # of the trailing window below it that the arrays hold
+    def _reset(self, outgoing, incoming, max_endorsement_id, max_deletion_id=0, late_ids=()):
+        self._outgoing = outgoing
+        self._incoming = incoming
+        self._added_outgoing = {}
+        self._added_incoming = {}
+        self._added_ids = set()
+        # (giver, receiver, skill) -> endorsement id of the added edges
+        self._added_edges = {}
+        self._removed = set()
+        self._late_ids = set(late_ids)
+        self.max_endorsement_id = max_endorsement_id
+        # Highest endorsement id read by sync
+        self.max_synced_id = max_endorsement_id
+        self.max_deletion_id = max_deletion_id
+
+    @property
+    def num_edges(self):
+        return len(self._outgoing.targets) + len(self._added_ids) - len(self._removed)
+
+    # Load every endorsement from the database, streaming rows sorted by the
+    # giver and receiver indexes straight into the arrays
+    def load(self):
+        generation = self._generation
+        # Read in a single statement, so that deletions logged after it are
+        # of endorsements this load may have seen, and recreating them gives
+        # them ids beyond max_endorsement_id
+        max_endorsement_id, max_deletion_id, max_profile_id = db.session.query(
+            db.session.query(func.max(Endorsement.id)).label('max_endorsement_id'),
+            db.session.query(func.max(EndorsementDeletion.id)).label('max_deletion_id'),
+            db.session.query(func.max(Profile.id)).label('max_profile_id')).one()
+        max_endorsement_id = max_endorsement_id or 0
+
+        def edges(source, target):
+            return db.session.query(source, target, Endorsement.skill_id, Endorsement.id)\
+                .filter(Endorsement.id <= max_endorsement_id)\
+                .order_by(source)\
+                .yield_per(TRUST_GRAPH_BATCH_SIZE)
+
+        # Ids of the trailing window that made it into the arrays, so that
+        # sync only adds those committed after this load
+        late_ids = set()
+        def outgoing_rows():
+            for giver_id, receiver_id, skill_id, endorsement_id in \
+                    edges(Endorsement.giver_id, Endorsement.receiver_id):
+                if endorsement_id > max_endorsement_id - TRUST_GRAPH_LATE_IDS:
+                    late_ids.add(endorsement_id)
+                yield giver_id, receiver_id, skill_id
+
+        outgoing = Adjacency.from_sorted_rows(outgoing_rows(), max_profile_id)
+        incoming = Adjacency.from_sorted_rows(
+            (row[:3] for row in edges(Endorsement.receiver_id, Endorsement.giver_id)
+                if row[3] <= max_endorsement_id - TRUST_GRAPH_LATE_IDS or row[3] in late_ids),
+            max_profile_id)
+
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._reset(outgoing, incoming, max_endorsement_id, max_deletion_id or 0, late_ids)
+            self.loaded_at = self.synced_at = time.monotonic()
+
+    # Reload the graph when it expired, or pick up the endorsements created
+    # and deleted by other processes since the last sync. One thread does it
+    # at a time: the others wait for the first load, and otherwise go on with
+    # the current graph. Expired graphs are reloaded in the background, while
+    # requests keep using the current one.
+    def sync(self):
+        if not self._due(time.monotonic()):
+            return
+        if not self._sync_lock.acquire(blocking=self.loaded_at is None):
+            return
+        reloading = False
+        try:
+            now = time.monotonic()
+            if self.loaded_at is None:
+                self.load()
+            elif now - self.loaded_at >= TRUST_GRAPH_RELOAD_INTERVAL:
+                # The reload thread releases the lock when done
+                self.reloader = threading.Thread(target=self._reload,
+                    args=(current_app._get_current_object(),), daemon=True)
+                self.reloader.start()
+                reloading = True
+            elif now - self.synced_at >= TRUST_GRAPH_SYNC_INTERVAL:
+                self._apply_changes()
+                self.synced_at = now
+        finally:
+            if not reloading:
+                self._sync_lock.release()
+
+    # Changes written meanwhile are picked up by the next sync, going by the
+    # ids read in the same statement as the snapshot of the reload
+    def _reload(self, app):
+        try:
+            with app.app_context():
+                self.load()
+        finally:
+            self._sync_lock.release()
+
+    def _due(self, now):
+        return self.loaded_at is None or now - self.loaded_at >= TRUST_GRAPH_RELOAD_INTERVAL \
+            or now - self.synced_at >= TRUST_GRAPH_SYNC_INTERVAL
+
+    # Deletions first, as endorsements recreated since then are newer
+    def _apply_changes(self):
+        deletions = db.session.query(EndorsementDeletion.id, EndorsementDeletion.endorsement_id,
+                EndorsementDeletion.giver_id, EndorsementDeletion.receiver_id,
+                EndorsementDeletion.skill_id)\
+            .filter(EndorsementDeletion.id > self.max_deletion_id)\
+            .order_by(EndorsementDeletion.id)\
+            .limit(TRUST_GRAPH_BATCH_SIZE + 1)\
+            .all()
+        # Many deletions, e.g. of all endorsements, are cheaper to reload
+        if len(deletions) > TRUST_GRAPH_BATCH_SIZE:
+            self.load()
+            return
+        for deletion_id, endorsement_id, giver_id, receiver_id, skill_id in deletions:
+            self.remove_edge(giver_id, receiver_id, skill_id, endorsement_id)
+            self.max_deletion_id = deletion_id
+
+        # New endorsements, and those of the trailing window committed late
+        new_edges = db.session.query(Endorsement.id, Endorsement.giver_id,
+                Endorsement.receiver_id, Endorsement.skill_id)\
+            .filter(Endorsement.id > self.max_synced_id - TRUST_GRAPH_LATE_IDS)\
+            .order_by(Endorsement.id)
+        for endorsement_id, giver_id, receiver_id, skill_id in new_edges:
+            self.add_edge(endorsement_id, giver_id, receiver_id, skill_id)
+            self.max_synced_id = max(self.max_synced_id, endorsement_id)
+
+    # Whether the edge of an endorsement is already in the arrays or overlay
+    def _has_edge(self, endorsement_id):
+        if endorsement_id in self._added_ids:
+            return True
+        if endorsement_id > self.max_endorsement_id:
+            return False
+        return endorsement_id <= self.max_endorsement_id - TRUST_GRAPH_LATE_IDS or \
+            endorsement_id in self._late_ids
+
+    def add_edge(self, endorsement_id, giver_id, receiver_id, skill_id):
+        with self._lock:
+            if self._has_edge(endorsement_id):
+                return
+            self._added_ids.add(endorsement_id)
+            self._added_edges[(giver_id, receiver_id, skill_id)] = endorsement_id
+            self._removed.discard((giver_id, receiver_id, skill_id))
+            self._added_outgoing.setdefault(giver_id, []).append((receiver_id, skill_id))
+            self._added_incoming.setdefault(receiver_id, []).append((giver_id, skill_id))
+
+    # Remove an edge. When replaying the deletion log, the id of the deleted
+    # endorsement is given, and a newer endorsement of the same users and
+    # skill, created since, is kept.
+    def remove_edge(self, giver_id, receiver_id, skill_id, endorsement_id=None):
+        edge = (giver_id, receiver_id, skill_id)
+        with self._lock:
+            if endorsement_id is not None and self._added_edges.get(edge, 0) > endorsement_id:
+                return
+            self._removed.add(edge)
+
+    # Force a full reload on next use, after deleting all users or endorsements
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self.loaded_at = None
+
+    # Users adjacent to a node in one direction, optionally for one skill
+    def _neighbours(self, node, forward, skill_id):
+        adjacency = self._outgoing if forward else self._incoming
+        added = self._added_outgoing if forward else self._added_incoming
+        removed = self._removed
+
+        targets, skills = adjacency.neighbours(node)
+        for target, skill in zip(targets, skills):
+            if skill_id is not None and skill != skill_id:
+                continue
+            if removed:
+                edge = (node, target, skill) if forward else (target, node, skill)
+                if edge in removed:
+                    continue
+            yield target
+
+        for target, skill in added.get(node, ()):
+            if skill_id is not None and skill != skill_id:
+                continue
+            edge = (node, target, skill) if forward else (target, node, skill)
+            if edge not in removed:
+                yield target
+
+    # Expand a BFS frontier by one level. Returns the next frontier and a
+    # node reached by both searches, if any.
+    def _expand(self, frontier, parents, other_parents, forward, skill_id):
+        next_frontier = []
+        for node in frontier:
+            for neighbour in self._neighbours(node, forward, skill_id):
+                if neighbour in parents:
+                    continue
+                parents[neighbour] = node
+                if neighbour in other_parents:
+                    return next_frontier, neighbour
+                next_frontier.append(neighbour)
+        return next_frontier, None
+
+    # Shortest chain of endorsements from source to target, as a list of user
+    # ids, using a bidirectional BFS that always expands the smaller frontier.
+    # Returns None if there is no chain of at most max_depth endorsements.
+    def shortest_path(self, source, target, skill_id=None, max_depth=6):
+        if source == target:
+            return [source]
+
+        forward_parents = {source: None}
+        backward_parents = {target: None}
+        forward_frontier = [source]
+        backward_frontier = [target]
+        meeting = None
+        depth = 0
+
+        while forward_frontier and backward_frontier and depth < max_depth:
+            depth += 1
+            if len(forward_frontier) <= len(backward_frontier):
+                forward_frontier, meeting = self._expand(forward_frontier,
+                    forward_parents, backward_parents, True, skill_id)
+            else:
+                backward_frontier, meeting = self._expand(backward_frontier,
+                    backward_parents, forward_parents, False, skill_id)
+            if meeting is not None:
+                break
+
+        if meeting is None:
+            return None
+
+        path = []
+        node = meeting
+        while node is not None:
+            path.append(node)
+            node = forward_parents[node]
+        path.reverse()
+        node = backward_parents[meeting]
+        while node is not None:
+            path.append(node)
+            node = backward_parents[node]
+        return path
+
+
+trust_graph = TrustGraph()
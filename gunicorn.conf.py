@@ -0,0 +1,17 @@
+# Gunicorn settings, read from the working directory: gunicorn 'app:create_app()'
+
+# Create the app once and fork the workers from it
+preload_app = True
+
+# Runs in the master once the app is created, before the workers are forked
+def when_ready(server):
+    from app import preload
+    preload(server.app.wsgi())
+
+# The memory response cache is per process, and writes only invalidate it
+# in the worker handling them, so other workers would serve stale responses
+def on_starting(server):
+    from response_cache import RESPONSE_CACHE_BACKEND
+    if RESPONSE_CACHE_BACKEND == 'memory' and server.cfg.workers > 1:
+        raise RuntimeError('RESPONSE_CACHE_BACKEND=memory needs a single worker, '
+            'use redis to share the cache between workers')
@@ -0,0 +1,148 @@
+# Bulk import of profiles, skills and endorsements using PostgreSQL COPY
+
+import csv
+import io
+import json
+import time
+
+# Columns accepted in each import file. The id of profiles and skills is the
+# identifier used by the endorsements file to reference them, and is
+# replaced by a new database id on import.
+PROFILE_COLUMNS = ['id', 'first_name', 'last_name', 'location', 'description', 'contact']
+SKILL_COLUMNS = ['id', 'name', 'description']
+ENDORSEMENT_COLUMNS = ['giver_id', 'receiver_id', 'skill_id', 'creation_date']
+
+# Staging tables, dropped at the end of the import transaction. New ids are
+# taken from the target table sequence while rows are copied in.
+STAGING_TABLES = """
+CREATE TEMP TABLE import_profile (
+    id text, first_name text, last_name text, location text, description text,
+    contact integer,
+    new_id integer DEFAULT nextval(pg_get_serial_sequence('profile', 'id'))
+) ON COMMIT DROP;
+CREATE TEMP TABLE import_skill (
+    id text, name text, description text,
+    new_id integer DEFAULT nextval(pg_get_serial_sequence('skill', 'id'))
+) ON COMMIT DROP;
+CREATE TEMP TABLE import_endorsement (
+    giver_id text, receiver_id text, skill_id text, creation_date timestamp
+) ON COMMIT DROP;
+"""
+
+'''
+NDJSONReader
+File-like object converting an NDJSON file into CSV rows on the fly, so it
+can be streamed to COPY one chunk at a time.
+'''
+class NDJSONReader:
+    def __init__(self, file, columns):
+        self.file = file
+        self.columns = columns
+        self._buffer = ''
+
+    def _next_row(self):
+        for line in self.file:
+            if line.strip():
+                item = json.loads(line)
+                output = io.StringIO()
+                csv.writer(output).writerow([item.get(column) for column in self.columns])
+                return output.getvalue()
+        return None
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            row = self._next_row()
+            if row is None:
+                break
+            self._buffer += row
+
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+# Stream a CSV (with header) or NDJSON file into a staging table.
+# Returns the number of rows copied.
+def copy_file(cursor, table, columns, path):
+    with open(path, newline='') as file:
+        if path.endswith('.csv'):
+            header = next(csv.reader([file.readline()]))
+            unknown = [column for column in header if column not in columns]
+            if unknown:
+                raise ValueError(f'{path}: unknown columns {", ".join(unknown)}')
+            source, columns = file, header
+        else:
+            source = NDJSONReader(file, columns)
+
+        cursor.copy_expert(
+            f'COPY {table} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)', source)
+        return cursor.rowcount
+
+def report(name, rows, seconds):
+    rate = rows / seconds if seconds > 0 else 0
+    print(f'{name:<14} {rows:>10} rows in {seconds:7.2f}s  ({rate:,.0f} rows/s)')
+
+# Import the given files in a single transaction. Endorsements reference
+# users and skills by the ids used in the profiles and skills files when
+# those are imported in the same run, or by database ids otherwise.
+# Endorsements with unknown references or already existing are skipped.
+def import_files(connection, profiles=None, skills=None, endorsements=None):
+    cursor = connection.cursor()
+    cursor.execute(STAGING_TABLES)
+    started = time.perf_counter()
+    total = 0
+
+    try:
+        for path, model, columns, fields in (
+                (profiles, 'profile', PROFILE_COLUMNS, 'first_name, last_name, location, description, contact'),
+                (skills, 'skill', SKILL_COLUMNS, 'name, description')):
+            if not path:
+                continue
+            start = time.perf_counter()
+            copied = copy_file(cursor, f'import_{model}', columns, path)
+            cursor.execute(f'INSERT INTO {model} (id, {fields}) SELECT new_id, {fields} FROM import_{model}')
+            cursor.execute(f'CREATE INDEX ON import_{model} (id); ANALYZE import_{model}')
+            report(model, copied, time.perf_counter() - start)
+            total += copied
+
+        if endorsements:
+            start = time.perf_counter()
+            copied = copy_file(cursor, 'import_endorsement', ENDORSEMENT_COLUMNS, endorsements)
+            cursor.execute('ANALYZE import_endorsement')
+
+            if profiles:
+                giver = 'JOIN import_profile g ON g.id = e.giver_id'
+                receiver = 'JOIN import_profile r ON r.id = e.receiver_id'
+                giver_id, receiver_id = 'g.new_id', 'r.new_id'
+            else:
+                giver = 'JOIN profile g ON g.id = e.giver_id::integer'
+                receiver = 'JOIN profile r ON r.id = e.receiver_id::integer'
+                giver_id, receiver_id = 'g.id', 'r.id'
+            if skills:
+                skill, skill_id = 'JOIN import_skill s ON s.id = e.skill_id', 's.new_id'
+            else:
+                skill, skill_id = 'JOIN skill s ON s.id = e.skill_id::integer', 's.id'
+
+            # Rows are sorted to insert into the unique index in key order
+            cursor.execute(f'''
+                INSERT INTO endorsement (giver_id, receiver_id, skill_id, creation_date)
+                SELECT {giver_id}, {receiver_id}, {skill_id}, COALESCE(e.creation_date, CURRENT_DATE)
+                FROM import_endorsement e {giver} {receiver} {skill}
+                ORDER BY 1, 2, 3
+                ON CONFLICT DO NOTHING''')
+            inserted = cursor.rowcount
+            report('endorsement', inserted, time.perf_counter() - start)
+            if copied != inserted:
+                print(f'{copied - inserted} endorsements skipped (unknown user or skill, or duplicated)')
+            total += inserted
+
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    report('total', total, time.perf_counter() - started)
+    return total
@@ -1,14 +1,58 @@
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
-from app import app
+from app import create_app
 from models import db
+from importer import import_files
+from trust import compute_trust_scores, DAMPING, TOLERANCE, MAX_ITERATIONS
 
-migrate = Migrate(app, db)
-manager = Manager(app)
+migrate = Migrate(db=db)
+
+# The app is only created when a command runs, with the migrations
+# available to the db command
+def create_manage_app():
+    app = create_app()
+    migrate.init_app(app, db)
+    return app
+
+manager = Manager(create_manage_app)
 
 manager.add_command('db', MigrateCommand)
 
 
+# Bulk load profiles, skills and endorsements from CSV or NDJSON files
+@manager.option('-p', '--profiles', dest='profiles', default=None, help='Profiles CSV or NDJSON file')
+@manager.option('-s', '--skills', dest='skills', default=None, help='Skills CSV or NDJSON file')
+@manager.option('-e', '--endorsements', dest='endorsements', default=None, help='Endorsements CSV or NDJSON file')
+def import_data(profiles=None, skills=None, endorsements=None):
+    if db.engine.dialect.name != 'postgresql':
+        raise SystemExit('import_data requires a PostgreSQL database')
+
+    connection = db.engine.raw_connection()
+    try:
+        import_files(connection, profiles, skills, endorsements)
+    finally:
+        connection.close()
+
+
+# Compute the trust score of every user, and of every user for each skill,
+# from the endorsement graph. Meant to run periodically, e.g. nightly.
+@manager.option('--cold', dest='cold', action='store_true', default=False,
+    help='Start from uniform scores instead of the previous ones')
+@manager.option('-d', '--damping', dest='damping', type=float, default=DAMPING,
+    help='Probability of following an endorsement')
+@manager.option('-t', '--tolerance', dest='tolerance', type=float, default=TOLERANCE,
+    help='Stop once scores change less than this')
+@manager.option('-i', '--max-iterations', dest='max_iterations', type=int, default=MAX_ITERATIONS,
+    help='Maximum number of iterations')
+def trust_scores(cold=False, damping=DAMPING, tolerance=TOLERANCE, max_iterations=MAX_ITERATIONS):
+    connection = db.engine.raw_connection()
+    try:
+        compute_trust_scores(connection, db.engine.dialect.name == 'postgresql',
+            not cold, damping, tolerance, max_iterations)
+    finally:
+        connection.close()
+
+
 if __name__ == '__main__':
-    manager.run()
\ No newline at end of file
+    manager.run()
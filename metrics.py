@@ -0,0 +1,240 @@
+# Per-request performance metrics: wall time, SQL statements, database,
+# auth and serialization time. Sent as a Server-Timing header on every
+# response, and aggregated per route into Prometheus histograms.
+
+import bisect
+import logging
+import threading
+import time
+from functools import wraps
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds of the histogram buckets, in seconds and in statements
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# Timings sent in the Server-Timing header, with their descriptions
+TIMINGS = (
+    ('db', 'Database'),
+    ('auth', 'Token verification'),
+    ('serialize', 'JSON serialization')
+)
+
+# Statements listed in the error of a request over its budget, beyond the
+# budget itself, or in all for routes whose budget is only known at the end
+LISTED_STATEMENTS_MARGIN = 5
+MAX_LISTED_STATEMENTS = 50
+
+logger = logging.getLogger(__name__)
+
+
+# Add time spent on something (db, auth, serialize) to the current request
+def add_timing(name, seconds):
+    if has_request_context():
+        timings = g.setdefault('timings', {})
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+# Time every SQL statement run on any engine, primary or replica
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._metrics_start = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_statement(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, '_metrics_start', None)
+    if start is not None and has_request_context():
+        add_timing('db', time.perf_counter() - start)
+        g.sql_count = g.get('sql_count', 0) + 1
+        statements = g.setdefault('sql_statements', [])
+        if len(statements) < statements_to_list():
+            statements.append(statement)
+
+# Number of statements of the current request to keep the text of. Only the
+# strict budget check lists them, so other requests keep none.
+def statements_to_list():
+    budget = g.get('query_budget')
+    if budget is None or not current_app.config.get('QUERY_BUDGET_STRICT'):
+        return 0
+    return MAX_LISTED_STATEMENTS if callable(budget) else budget + LISTED_STATEMENTS_MARGIN
+
+
+'''
+QueryBudgetExceeded
+Raised when a request runs more SQL statements than the budget of its
+route, listing the first statements it ran, when they were kept.
+'''
+class QueryBudgetExceeded(Exception):
+    def __init__(self, route, budget, count, statements=()):
+        self.route = route
+        self.budget = budget
+        self.count = count
+        self.statements = statements
+        message = f'{route} ran {count} SQL statements, over its budget of {budget}'
+        if statements:
+            message += ':\n' + '\n'.join(f'{i}. {s}' for i, s in enumerate(statements, 1))
+            if count > len(statements):
+                message += f'\n... and {count - len(statements)} more'
+        super().__init__(message)
+
+# Declare the maximum number of SQL statements a route may run, to be placed
+# right under app.route. max_statements can also be a function called after
+# the request, e.g. for routes whose work grows with the size of the request.
+# Requests over budget are logged and counted, and fail when the
+# QUERY_BUDGET_STRICT setting of the app is on (as in the tests).
+def query_budget(max_statements):
+    def query_budget_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            g.query_budget = max_statements
+            return f(*args, **kwargs)
+        wrapper.query_budget = max_statements
+        return wrapper
+    return query_budget_decorator
+
+
+# Wrap a JSON encoder class so that the time spent encoding is recorded
+def timed_encoder(encoder):
+    class TimedJSONEncoder(encoder):
+        def encode(self, o):
+            start = time.perf_counter()
+            try:
+                return super().encode(o)
+            finally:
+                add_timing('serialize', time.perf_counter() - start)
+    return TimedJSONEncoder
+
+
+'''
+Histogram
+Cumulative Prometheus histogram, with one series per combination of labels.
+'''
+class Histogram:
+    def __init__(self, name, description, label_names, buckets):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+
+    # Not thread safe, callers hold the lock of RequestMetrics
+    def observe(self, labels, value):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def lines(self):
+        yield f'# HELP {self.name} {self.description}'
+        yield f'# TYPE {self.name} histogram'
+        for labels, (counts, total) in sorted(self._series.items()):
+            labels = list(zip(self.label_names, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield f'{self.name}_bucket{format_labels(labels + [("le", bound)])} {cumulative}'
+            yield f'{self.name}_sum{format_labels(labels)} {total}'
+            yield f'{self.name}_count{format_labels(labels)} {cumulative}'
+
+
+def format_labels(labels):
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+# Lines of a counter or gauge, from (labels, value) samples
+def metric_lines(name, kind, description, samples):
+    yield f'# HELP {name} {description}'
+    yield f'# TYPE {name} {kind}'
+    for labels, value in samples:
+        yield f'{name}{format_labels(sorted(labels.items()))} {value}'
+
+
+'''
+RequestMetrics
+Histograms of the timings of the requests served by this process, per route.
+'''
+class RequestMetrics:
+    def __init__(self):
+        self.duration = Histogram('endorsa_request_duration_seconds',
+            'Wall time of requests', ('method', 'route', 'status'), DURATION_BUCKETS)
+        self.db = Histogram('endorsa_request_db_seconds',
+            'Time spent running SQL statements per request', ('method', 'route'), DURATION_BUCKETS)
+        self.auth = Histogram('endorsa_request_auth_seconds',
+            'Time spent verifying the access token per request', ('method', 'route'), DURATION_BUCKETS)
+        self.serialize = Histogram('endorsa_request_serialize_seconds',
+            'Time spent serializing JSON per request', ('method', 'route'), DURATION_BUCKETS)
+        self.queries = Histogram('endorsa_request_sql_statements',
+            'SQL statements run per request', ('method', 'route'), QUERY_BUCKETS)
+        self.over_budget = {}
+        self._lock = threading.Lock()
+
+    # Called before the request is handled
+    def start(self):
+        g.request_start = time.perf_counter()
+        g.timings = {}
+        g.sql_count = 0
+        g.sql_statements = []
+
+    # Called once the response is ready: adds the Server-Timing header and
+    # records the request. Streamed bodies are sent later and not included.
+    def finish(self, response):
+        # Popped so that the error response of a failed check is not
+        # recorded again
+        start = g.pop('request_start', None)
+        if start is None:
+            return response
+        total = time.perf_counter() - start
+        timings = g.get('timings', {})
+        sql_count = g.get('sql_count', 0)
+
+        entries = []
+        for name, description in TIMINGS:
+            if name == 'db':
+                description = f'SQL statements: {sql_count}'
+            entries.append(f'{name};dur={1000 * timings.get(name, 0.0):.2f};desc="{description}"')
+        entries.append(f'total;dur={1000 * total:.2f}')
+        response.headers.add('Server-Timing', ', '.join(entries))
+
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        labels = (request.method, route)
+        with self._lock:
+            self.duration.observe(labels + (str(response.status_code),), total)
+            self.db.observe(labels, timings.get('db', 0.0))
+            self.auth.observe(labels, timings.get('auth', 0.0))
+            self.serialize.observe(labels, timings.get('serialize', 0.0))
+            self.queries.observe(labels, sql_count)
+
+        budget = g.get('query_budget')
+        if callable(budget):
+            budget = budget()
+        if budget is not None and sql_count > budget:
+            self.check_budget(labels, budget, sql_count, g.get('sql_statements', []))
+        return response
+
+    def check_budget(self, labels, budget, count, statements):
+        with self._lock:
+            self.over_budget[labels] = self.over_budget.get(labels, 0) + 1
+        error = QueryBudgetExceeded(' '.join(labels), budget, count, statements)
+        if current_app.config.get('QUERY_BUDGET_STRICT'):
+            raise error
+        logger.warning('%s', error)
+
+    def lines(self):
+        with self._lock:
+            lines = [line for histogram in (self.duration, self.db, self.auth, self.serialize,
+                self.queries) for line in histogram.lines()]
+            lines += metric_lines('endorsa_query_budget_exceeded_total', 'counter',
+                'Requests that ran more SQL statements than the budget of their route',
+                [({'method': method, 'route': route}, count)
+                    for (method, route), count in sorted(self.over_budget.items())])
+            return lines
+
+
+request_metrics = RequestMetrics()
@@ -0,0 +1,54 @@
+"""row version triggers on listed columns
+
+Revision ID: 2d6f8b3e5a17
+Revises: 7e4b9d2c1a85
+Create Date: 2026-10-18 17:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '2d6f8b3e5a17'
+down_revision = '7e4b9d2c1a85'
+branch_labels = None
+depends_on = None
+
+
+# The version triggers compared OLD.* with NEW.*, which includes the
+# generated search_vector columns. PostgreSQL rejects BEFORE triggers whose
+# WHEN condition references generated columns, so such a schema can't be
+# restored from a dump. They now list the columns compared instead.
+VERSION_TRIGGERS = """
+DROP TRIGGER IF EXISTS profile_version ON profile;
+DROP TRIGGER IF EXISTS skill_version ON skill;
+
+CREATE TRIGGER profile_version BEFORE UPDATE ON profile
+FOR EACH ROW WHEN ((OLD.first_name, OLD.last_name, OLD.location, OLD.description, OLD.contact, OLD.num_endorsements_received, OLD.trust_score, OLD.version, OLD.updated_at)
+  IS DISTINCT FROM (NEW.first_name, NEW.last_name, NEW.location, NEW.description, NEW.contact, NEW.num_endorsements_received, NEW.trust_score, NEW.version, NEW.updated_at))
+EXECUTE PROCEDURE row_version_update();
+
+CREATE TRIGGER skill_version BEFORE UPDATE ON skill
+FOR EACH ROW WHEN ((OLD.name, OLD.description, OLD.num_endorsements, OLD.version, OLD.updated_at)
+  IS DISTINCT FROM (NEW.name, NEW.description, NEW.num_endorsements, NEW.version, NEW.updated_at))
+EXECUTE PROCEDURE row_version_update();
+"""
+
+OLD_VERSION_TRIGGERS = """
+DROP TRIGGER profile_version ON profile;
+DROP TRIGGER skill_version ON skill;
+
+CREATE TRIGGER profile_version BEFORE UPDATE ON profile
+FOR EACH ROW WHEN (OLD.* IS DISTINCT FROM NEW.*) EXECUTE PROCEDURE row_version_update();
+
+CREATE TRIGGER skill_version BEFORE UPDATE ON skill
+FOR EACH ROW WHEN (OLD.* IS DISTINCT FROM NEW.*) EXECUTE PROCEDURE row_version_update();
+"""
+
+
+def upgrade():
+    op.execute(VERSION_TRIGGERS)
+
+
+def downgrade():
+    op.execute(OLD_VERSION_TRIGGERS)
@@ -0,0 +1,60 @@
+"""initial schema
+
+Revision ID: 3f1c2a9b7d10
+Revises: 
+Create Date: 2026-10-17 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9b7d10'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+# Tables were originally created with db.create_all(), so existing
+# databases already have them and only missing tables are created here.
+def upgrade():
+    existing_tables = sa.inspect(op.get_bind()).get_table_names()
+
+    if 'profile' not in existing_tables:
+        op.create_table('profile',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('first_name', sa.String(), nullable=False),
+            sa.Column('last_name', sa.String(), nullable=False),
+            sa.Column('location', sa.String(), nullable=True),
+            sa.Column('description', sa.String(), nullable=True),
+            sa.Column('contact', sa.Integer(), nullable=True),
+            sa.PrimaryKeyConstraint('id')
+        )
+
+    if 'skill' not in existing_tables:
+        op.create_table('skill',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('name', sa.String(), nullable=False),
+            sa.Column('description', sa.String(), nullable=True),
+            sa.PrimaryKeyConstraint('id')
+        )
+
+    if 'endorsement' not in existing_tables:
+        op.create_table('endorsement',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('giver_id', sa.Integer(), nullable=False),
+            sa.Column('receiver_id', sa.Integer(), nullable=False),
+            sa.Column('skill_id', sa.Integer(), nullable=False),
+            sa.Column('creation_date', sa.DateTime(), nullable=False),
+            sa.ForeignKeyConstraint(['giver_id'], ['profile.id'], ondelete='CASCADE'),
+            sa.ForeignKeyConstraint(['receiver_id'], ['profile.id'], ondelete='CASCADE'),
+            sa.ForeignKeyConstraint(['skill_id'], ['skill.id'], ondelete='CASCADE'),
+            sa.PrimaryKeyConstraint('id')
+        )
+
+
+def downgrade():
+    op.drop_table('endorsement')
+    op.drop_table('skill')
+    op.drop_table('profile')
@@ -0,0 +1,36 @@
+"""trust scores
+
+Revision ID: 4b7d2e9c1a63
+Revises: e2b85c1f9a47
+Create Date: 2026-10-17 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4b7d2e9c1a63'
+down_revision = 'e2b85c1f9a47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The columns may already exist if db.create_all() created the tables
+    # at application start before this migration
+    inspector = sa.inspect(op.get_bind())
+    if 'trust_score' not in [c['name'] for c in inspector.get_columns('profile')]:
+        op.add_column('profile', sa.Column('trust_score', sa.Float(),
+            nullable=False, server_default='0'))
+    if 'trust_score' not in [c['name'] for c in inspector.get_columns('skill_ranking')]:
+        op.add_column('skill_ranking', sa.Column('trust_score', sa.Float(),
+            nullable=False, server_default='0'))
+        op.create_index('ix_skill_ranking_trust', 'skill_ranking',
+            ['skill_id', 'trust_score', 'receiver_id'])
+
+
+def downgrade():
+    op.drop_index('ix_skill_ranking_trust', table_name='skill_ranking')
+    op.drop_column('skill_ranking', 'trust_score')
+    op.drop_column('profile', 'trust_score')
@@ -0,0 +1,31 @@
+"""skill ranking index by receiver
+
+Revision ID: 5c8e3a1f6d92
+Revises: a6f1d3b8c925
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c8e3a1f6d92'
+down_revision = 'a6f1d3b8c925'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    existing_indexes = [index['name'] for index in inspector.get_indexes('skill_ranking')]
+
+    # Skills of each user, for the endorsement summaries of batch gets and
+    # the cascade deletes of users
+    if 'ix_skill_ranking_receiver' not in existing_indexes:
+        op.create_index('ix_skill_ranking_receiver', 'skill_ranking',
+            ['receiver_id', 'num_endorsements', 'skill_id'])
+
+
+def downgrade():
+    op.drop_index('ix_skill_ranking_receiver', table_name='skill_ranking')
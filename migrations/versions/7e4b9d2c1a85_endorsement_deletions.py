@@ -0,0 +1,62 @@
+"""endorsement deletion log
+
+Revision ID: 7e4b9d2c1a85
+Revises: 5c8e3a1f6d92
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7e4b9d2c1a85'
+down_revision = '5c8e3a1f6d92'
+branch_labels = None
+depends_on = None
+
+
+# Statement-level trigger logging every delete of endorsements, including
+# cascade deletes, for the trust graph of the other processes, and pruning
+# entries older than a day
+DELETION_TRIGGER = """
+CREATE FUNCTION endorsement_deletion_log() RETURNS trigger AS $$
+BEGIN
+  DELETE FROM endorsement_deletion
+  WHERE deleted_at < timezone('utc', now()) - interval '1 day';
+  INSERT INTO endorsement_deletion (endorsement_id, giver_id, receiver_id, skill_id, deleted_at)
+  SELECT id, giver_id, receiver_id, skill_id, timezone('utc', now()) FROM old_rows ORDER BY id;
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER endorsement_deletion_log AFTER DELETE ON endorsement
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE endorsement_deletion_log();
+"""
+
+
+def upgrade():
+    # The table and its trigger may already exist if the tables were
+    # created by db.create_all(), as in the tests
+    if 'endorsement_deletion' in sa.inspect(op.get_bind()).get_table_names():
+        return
+
+    op.create_table('endorsement_deletion',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('endorsement_id', sa.Integer(), nullable=False),
+        sa.Column('giver_id', sa.Integer(), nullable=False),
+        sa.Column('receiver_id', sa.Integer(), nullable=False),
+        sa.Column('skill_id', sa.Integer(), nullable=False),
+        sa.Column('deleted_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_endorsement_deletion_deleted_at', 'endorsement_deletion', ['deleted_at'])
+    op.execute(DELETION_TRIGGER)
+
+
+def downgrade():
+    op.execute('DROP TRIGGER endorsement_deletion_log ON endorsement')
+    op.execute('DROP FUNCTION endorsement_deletion_log()')
+    op.drop_index('ix_endorsement_deletion_deleted_at', table_name='endorsement_deletion')
+    op.drop_table('endorsement_deletion')
@@ -0,0 +1,49 @@
+"""endorsement indexes and unique constraint
+
+Revision ID: 8a4d6e2c5b31
+Revises: 3f1c2a9b7d10
+Create Date: 2026-10-17 10:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4d6e2c5b31'
+down_revision = '3f1c2a9b7d10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    existing_indexes = [index['name'] for index in inspector.get_indexes('endorsement')]
+    existing_constraints = [constraint['name'] for constraint
+        in inspector.get_unique_constraints('endorsement')]
+
+    # Remove duplicate endorsements, keeping the oldest one
+    op.execute("""
+        DELETE FROM endorsement
+        WHERE id NOT IN (
+            SELECT MIN(id) FROM endorsement
+            GROUP BY giver_id, receiver_id, skill_id
+        )
+    """)
+
+    # Also used for lookups by giver_id, its leading column
+    if 'uq_endorsement_giver_receiver_skill' not in existing_constraints:
+        op.create_unique_constraint('uq_endorsement_giver_receiver_skill',
+            'endorsement', ['giver_id', 'receiver_id', 'skill_id'])
+
+    if 'ix_endorsement_receiver_id' not in existing_indexes:
+        op.create_index('ix_endorsement_receiver_id', 'endorsement', ['receiver_id'])
+
+    if 'ix_endorsement_skill_id' not in existing_indexes:
+        op.create_index('ix_endorsement_skill_id', 'endorsement', ['skill_id'])
+
+
+def downgrade():
+    op.drop_index('ix_endorsement_skill_id', table_name='endorsement')
+    op.drop_index('ix_endorsement_receiver_id', table_name='endorsement')
+    op.drop_constraint('uq_endorsement_giver_receiver_skill', 'endorsement', type_='unique')
@@ -0,0 +1,140 @@
+"""row versions
+
+Revision ID: 9d3a5f7e2b14
+Revises: 4b7d2e9c1a63
+Create Date: 2026-10-17 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d3a5f7e2b14'
+down_revision = '4b7d2e9c1a63'
+branch_labels = None
+depends_on = None
+
+
+# Triggers bumping the version of profiles and skills whenever their detail
+# changes, including through endorsements and name changes of related rows
+VERSION_TRIGGERS = """
+CREATE FUNCTION row_version_insert() RETURNS trigger AS $$
+BEGIN
+  NEW.updated_at := timezone('utc', now());
+  RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION row_version_update() RETURNS trigger AS $$
+BEGIN
+  NEW.version := OLD.version + 1;
+  NEW.updated_at := timezone('utc', now());
+  RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION endorsement_versions_insert() RETURNS trigger AS $$
+BEGIN
+  UPDATE profile SET version = version + 1
+  WHERE id IN (SELECT giver_id FROM new_rows);
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION endorsement_versions_delete() RETURNS trigger AS $$
+BEGIN
+  UPDATE profile SET version = version + 1
+  WHERE id IN (SELECT giver_id FROM old_rows);
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION profile_name_versions() RETURNS trigger AS $$
+BEGIN
+  UPDATE profile SET version = version + 1 WHERE id IN (
+    SELECT receiver_id FROM endorsement WHERE giver_id = NEW.id
+    UNION SELECT giver_id FROM endorsement WHERE receiver_id = NEW.id);
+  UPDATE skill SET version = version + 1 WHERE id IN (
+    SELECT skill_id FROM endorsement WHERE giver_id = NEW.id
+    UNION SELECT skill_id FROM endorsement WHERE receiver_id = NEW.id);
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION skill_name_versions() RETURNS trigger AS $$
+BEGIN
+  UPDATE profile SET version = version + 1 WHERE id IN (
+    SELECT giver_id FROM endorsement WHERE skill_id = NEW.id
+    UNION SELECT receiver_id FROM endorsement WHERE skill_id = NEW.id);
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER profile_created BEFORE INSERT ON profile
+FOR EACH ROW EXECUTE PROCEDURE row_version_insert();
+
+CREATE TRIGGER profile_version BEFORE UPDATE ON profile
+FOR EACH ROW WHEN (OLD.* IS DISTINCT FROM NEW.*) EXECUTE PROCEDURE row_version_update();
+
+CREATE TRIGGER skill_created BEFORE INSERT ON skill
+FOR EACH ROW EXECUTE PROCEDURE row_version_insert();
+
+CREATE TRIGGER skill_version BEFORE UPDATE ON skill
+FOR EACH ROW WHEN (OLD.* IS DISTINCT FROM NEW.*) EXECUTE PROCEDURE row_version_update();
+
+CREATE TRIGGER endorsement_versions_insert AFTER INSERT ON endorsement
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE endorsement_versions_insert();
+
+CREATE TRIGGER endorsement_versions_delete AFTER DELETE ON endorsement
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE endorsement_versions_delete();
+
+CREATE TRIGGER profile_name_versions AFTER UPDATE OF first_name, last_name ON profile
+FOR EACH ROW WHEN (OLD.first_name IS DISTINCT FROM NEW.first_name
+  OR OLD.last_name IS DISTINCT FROM NEW.last_name)
+EXECUTE PROCEDURE profile_name_versions();
+
+CREATE TRIGGER skill_name_versions AFTER UPDATE OF name ON skill
+FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name)
+EXECUTE PROCEDURE skill_name_versions();
+"""
+
+
+def upgrade():
+    # The columns and triggers may already exist if db.create_all() created
+    # the tables at application start before this migration
+    inspector = sa.inspect(op.get_bind())
+    if 'version' in [c['name'] for c in inspector.get_columns('profile')]:
+        return
+
+    for table in ('profile', 'skill'):
+        op.add_column(table, sa.Column('version', sa.Integer(),
+            nullable=False, server_default='1'))
+        op.add_column(table, sa.Column('updated_at', sa.DateTime(),
+            nullable=False, server_default=sa.text("timezone('utc', now())")))
+        op.alter_column(table, 'updated_at', server_default=None)
+
+    op.execute(VERSION_TRIGGERS)
+
+
+def downgrade():
+    for trigger, table in (
+            ('skill_name_versions', 'skill'),
+            ('profile_name_versions', 'profile'),
+            ('endorsement_versions_delete', 'endorsement'),
+            ('endorsement_versions_insert', 'endorsement'),
+            ('skill_version', 'skill'),
+            ('skill_created', 'skill'),
+            ('profile_version', 'profile'),
+            ('profile_created', 'profile')):
+        op.execute(f'DROP TRIGGER {trigger} ON {table}')
+    for function in ('skill_name_versions', 'profile_name_versions',
+            'endorsement_versions_delete', 'endorsement_versions_insert',
+            'row_version_update', 'row_version_insert'):
+        op.execute(f'DROP FUNCTION {function}()')
+
+    for table in ('skill', 'profile'):
+        op.drop_column(table, 'updated_at')
+        op.drop_column(table, 'version')
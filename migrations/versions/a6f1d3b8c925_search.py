@@ -0,0 +1,58 @@
+"""search
+
+Revision ID: a6f1d3b8c925
+Revises: 9d3a5f7e2b14
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6f1d3b8c925'
+down_revision = '9d3a5f7e2b14'
+branch_labels = None
+depends_on = None
+
+
+# Generated tsvector columns with GIN indexes for full-text search, and
+# trigram indexes on names for misspelt queries. Needs PostgreSQL 12 or
+# later, and the pg_trgm extension (part of the standard contrib modules).
+SEARCH = """
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+ALTER TABLE profile ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (
+  setweight(to_tsvector('english', first_name || ' ' || last_name), 'A') ||
+  setweight(to_tsvector('english', coalesce(location, '')), 'B') ||
+  setweight(to_tsvector('english', coalesce(description, '')), 'C')
+) STORED;
+CREATE INDEX ix_profile_search_vector ON profile USING gin (search_vector);
+CREATE INDEX ix_profile_name_trgm ON profile USING gin ((first_name || ' ' || last_name) gin_trgm_ops);
+
+ALTER TABLE skill ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (
+  setweight(to_tsvector('english', name), 'A') ||
+  setweight(to_tsvector('english', coalesce(description, '')), 'C')
+) STORED;
+CREATE INDEX ix_skill_search_vector ON skill USING gin (search_vector);
+CREATE INDEX ix_skill_name_trgm ON skill USING gin (name gin_trgm_ops);
+"""
+
+
+def upgrade():
+    # The columns may already exist if the tables were created by
+    # db.create_all(), as in the tests
+    inspector = sa.inspect(op.get_bind())
+    if 'search_vector' in [c['name'] for c in inspector.get_columns('profile')]:
+        return
+
+    op.execute(SEARCH)
+
+
+def downgrade():
+    op.drop_index('ix_skill_name_trgm', table_name='skill')
+    op.drop_index('ix_skill_search_vector', table_name='skill')
+    op.drop_column('skill', 'search_vector')
+    op.drop_index('ix_profile_name_trgm', table_name='profile')
+    op.drop_index('ix_profile_search_vector', table_name='profile')
+    op.drop_column('profile', 'search_vector')
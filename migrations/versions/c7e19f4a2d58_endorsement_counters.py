@@ -0,0 +1,92 @@
+"""endorsement counters on profile and skill
+
+Revision ID: c7e19f4a2d58
+Revises: 8a4d6e2c5b31
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7e19f4a2d58'
+down_revision = '8a4d6e2c5b31'
+branch_labels = None
+depends_on = None
+
+
+# Statement-level triggers keeping the counters up to date on any insert or
+# delete of endorsements, including cascade deletes
+COUNTER_TRIGGERS = """
+CREATE FUNCTION endorsement_counters_insert() RETURNS trigger AS $$
+BEGIN
+  UPDATE profile p SET num_endorsements_received = p.num_endorsements_received + c.count
+  FROM (SELECT receiver_id, count(*) AS count FROM new_rows GROUP BY receiver_id) c
+  WHERE p.id = c.receiver_id;
+  UPDATE skill s SET num_endorsements = s.num_endorsements + c.count
+  FROM (SELECT skill_id, count(*) AS count FROM new_rows GROUP BY skill_id) c
+  WHERE s.id = c.skill_id;
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION endorsement_counters_delete() RETURNS trigger AS $$
+BEGIN
+  UPDATE profile p SET num_endorsements_received = p.num_endorsements_received - c.count
+  FROM (SELECT receiver_id, count(*) AS count FROM old_rows GROUP BY receiver_id) c
+  WHERE p.id = c.receiver_id;
+  UPDATE skill s SET num_endorsements = s.num_endorsements - c.count
+  FROM (SELECT skill_id, count(*) AS count FROM old_rows GROUP BY skill_id) c
+  WHERE s.id = c.skill_id;
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER endorsement_counters_insert AFTER INSERT ON endorsement
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE endorsement_counters_insert();
+
+CREATE TRIGGER endorsement_counters_delete AFTER DELETE ON endorsement
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE endorsement_counters_delete();
+"""
+
+
+def upgrade():
+    # The columns and triggers may already exist if db.create_all() ran at
+    # application start before this migration
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if 'num_endorsements_received' not in [c['name'] for c in inspector.get_columns('profile')]:
+        op.add_column('profile', sa.Column('num_endorsements_received', sa.Integer(),
+            nullable=False, server_default='0'))
+    if 'num_endorsements' not in [c['name'] for c in inspector.get_columns('skill')]:
+        op.add_column('skill', sa.Column('num_endorsements', sa.Integer(),
+            nullable=False, server_default='0'))
+
+    # Count existing endorsements
+    op.execute("""
+        UPDATE profile p SET num_endorsements_received = c.count
+        FROM (SELECT receiver_id, count(*) AS count FROM endorsement GROUP BY receiver_id) c
+        WHERE p.id = c.receiver_id
+    """)
+    op.execute("""
+        UPDATE skill s SET num_endorsements = c.count
+        FROM (SELECT skill_id, count(*) AS count FROM endorsement GROUP BY skill_id) c
+        WHERE s.id = c.skill_id
+    """)
+
+    existing_triggers = [row[0] for row in bind.execute(sa.text(
+        "SELECT tgname FROM pg_trigger WHERE tgrelid = 'endorsement'::regclass"))]
+    if 'endorsement_counters_insert' not in existing_triggers:
+        op.execute(COUNTER_TRIGGERS)
+
+
+def downgrade():
+    op.execute('DROP TRIGGER endorsement_counters_delete ON endorsement')
+    op.execute('DROP TRIGGER endorsement_counters_insert ON endorsement')
+    op.execute('DROP FUNCTION endorsement_counters_delete()')
+    op.execute('DROP FUNCTION endorsement_counters_insert()')
+    op.drop_column('skill', 'num_endorsements')
+    op.drop_column('profile', 'num_endorsements_received')
@@ -0,0 +1,98 @@
+"""skill ranking
+
+Revision ID: e2b85c1f9a47
+Revises: c7e19f4a2d58
+Create Date: 2026-10-17 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2b85c1f9a47'
+down_revision = 'c7e19f4a2d58'
+branch_labels = None
+depends_on = None
+
+
+# Statement-level triggers keeping the ranking up to date on any insert or
+# delete of endorsements, including cascade deletes
+RANKING_TRIGGERS = """
+CREATE FUNCTION skill_ranking_insert() RETURNS trigger AS $$
+BEGIN
+  INSERT INTO skill_ranking (skill_id, receiver_id, num_endorsements, last_endorsed)
+  SELECT skill_id, receiver_id, count(*), max(creation_date)
+  FROM new_rows GROUP BY skill_id, receiver_id
+  ON CONFLICT (skill_id, receiver_id) DO UPDATE SET
+    num_endorsements = skill_ranking.num_endorsements + EXCLUDED.num_endorsements,
+    last_endorsed = GREATEST(skill_ranking.last_endorsed, EXCLUDED.last_endorsed);
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION skill_ranking_delete() RETURNS trigger AS $$
+BEGIN
+  UPDATE skill_ranking r SET
+    num_endorsements = r.num_endorsements - c.count,
+    last_endorsed = COALESCE((SELECT max(e.creation_date) FROM endorsement e
+      WHERE e.receiver_id = r.receiver_id AND e.skill_id = r.skill_id), r.last_endorsed)
+  FROM (SELECT skill_id, receiver_id, count(*) AS count FROM old_rows
+    GROUP BY skill_id, receiver_id) c
+  WHERE r.skill_id = c.skill_id AND r.receiver_id = c.receiver_id;
+
+  DELETE FROM skill_ranking r
+  USING (SELECT DISTINCT skill_id, receiver_id FROM old_rows) c
+  WHERE r.skill_id = c.skill_id AND r.receiver_id = c.receiver_id
+    AND r.num_endorsements <= 0;
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER skill_ranking_insert AFTER INSERT ON endorsement
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE skill_ranking_insert();
+
+CREATE TRIGGER skill_ranking_delete AFTER DELETE ON endorsement
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE skill_ranking_delete();
+"""
+
+
+def upgrade():
+    # The table and its triggers may already exist if db.create_all() ran
+    # at application start before this migration
+    if 'skill_ranking' not in sa.inspect(op.get_bind()).get_table_names():
+        create_skill_ranking()
+
+    # Rank existing endorsements
+    op.execute('DELETE FROM skill_ranking')
+    op.execute("""
+        INSERT INTO skill_ranking (skill_id, receiver_id, num_endorsements, last_endorsed)
+        SELECT skill_id, receiver_id, count(*), max(creation_date)
+        FROM endorsement GROUP BY skill_id, receiver_id
+    """)
+
+
+def create_skill_ranking():
+    op.create_table('skill_ranking',
+        sa.Column('skill_id', sa.Integer(), nullable=False),
+        sa.Column('receiver_id', sa.Integer(), nullable=False),
+        sa.Column('num_endorsements', sa.Integer(), nullable=False),
+        sa.Column('last_endorsed', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['receiver_id'], ['profile.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['skill_id'], ['skill.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('skill_id', 'receiver_id')
+    )
+    op.create_index('ix_skill_ranking_top', 'skill_ranking',
+        ['skill_id', 'num_endorsements', 'last_endorsed', 'receiver_id'])
+    op.execute(RANKING_TRIGGERS)
+
+
+def downgrade():
+    op.execute('DROP TRIGGER skill_ranking_delete ON endorsement')
+    op.execute('DROP TRIGGER skill_ranking_insert ON endorsement')
+    op.execute('DROP FUNCTION skill_ranking_delete()')
+    op.execute('DROP FUNCTION skill_ranking_insert()')
+    op.drop_index('ix_skill_ranking_top', table_name='skill_ranking')
+    op.drop_table('skill_ranking')
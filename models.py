@@ -1,25 +1,73 @@
 import os
-from sqlalchemy import Table, Column, String, Integer, ForeignKey, DateTime
-from sqlalchemy.orm import relationship
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
-from datetime import date
+import random
+from sqlalchemy import Table, Column, String, Integer, Float, ForeignKey, DateTime, Index, UniqueConstraint, DDL, event, func, text
+from sqlalchemy.orm import relationship, sessionmaker
+from flask import g, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from datetime import date, datetime
+from pool import engine_options
 
-database_path = os.environ['DATABASE_URL']
+# Read replicas of DATABASE_URL, from DATABASE_REPLICA_URLS as a
+# comma-separated list of database URLs. GET requests read from one of them,
+# everything else uses the primary.
+def get_replica_paths():
+    return [path.strip() for path in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+        if path.strip()]
 
-db = SQLAlchemy()
 
-# Bind a flask application and a SQLAlchemy service
-def setup_db(app, database_path=database_path):
+'''
+RoutingSession
+Session sending the queries of a request to the replica chosen for it by
+use_replica, and everything else (writes, requests pinned to the primary,
+code running outside requests) to the primary database.
+'''
+class RoutingSession(SignallingSession):
+  def get_bind(self, mapper=None, clause=None):
+    replica = g.get('read_replica') if has_request_context() else None
+    if replica is not None and not self._flushing:
+      return get_state(self.app).db.get_engine(self.app, bind=replica)
+    return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+  def create_session(self, options):
+    return sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+# Bind a flask application and a SQLAlchemy service. Database URLs default
+# to DATABASE_URL and DATABASE_REPLICA_URLS, read when the app is created.
+# No connection is opened here, so workers forked from an app created once
+# (gunicorn --preload) each open their own. The schema is created by the
+# migrations (python manage.py db upgrade), not when the app starts.
+def setup_db(app, database_path=None, replica_paths=None):
+    if database_path is None:
+        database_path = os.environ['DATABASE_URL']
+    if replica_paths is None:
+        replica_paths = get_replica_paths()
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    # Pool sizes, recycling, pre-ping and statement timeout from DB_* variables
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
+    # Replicas are binds no model is mapped to, only used by RoutingSession
+    app.config["DATABASE_REPLICAS"] = [f'replica_{i}' for i in range(len(replica_paths))]
+    app.config["SQLALCHEMY_BINDS"] = dict(zip(app.config["DATABASE_REPLICAS"], replica_paths))
     db.app = app
-    migrate = Migrate(app, db)
     db.init_app(app)
-    db.create_all()
-    
+
     return db
 
+# Send the reads of the current request to a replica, if any is configured
+def use_replica():
+    replicas = db.get_app().config.get('DATABASE_REPLICAS')
+    g.read_replica = random.choice(replicas) if replicas else None
+
+# Send the rest of the current request to the primary, e.g. to read rows
+# right after writing them
+def use_primary():
+    g.read_replica = None
+
 
 # Profile entity
 class Profile(db.Model):
@@ -31,6 +79,14 @@ class Profile(db.Model):
   location = Column(String)
   description = Column(String)
   contact = Column(Integer)
+  # Maintained by database triggers on the endorsement table
+  num_endorsements_received = Column(Integer, nullable=False, default=0, server_default='0')
+  # Computed by the trust_scores job in manage.py (see trust.py)
+  trust_score = Column(Float, nullable=False, default=0, server_default='0')
+  # Bumped by database triggers whenever the user profile changes (see
+  # ROW_VERSIONS_POSTGRESQL), used to answer conditional GETs
+  version = Column(Integer, nullable=False, default=1, server_default='1')
+  updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
 
   def __init__(self, first_name, last_name, location, description, contact):
     self.first_name = first_name
@@ -53,16 +109,14 @@ class Profile(db.Model):
       db.session.delete(self)
       db.session.commit()
 
+  # Fields of the form representation, which the read routes can select a
+  # subset of with the fields parameter
+  FIELDS = ('id', 'first_name', 'last_name', 'location', 'description', 'contact',
+    'num_endorsements_received', 'trust_score')
+
   # Form representation of Profile model
   def format(self):
-    return {
-      'id': self.id,
-      'first_name': self.first_name,
-      'last_name': self.last_name,
-      'location': self.location,
-      'description': self.description,
-      'contact': self.contact
-    }
+    return {field: getattr(self, field) for field in self.FIELDS}
 
 # Skill entity
 class Skill(db.Model):
@@ -71,6 +125,11 @@ class Skill(db.Model):
   id = Column(Integer, primary_key=True)
   name = Column(String, nullable=False)
   description = Column(String)
+  # Maintained by database triggers on the endorsement table
+  num_endorsements = Column(Integer, nullable=False, default=0, server_default='0')
+  # Bumped by database triggers whenever the skill detail changes
+  version = Column(Integer, nullable=False, default=1, server_default='1')
+  updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
 
   def __init__(self, name, description):
     self.name = name
@@ -90,13 +149,13 @@ class Skill(db.Model):
     db.session.delete(self)
     db.session.commit()
 
+  # Fields of the form representation, which the read routes can select a
+  # subset of with the fields parameter
+  FIELDS = ('id', 'name', 'description', 'num_endorsements')
+
   # Form representation of Skill model
   def format(self):
-    return {
-      'id': self.id,
-      'name': self.name,
-      'description': self.description
-    }
+    return {field: getattr(self, field) for field in self.FIELDS}
 
 # Endorsement entity
 class Endorsement(db.Model):
@@ -106,10 +165,16 @@ class Endorsement(db.Model):
   # https://docs.sqlalchemy.org/en/13/orm/join_conditions.html#handling-multiple-join-paths
   
   
+  # A user can endorse another user only once per skill. The unique index
+  # also serves lookups by giver_id, as it is its leading column.
+  __table_args__ = (
+    UniqueConstraint('giver_id', 'receiver_id', 'skill_id', name='uq_endorsement_giver_receiver_skill'),
+  )
+
   id = Column(Integer, primary_key=True)
   giver_id = Column(Integer, ForeignKey('profile.id', ondelete='CASCADE'), nullable=False)
-  receiver_id = Column(Integer, ForeignKey('profile.id', ondelete='CASCADE'), nullable=False)
-  skill_id = Column(Integer, ForeignKey('skill.id', ondelete='CASCADE'), nullable=False)
+  receiver_id = Column(Integer, ForeignKey('profile.id', ondelete='CASCADE'), nullable=False, index=True)
+  skill_id = Column(Integer, ForeignKey('skill.id', ondelete='CASCADE'), nullable=False, index=True)
   creation_date = Column(DateTime, nullable=False)
 
   endorsement_giver = relationship("Profile", foreign_keys=[giver_id])
@@ -144,4 +209,534 @@ class Endorsement(db.Model):
       'receiver_id': self.receiver_id,
       'skill_id': self.skill_id,
       'creation_date': self.creation_date
-    }
\ No newline at end of file
+    }
+
+# Skill ranking entity: number of endorsements received by each user for
+# each skill, and date of the latest one. Maintained by database triggers on
+# the endorsement table, so the top users for a skill are read from an index
+# instead of being aggregated on each request. The trust score of each user
+# for each skill is computed by the trust_scores job in manage.py.
+class SkillRanking(db.Model):
+  __tablename__ = 'skill_ranking'
+  __table_args__ = (
+    Index('ix_skill_ranking_top', 'skill_id', 'num_endorsements', 'last_endorsed', 'receiver_id'),
+    Index('ix_skill_ranking_trust', 'skill_id', 'trust_score', 'receiver_id'),
+    # Skills of each user, for the endorsement summaries of batch gets and
+    # the cascade deletes of users
+    Index('ix_skill_ranking_receiver', 'receiver_id', 'num_endorsements', 'skill_id'),
+  )
+
+  skill_id = Column(Integer, ForeignKey('skill.id', ondelete='CASCADE'), primary_key=True)
+  receiver_id = Column(Integer, ForeignKey('profile.id', ondelete='CASCADE'), primary_key=True)
+  num_endorsements = Column(Integer, nullable=False)
+  last_endorsed = Column(DateTime, nullable=False)
+  trust_score = Column(Float, nullable=False, default=0, server_default='0')
+
+  # Top receivers for a skill, by number of endorsements and most recent one
+  @staticmethod
+  def top(skill_id, limit):
+    return SkillRanking._ranking(skill_id)\
+      .order_by(SkillRanking.num_endorsements.desc(), SkillRanking.last_endorsed.desc(),
+        SkillRanking.receiver_id.desc())\
+      .limit(limit)
+
+  # Top receivers for a skill, by trust score
+  @staticmethod
+  def trusted(skill_id, limit):
+    return SkillRanking._ranking(skill_id)\
+      .order_by(SkillRanking.trust_score.desc(), SkillRanking.receiver_id.desc())\
+      .limit(limit)
+
+  # Most endorsed skills of each of the given users, up to limit each, as
+  # (receiver_id, skill_id, name, num_endorsements) rows
+  @staticmethod
+  def top_skills(receiver_ids, limit):
+    rank = func.row_number().over(partition_by=SkillRanking.receiver_id,
+      order_by=(SkillRanking.num_endorsements.desc(), SkillRanking.skill_id))
+    ranking = db.session.query(SkillRanking.receiver_id, SkillRanking.skill_id,
+        SkillRanking.num_endorsements, rank.label('rank'))\
+      .filter(SkillRanking.receiver_id.in_(receiver_ids))\
+      .subquery()
+    return db.session.query(ranking.c.receiver_id, ranking.c.skill_id, Skill.name,
+        ranking.c.num_endorsements)\
+      .join(Skill, ranking.c.skill_id == Skill.id)\
+      .filter(ranking.c.rank <= limit)\
+      .order_by(ranking.c.receiver_id, ranking.c.rank)
+
+  # Top receivers of each of the given skills, up to limit each, in the
+  # order of top(), as (skill_id, receiver_id, first_name, last_name,
+  # num_endorsements) rows
+  @staticmethod
+  def top_receivers(skill_ids, limit):
+    rank = func.row_number().over(partition_by=SkillRanking.skill_id,
+      order_by=(SkillRanking.num_endorsements.desc(), SkillRanking.last_endorsed.desc(),
+        SkillRanking.receiver_id.desc()))
+    ranking = db.session.query(SkillRanking.skill_id, SkillRanking.receiver_id,
+        SkillRanking.num_endorsements, rank.label('rank'))\
+      .filter(SkillRanking.skill_id.in_(skill_ids))\
+      .subquery()
+    return db.session.query(ranking.c.skill_id, ranking.c.receiver_id, Profile.first_name,
+        Profile.last_name, ranking.c.num_endorsements)\
+      .join(Profile, ranking.c.receiver_id == Profile.id)\
+      .filter(ranking.c.rank <= limit)\
+      .order_by(ranking.c.skill_id, ranking.c.rank)
+
+  @staticmethod
+  def _ranking(skill_id):
+    return SkillRanking.query\
+      .filter(SkillRanking.skill_id == skill_id)\
+      .join(Profile, SkillRanking.receiver_id == Profile.id)\
+      .with_entities(SkillRanking.receiver_id, SkillRanking.num_endorsements,
+        SkillRanking.last_endorsed, SkillRanking.trust_score)\
+      .add_columns(Profile.first_name, Profile.last_name)
+
+# Endorsement deletion log, written by database triggers on any delete of
+# endorsements, including cascade deletes, so that the in-memory trust graph
+# of each process can drop the edges deleted by other processes (see
+# graph.py). Entries are kept for a day.
+class EndorsementDeletion(db.Model):
+  __tablename__ = 'endorsement_deletion'
+
+  id = Column(Integer, primary_key=True)
+  endorsement_id = Column(Integer, nullable=False)
+  giver_id = Column(Integer, nullable=False)
+  receiver_id = Column(Integer, nullable=False)
+  skill_id = Column(Integer, nullable=False)
+  deleted_at = Column(DateTime, nullable=False, index=True)
+
+# Triggers keeping Profile.num_endorsements_received and Skill.num_endorsements
+# up to date in the same transaction as any insert or delete of endorsements,
+# including bulk inserts, imports and cascade deletes. On PostgreSQL they run
+# once per statement over its transition table, so bulk writes update each
+# counter once. The same SQL is applied to existing databases by migration
+# c7e19f4a2d58.
+ENDORSEMENT_COUNTERS_POSTGRESQL = """
+CREATE FUNCTION endorsement_counters_insert() RETURNS trigger AS $$
+BEGIN
+  UPDATE profile p SET num_endorsements_received = p.num_endorsements_received + c.count
+  FROM (SELECT receiver_id, count(*) AS count FROM new_rows GROUP BY receiver_id) c
+  WHERE p.id = c.receiver_id;
+  UPDATE skill s SET num_endorsements = s.num_endorsements + c.count
+  FROM (SELECT skill_id, count(*) AS count FROM new_rows GROUP BY skill_id) c
+  WHERE s.id = c.skill_id;
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION endorsement_counters_delete() RETURNS trigger AS $$
+BEGIN
+  UPDATE profile p SET num_endorsements_received = p.num_endorsements_received - c.count
+  FROM (SELECT receiver_id, count(*) AS count FROM old_rows GROUP BY receiver_id) c
+  WHERE p.id = c.receiver_id;
+  UPDATE skill s SET num_endorsements = s.num_endorsements - c.count
+  FROM (SELECT skill_id, count(*) AS count FROM old_rows GROUP BY skill_id) c
+  WHERE s.id = c.skill_id;
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER endorsement_counters_insert AFTER INSERT ON endorsement
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE endorsement_counters_insert();
+
+CREATE TRIGGER endorsement_counters_delete AFTER DELETE ON endorsement
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE endorsement_counters_delete();
+"""
+
+ENDORSEMENT_COUNTERS_SQLITE = [
+"""
+CREATE TRIGGER endorsement_counters_insert AFTER INSERT ON endorsement
+BEGIN
+  UPDATE profile SET num_endorsements_received = num_endorsements_received + 1 WHERE id = NEW.receiver_id;
+  UPDATE skill SET num_endorsements = num_endorsements + 1 WHERE id = NEW.skill_id;
+END
+""",
+"""
+CREATE TRIGGER endorsement_counters_delete AFTER DELETE ON endorsement
+BEGIN
+  UPDATE profile SET num_endorsements_received = num_endorsements_received - 1 WHERE id = OLD.receiver_id;
+  UPDATE skill SET num_endorsements = num_endorsements - 1 WHERE id = OLD.skill_id;
+END
+"""]
+
+event.listen(Endorsement.__table__, 'after_create',
+  DDL(ENDORSEMENT_COUNTERS_POSTGRESQL).execute_if(dialect='postgresql'))
+for statement in ENDORSEMENT_COUNTERS_SQLITE:
+  event.listen(Endorsement.__table__, 'after_create',
+    DDL(statement).execute_if(dialect='sqlite'))
+
+
+# Triggers keeping the skill_ranking table up to date with endorsements.
+# Created once all tables exist, as they span several of them. Existing
+# databases get them from migration e2b85c1f9a47.
+SKILL_RANKING_POSTGRESQL = """
+CREATE FUNCTION skill_ranking_insert() RETURNS trigger AS $$
+BEGIN
+  INSERT INTO skill_ranking (skill_id, receiver_id, num_endorsements, last_endorsed)
+  SELECT skill_id, receiver_id, count(*), max(creation_date)
+  FROM new_rows GROUP BY skill_id, receiver_id
+  ON CONFLICT (skill_id, receiver_id) DO UPDATE SET
+    num_endorsements = skill_ranking.num_endorsements + EXCLUDED.num_endorsements,
+    last_endorsed = GREATEST(skill_ranking.last_endorsed, EXCLUDED.last_endorsed);
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION skill_ranking_delete() RETURNS trigger AS $$
+BEGIN
+  UPDATE skill_ranking r SET
+    num_endorsements = r.num_endorsements - c.count,
+    last_endorsed = COALESCE((SELECT max(e.creation_date) FROM endorsement e
+      WHERE e.receiver_id = r.receiver_id AND e.skill_id = r.skill_id), r.last_endorsed)
+  FROM (SELECT skill_id, receiver_id, count(*) AS count FROM old_rows
+    GROUP BY skill_id, receiver_id) c
+  WHERE r.skill_id = c.skill_id AND r.receiver_id = c.receiver_id;
+
+  DELETE FROM skill_ranking r
+  USING (SELECT DISTINCT skill_id, receiver_id FROM old_rows) c
+  WHERE r.skill_id = c.skill_id AND r.receiver_id = c.receiver_id
+    AND r.num_endorsements <= 0;
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER skill_ranking_insert AFTER INSERT ON endorsement
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE skill_ranking_insert();
+
+CREATE TRIGGER skill_ranking_delete AFTER DELETE ON endorsement
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE skill_ranking_delete();
+"""
+
+SKILL_RANKING_SQLITE = [
+"""
+CREATE TRIGGER skill_ranking_insert AFTER INSERT ON endorsement
+BEGIN
+  INSERT INTO skill_ranking (skill_id, receiver_id, num_endorsements, last_endorsed)
+  VALUES (NEW.skill_id, NEW.receiver_id, 1, NEW.creation_date)
+  ON CONFLICT (skill_id, receiver_id) DO UPDATE SET
+    num_endorsements = num_endorsements + 1,
+    last_endorsed = max(last_endorsed, excluded.last_endorsed);
+END
+""",
+"""
+CREATE TRIGGER skill_ranking_delete AFTER DELETE ON endorsement
+BEGIN
+  UPDATE skill_ranking SET
+    num_endorsements = num_endorsements - 1,
+    last_endorsed = COALESCE((SELECT max(creation_date) FROM endorsement
+      WHERE receiver_id = OLD.receiver_id AND skill_id = OLD.skill_id), last_endorsed)
+  WHERE skill_id = OLD.skill_id AND receiver_id = OLD.receiver_id;
+  DELETE FROM skill_ranking
+  WHERE skill_id = OLD.skill_id AND receiver_id = OLD.receiver_id AND num_endorsements <= 0;
+END
+"""]
+
+# Only run when create_all actually creates the given table
+def creating(table):
+  def callable_(ddl, target, bind, tables=None, **kw):
+    return tables is not None and table.__table__ in tables
+  return callable_
+
+event.listen(db.metadata, 'after_create',
+  DDL(SKILL_RANKING_POSTGRESQL).execute_if(dialect='postgresql', callable_=creating(SkillRanking)))
+for statement in SKILL_RANKING_SQLITE:
+  event.listen(db.metadata, 'after_create',
+    DDL(statement).execute_if(dialect='sqlite', callable_=creating(SkillRanking)))
+
+
+# Triggers logging deleted endorsements in endorsement_deletion, and pruning
+# entries older than a day. Existing databases get them from migration
+# 7e4b9d2c1a85.
+ENDORSEMENT_DELETIONS_POSTGRESQL = """
+CREATE FUNCTION endorsement_deletion_log() RETURNS trigger AS $$
+BEGIN
+  DELETE FROM endorsement_deletion
+  WHERE deleted_at < timezone('utc', now()) - interval '1 day';
+  INSERT INTO endorsement_deletion (endorsement_id, giver_id, receiver_id, skill_id, deleted_at)
+  SELECT id, giver_id, receiver_id, skill_id, timezone('utc', now()) FROM old_rows ORDER BY id;
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER endorsement_deletion_log AFTER DELETE ON endorsement
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE endorsement_deletion_log();
+"""
+
+ENDORSEMENT_DELETIONS_SQLITE = """
+CREATE TRIGGER endorsement_deletion_log AFTER DELETE ON endorsement
+BEGIN
+  DELETE FROM endorsement_deletion WHERE deleted_at < datetime('now', '-1 day');
+  INSERT INTO endorsement_deletion (endorsement_id, giver_id, receiver_id, skill_id, deleted_at)
+  VALUES (OLD.id, OLD.giver_id, OLD.receiver_id, OLD.skill_id, datetime('now'));
+END
+"""
+
+event.listen(db.metadata, 'after_create',
+  DDL(ENDORSEMENT_DELETIONS_POSTGRESQL).execute_if(dialect='postgresql',
+    callable_=creating(EndorsementDeletion)))
+event.listen(db.metadata, 'after_create',
+  DDL(ENDORSEMENT_DELETIONS_SQLITE).execute_if(dialect='sqlite',
+    callable_=creating(EndorsementDeletion)))
+
+
+# Triggers bumping the version and updated_at of profiles and skills whenever
+# their detail (GET /users/<id> and GET /skills/<id>) changes: on any update
+# of the row itself, including counters and trust scores, on endorsements
+# given by a user, and on name changes of the users and skills shown along
+# with their endorsements. The update triggers list the columns compared,
+# as BEFORE triggers can't reference generated columns such as
+# search_vector. Existing databases get them from migrations 9d3a5f7e2b14
+# and 2d6f8b3e5a17.
+ROW_VERSIONS_POSTGRESQL = """
+CREATE FUNCTION row_version_insert() RETURNS trigger AS $$
+BEGIN
+  NEW.updated_at := timezone('utc', now());
+  RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION row_version_update() RETURNS trigger AS $$
+BEGIN
+  NEW.version := OLD.version + 1;
+  NEW.updated_at := timezone('utc', now());
+  RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION endorsement_versions_insert() RETURNS trigger AS $$
+BEGIN
+  UPDATE profile SET version = version + 1
+  WHERE id IN (SELECT giver_id FROM new_rows);
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION endorsement_versions_delete() RETURNS trigger AS $$
+BEGIN
+  UPDATE profile SET version = version + 1
+  WHERE id IN (SELECT giver_id FROM old_rows);
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION profile_name_versions() RETURNS trigger AS $$
+BEGIN
+  UPDATE profile SET version = version + 1 WHERE id IN (
+    SELECT receiver_id FROM endorsement WHERE giver_id = NEW.id
+    UNION SELECT giver_id FROM endorsement WHERE receiver_id = NEW.id);
+  UPDATE skill SET version = version + 1 WHERE id IN (
+    SELECT skill_id FROM endorsement WHERE giver_id = NEW.id
+    UNION SELECT skill_id FROM endorsement WHERE receiver_id = NEW.id);
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION skill_name_versions() RETURNS trigger AS $$
+BEGIN
+  UPDATE profile SET version = version + 1 WHERE id IN (
+    SELECT giver_id FROM endorsement WHERE skill_id = NEW.id
+    UNION SELECT receiver_id FROM endorsement WHERE skill_id = NEW.id);
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER profile_created BEFORE INSERT ON profile
+FOR EACH ROW EXECUTE PROCEDURE row_version_insert();
+
+CREATE TRIGGER profile_version BEFORE UPDATE ON profile
+FOR EACH ROW WHEN ((OLD.first_name, OLD.last_name, OLD.location, OLD.description, OLD.contact, OLD.num_endorsements_received, OLD.trust_score, OLD.version, OLD.updated_at)
+  IS DISTINCT FROM (NEW.first_name, NEW.last_name, NEW.location, NEW.description, NEW.contact, NEW.num_endorsements_received, NEW.trust_score, NEW.version, NEW.updated_at))
+EXECUTE PROCEDURE row_version_update();
+
+CREATE TRIGGER skill_created BEFORE INSERT ON skill
+FOR EACH ROW EXECUTE PROCEDURE row_version_insert();
+
+CREATE TRIGGER skill_version BEFORE UPDATE ON skill
+FOR EACH ROW WHEN ((OLD.name, OLD.description, OLD.num_endorsements, OLD.version, OLD.updated_at)
+  IS DISTINCT FROM (NEW.name, NEW.description, NEW.num_endorsements, NEW.version, NEW.updated_at))
+EXECUTE PROCEDURE row_version_update();
+
+CREATE TRIGGER endorsement_versions_insert AFTER INSERT ON endorsement
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE endorsement_versions_insert();
+
+CREATE TRIGGER endorsement_versions_delete AFTER DELETE ON endorsement
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE endorsement_versions_delete();
+
+CREATE TRIGGER profile_name_versions AFTER UPDATE OF first_name, last_name ON profile
+FOR EACH ROW WHEN (OLD.first_name IS DISTINCT FROM NEW.first_name
+  OR OLD.last_name IS DISTINCT FROM NEW.last_name)
+EXECUTE PROCEDURE profile_name_versions();
+
+CREATE TRIGGER skill_name_versions AFTER UPDATE OF name ON skill
+FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name)
+EXECUTE PROCEDURE skill_name_versions();
+"""
+
+# SQLite triggers cannot modify the row being written, so the version is
+# bumped by a second update, which does not fire triggers again
+ROW_VERSIONS_SQLITE = [
+"""
+CREATE TRIGGER profile_version AFTER UPDATE ON profile
+WHEN NEW.version = OLD.version
+BEGIN
+  UPDATE profile SET version = version + 1, updated_at = CURRENT_TIMESTAMP WHERE id = NEW.id;
+END
+""",
+"""
+CREATE TRIGGER skill_version AFTER UPDATE ON skill
+WHEN NEW.version = OLD.version
+BEGIN
+  UPDATE skill SET version = version + 1, updated_at = CURRENT_TIMESTAMP WHERE id = NEW.id;
+END
+""",
+"""
+CREATE TRIGGER endorsement_versions_insert AFTER INSERT ON endorsement
+BEGIN
+  UPDATE profile SET version = version + 1, updated_at = CURRENT_TIMESTAMP WHERE id = NEW.giver_id;
+END
+""",
+"""
+CREATE TRIGGER endorsement_versions_delete AFTER DELETE ON endorsement
+BEGIN
+  UPDATE profile SET version = version + 1, updated_at = CURRENT_TIMESTAMP WHERE id = OLD.giver_id;
+END
+""",
+"""
+CREATE TRIGGER profile_name_versions AFTER UPDATE OF first_name, last_name ON profile
+WHEN OLD.first_name IS NOT NEW.first_name OR OLD.last_name IS NOT NEW.last_name
+BEGIN
+  UPDATE profile SET version = version + 1, updated_at = CURRENT_TIMESTAMP WHERE id IN (
+    SELECT receiver_id FROM endorsement WHERE giver_id = NEW.id
+    UNION SELECT giver_id FROM endorsement WHERE receiver_id = NEW.id);
+  UPDATE skill SET version = version + 1, updated_at = CURRENT_TIMESTAMP WHERE id IN (
+    SELECT skill_id FROM endorsement WHERE giver_id = NEW.id
+    UNION SELECT skill_id FROM endorsement WHERE receiver_id = NEW.id);
+END
+""",
+"""
+CREATE TRIGGER skill_name_versions AFTER UPDATE OF name ON skill
+WHEN OLD.name IS NOT NEW.name
+BEGIN
+  UPDATE profile SET version = version + 1, updated_at = CURRENT_TIMESTAMP WHERE id IN (
+    SELECT giver_id FROM endorsement WHERE skill_id = NEW.id
+    UNION SELECT receiver_id FROM endorsement WHERE skill_id = NEW.id);
+END
+"""]
+
+event.listen(db.metadata, 'after_create',
+  DDL(ROW_VERSIONS_POSTGRESQL).execute_if(dialect='postgresql', callable_=creating(Profile)))
+for statement in ROW_VERSIONS_SQLITE:
+  event.listen(db.metadata, 'after_create',
+    DDL(statement).execute_if(dialect='sqlite', callable_=creating(Profile)))
+
+
+# Full-text search of profiles and skills (see search.py): a weighted
+# tsvector kept by PostgreSQL as a generated column (names A, locations B,
+# descriptions C), with a GIN index, plus GIN trigram indexes on names to
+# match misspelt queries. Not mapped, so regular queries never load it.
+# Other databases use the in-memory index of search.py instead.
+SEARCH_POSTGRESQL = """
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+ALTER TABLE profile ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (
+  setweight(to_tsvector('english', first_name || ' ' || last_name), 'A') ||
+  setweight(to_tsvector('english', coalesce(location, '')), 'B') ||
+  setweight(to_tsvector('english', coalesce(description, '')), 'C')
+) STORED;
+CREATE INDEX ix_profile_search_vector ON profile USING gin (search_vector);
+CREATE INDEX ix_profile_name_trgm ON profile USING gin ((first_name || ' ' || last_name) gin_trgm_ops);
+
+ALTER TABLE skill ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (
+  setweight(to_tsvector('english', name), 'A') ||
+  setweight(to_tsvector('english', coalesce(description, '')), 'C')
+) STORED;
+CREATE INDEX ix_skill_search_vector ON skill USING gin (search_vector);
+CREATE INDEX ix_skill_name_trgm ON skill USING gin (name gin_trgm_ops);
+"""
+
+event.listen(db.metadata, 'after_create',
+  DDL(SEARCH_POSTGRESQL).execute_if(dialect='postgresql', callable_=creating(Profile)))
+
+
+# Insert many rows into a model table with one multi-row INSERT statement,
+# without committing. Returns the new ids, in the same order as the rows.
+# On PostgreSQL the ids are reserved upfront from the table sequence, so a
+# single statement is needed whatever the number of rows. Other databases
+# insert row by row to get the generated ids back.
+def bulk_insert(model, rows):
+  table = model.__table__
+  if not rows:
+    return []
+
+  if db.engine.dialect.name == 'postgresql':
+    ids = [row[0] for row in db.session.execute(
+      text("SELECT nextval(pg_get_serial_sequence(:table, 'id')) FROM generate_series(1, :n)"),
+      {'table': table.name, 'n': len(rows)})]
+    rows = [dict(row, id=id) for row, id in zip(rows, ids)]
+    db.session.execute(table.insert().values(rows))
+    return ids
+
+  return [db.session.execute(table.insert().values(row)).inserted_primary_key[0]
+    for row in rows]
+
+
+# Full user profile (user info plus endorsements received and given) built
+# as a single JSON document by PostgreSQL in one round trip. Keys are sorted
+# and dates use the HTTP date format, matching the ORM/jsonify output.
+USER_PROFILE_JSON_SQL = text("""
+SELECT json_build_object(
+  'endorsements_given', COALESCE((
+    SELECT json_agg(json_build_object(
+      'creation_date', to_char(e.creation_date, 'Dy, DD Mon YYYY HH24:MI:SS "GMT"'),
+      'first_name', p.first_name,
+      'last_name', p.last_name,
+      'name', s.name,
+      'receiver_id', e.receiver_id,
+      'skill_id', e.skill_id
+    ) ORDER BY e.id)
+    FROM endorsement e
+    JOIN profile p ON p.id = e.receiver_id
+    JOIN skill s ON s.id = e.skill_id
+    WHERE e.giver_id = u.id
+  ), '[]'::json),
+  'endorsements_received', COALESCE((
+    SELECT json_agg(json_build_object(
+      'creation_date', to_char(e.creation_date, 'Dy, DD Mon YYYY HH24:MI:SS "GMT"'),
+      'first_name', p.first_name,
+      'giver_id', e.giver_id,
+      'last_name', p.last_name,
+      'name', s.name,
+      'skill_id', e.skill_id
+    ) ORDER BY e.id)
+    FROM endorsement e
+    JOIN profile p ON p.id = e.giver_id
+    JOIN skill s ON s.id = e.skill_id
+    WHERE e.receiver_id = u.id
+  ), '[]'::json),
+  'success', true,
+  'user', json_build_object(
+    'contact', u.contact,
+    'description', u.description,
+    'first_name', u.first_name,
+    'id', u.id,
+    'last_name', u.last_name,
+    'location', u.location,
+    'num_endorsements_received', u.num_endorsements_received,
+    -- Whole numbers are written with a decimal part, as Python does for floats
+    'trust_score', (CASE WHEN u.trust_score = trunc(u.trust_score) AND abs(u.trust_score) < 1e15
+      THEN trunc(u.trust_score)::bigint || '.0' ELSE u.trust_score::text END)::json
+  )
+)::text
+FROM profile u
+WHERE u.id = :id
+""")
+
+# Return the user profile JSON document as text, or None if not found
+def user_profile_json(id):
+  return db.session.execute(USER_PROFILE_JSON_SQL, {'id': id}).scalar()
@@ -0,0 +1,138 @@
+# Database connection pool settings and instrumentation
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+# Connections kept open per process, extra connections opened under load,
+# and seconds a request waits for a connection before failing. With gunicorn
+# each worker has its own pool, so the database must accept up to
+# workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections.
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+# Seconds after which a connection is replaced, below the idle timeout of the
+# database or of any proxy in between (-1 to never replace them)
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+# Check each connection with a round trip before using it, so connections
+# dropped by the database are replaced instead of failing a request
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+# Milliseconds after which PostgreSQL cancels a statement (0 for no limit)
+DB_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', 0))
+
+# Number of recent checkouts the wait percentiles are computed from
+POOL_STATS_WINDOW = 1000
+
+logger = logging.getLogger(__name__)
+
+
+'''
+PoolStats
+Counters of the connection pool: checkouts, time spent waiting for a
+connection, checkouts that found every connection in use, and timeouts.
+'''
+class PoolStats:
+    def __init__(self, window=POOL_STATS_WINDOW):
+        self.checkouts = 0
+        self.exhausted = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.peak_checked_out = 0
+        self._waits = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, wait, exhausted, checked_out):
+        with self._lock:
+            self.checkouts += 1
+            self.exhausted += exhausted
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            self.peak_checked_out = max(self.peak_checked_out, checked_out)
+            self._waits.append(wait)
+
+    # A checkout that gave up waiting also found the pool exhausted
+    def record_timeout(self):
+        with self._lock:
+            self.exhausted += 1
+            self.timeouts += 1
+
+    # Counters, with the current state of pool if given
+    def stats(self, pool=None):
+        with self._lock:
+            waits = sorted(self._waits)
+            result = {
+                'checkouts': self.checkouts,
+                'exhausted': self.exhausted,
+                'timeouts': self.timeouts,
+                'peak_checked_out': self.peak_checked_out,
+                'wait_ms': {
+                    'avg': 1000 * self.wait_total / self.checkouts if self.checkouts else None,
+                    'max': 1000 * self.wait_max,
+                    'p50': 1000 * percentile(waits, 50) if waits else None,
+                    'p95': 1000 * percentile(waits, 95) if waits else None,
+                    'p99': 1000 * percentile(waits, 99) if waits else None
+                }
+            }
+
+        result['pool'] = type(pool).__name__ if pool is not None else None
+        if isinstance(pool, QueuePool):
+            result.update({
+                'size': pool.size(),
+                'max_overflow': pool._max_overflow,
+                'checked_out': pool.checkedout(),
+                'checked_in': pool.checkedin(),
+                'overflow': pool.overflow()
+            })
+        return result
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+pool_stats = PoolStats()
+
+
+'''
+InstrumentedQueuePool
+QueuePool timing how long each checkout waits for a connection (including
+opening a new one) and counting checkouts made while the pool was exhausted.
+'''
+class InstrumentedQueuePool(QueuePool):
+    def _do_get(self):
+        exhausted = self._max_overflow > -1 and \
+            self.checkedout() >= self.size() + self._max_overflow
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            pool_stats.record_timeout()
+            logger.warning('Timed out after %ss waiting for a database connection, '
+                'all %d in use', self._timeout, self.size() + self._max_overflow)
+            raise
+        pool_stats.record(time.perf_counter() - start, exhausted, self.checkedout())
+        return connection
+
+
+# Engine options for SQLALCHEMY_ENGINE_OPTIONS. SQLite keeps the pool chosen
+# by SQLAlchemy, as its connections are not shared over a network.
+def engine_options(database_path):
+    if database_path.startswith('sqlite'):
+        return {}
+
+    options = {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING
+    }
+    if DB_STATEMENT_TIMEOUT > 0 and database_path.startswith('postgres'):
+        options['connect_args'] = {'options': f'-c statement_timeout={DB_STATEMENT_TIMEOUT}'}
+    return options
@@ -0,0 +1,144 @@
+# "Who should I ask" recommendations from 2-hop endorsement neighbourhoods
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from models import db, Endorsement
+from response_cache import response_cache
+
+# Number of users whose recommendations are kept in memory, and seconds they
+# are kept. Entries of a user are dropped as soon as their own endorsements
+# change in this process. With a response cache backend, entries are also
+# checked against the versions of the user:<id> and skill:<id> tags, which
+# the endorsement routes of every process bump. Otherwise the TTL bounds how
+# long endorsements written by other processes, or given by other users,
+# take to show.
+RECOMMENDATION_CACHE_SIZE = int(os.environ.get('RECOMMENDATION_CACHE_SIZE', 1024))
+RECOMMENDATION_CACHE_TTL = int(os.environ.get('RECOMMENDATION_CACHE_TTL', 300))
+
+# Age in days at which an endorsement counts half as much as a new one
+RECOMMENDATION_HALF_LIFE = int(os.environ.get('RECOMMENDATION_HALF_LIFE', 180))
+
+# Maximum number of candidates computed and kept per user and skill
+MAX_RECOMMENDATIONS = 100
+
+
+# Candidates endorsed for a skill by the users a user has endorsed (for any
+# skill), excluding the user and those the user already endorsed for it.
+# Each endorsement is a path to the candidate, and scores by its recency.
+# Returns up to MAX_RECOMMENDATIONS dicts, best first.
+def find_candidates(user_id, skill_id, half_life=RECOMMENDATION_HALF_LIFE):
+    endorsed = db.session.query(Endorsement.receiver_id)\
+        .filter(Endorsement.giver_id == user_id)
+    already_endorsed = endorsed.filter(Endorsement.skill_id == skill_id)
+
+    # Both hops are served by the (giver_id, receiver_id, skill_id) index
+    paths = db.session.query(Endorsement.receiver_id, Endorsement.creation_date)\
+        .filter(Endorsement.giver_id.in_(endorsed.distinct()))\
+        .filter(Endorsement.skill_id == skill_id)\
+        .filter(Endorsement.receiver_id != user_id)\
+        .filter(~Endorsement.receiver_id.in_(already_endorsed))
+
+    now = datetime.now()
+    candidates = {}
+    for receiver_id, creation_date in paths:
+        age = max((now - creation_date).total_seconds() / 86400, 0)
+        candidate = candidates.get(receiver_id)
+        if candidate is None:
+            candidate = candidates[receiver_id] = {
+                'id': receiver_id,
+                'num_paths': 0,
+                'last_endorsed': creation_date,
+                'score': 0.0
+            }
+        candidate['num_paths'] += 1
+        candidate['last_endorsed'] = max(candidate['last_endorsed'], creation_date)
+        candidate['score'] += 0.5 ** (age / half_life)
+
+    ranked = sorted(candidates.values(),
+        key=lambda c: (c['score'], c['num_paths'], c['last_endorsed'], c['id']), reverse=True)
+    return ranked[:MAX_RECOMMENDATIONS]
+
+
+'''
+RecommendationCache
+Bounded LRU cache of recommendations, holding for each user the candidates
+found for every skill asked for. Invalidated per user whenever the
+endorsements given by that user change, and expired after a TTL. Given a
+function returning the current versions of a list of tags, entries are only
+served while the versions of the user and skill tags they were found with
+are unchanged.
+'''
+class RecommendationCache:
+    def __init__(self, maxsize=1024, ttl=300, tag_versions=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.tag_versions = tag_versions
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Current versions of the tags of a user and skill, None without tags.
+    # Read before finding the candidates, so a write done meanwhile
+    # invalidates what is stored.
+    def versions(self, user_id, skill_id):
+        if self.tag_versions is None:
+            return None
+        return self.tag_versions([f'user:{user_id}', f'skill:{skill_id}'])
+
+    def get(self, user_id, skill_id, versions=None):
+        with self._lock:
+            skills = self._entries.get(user_id)
+            entry = skills.get(skill_id) if skills is not None else None
+            if entry is None or time.monotonic() >= entry[0] or entry[1] != versions:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[2]
+
+    def set(self, user_id, skill_id, candidates, versions=None):
+        if self.maxsize <= 0:
+            return
+
+        with self._lock:
+            skills = self._entries.setdefault(user_id, {})
+            skills[skill_id] = (time.monotonic() + self.ttl, versions, candidates)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    # Drop the entries of a user, after the endorsements they gave changed
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+recommendation_cache = RecommendationCache(RECOMMENDATION_CACHE_SIZE, RECOMMENDATION_CACHE_TTL,
+    response_cache.tag_versions if response_cache.backend is not None else None)
+
+# Recommendations for a user and skill, from the cache when possible
+def recommend(user_id, skill_id):
+    versions = recommendation_cache.versions(user_id, skill_id)
+    candidates = recommendation_cache.get(user_id, skill_id, versions)
+    if candidates is None:
+        candidates = find_candidates(user_id, skill_id)
+        recommendation_cache.set(user_id, skill_id, candidates, versions)
+    return candidates
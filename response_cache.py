@@ -0,0 +1,252 @@
+# Read-through cache of GET responses, invalidated by the write routes
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, g, request
+
+# Backend used to store responses: none (default), redis (shared by all
+# processes, needs the redis package) or memory (per process). As writes only
+# invalidate the memory backend of the process handling them, it is only
+# fit for a single process (see gunicorn.conf.py, which refuses it with
+# several workers).
+RESPONSE_CACHE_BACKEND = os.environ.get('RESPONSE_CACHE_BACKEND', 'none')
+RESPONSE_CACHE_URL = os.environ.get('RESPONSE_CACHE_URL', 'redis://localhost:6379/0')
+# Maximum number of responses kept by the memory backend
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 1024))
+# Seconds a response is kept. Bounds how long writes not done through the
+# API of this process (e.g. the trust_scores job, or other processes when
+# using the memory backend) take to show up.
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 60))
+# Seconds read replicas may lag behind the primary: the time the reads of a
+# client are pinned to the primary after a write (REPLICA_PIN_SECONDS in
+# app.py). Responses read from a replica are not stored within this time of
+# an invalidation of their tags, as they may not show the write yet.
+REPLICA_LAG_SECONDS = int(os.environ.get('REPLICA_PIN_SECONDS', 10))
+
+
+'''
+MemoryBackend
+Bounded LRU store of responses for a single process, with the current
+version of each tag.
+'''
+class MemoryBackend:
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._bumped_at = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() >= entry[0]:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def versions(self, tags):
+        with self._lock:
+            return [self._versions.get(tag, 0) for tag in tags]
+
+    def bump(self, tags):
+        with self._lock:
+            for tag in tags:
+                self._versions[tag] = self._versions.get(tag, 0) + 1
+                self._bumped_at[tag] = time.time()
+
+    # Time of the latest invalidation of any of the tags, 0 if never
+    def bumped_at(self, tags):
+        with self._lock:
+            return max([self._bumped_at.get(tag, 0) for tag in tags], default=0)
+
+    # Every response depends on the 'all' tag, so bumping it also
+    # invalidates responses stored meanwhile by requests still running
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        self.bump(['all'])
+
+    def size(self):
+        return len(self._entries)
+
+
+'''
+SharedBackend
+Store shared by all processes, on any client with the get, set, mget and
+incr commands of Redis. Tag versions never expire, so a version can't
+go back to a value an older entry was cached with.
+'''
+class SharedBackend:
+    def __init__(self, client, prefix='endorsa:'):
+        self.client = client
+        self.prefix = prefix
+
+    @staticmethod
+    def from_url(url, prefix='endorsa:'):
+        import redis
+        return SharedBackend(redis.Redis.from_url(url), prefix)
+
+    def get(self, key):
+        value = self.client.get(self.prefix + 'response:' + key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + 'response:' + key, json.dumps(value), ex=ttl)
+
+    def versions(self, tags):
+        if not tags:
+            return []
+        values = self.client.mget([self.prefix + 'tag:' + tag for tag in tags])
+        return [int(value) if value is not None else 0 for value in values]
+
+    def bump(self, tags):
+        for tag in tags:
+            self.client.incr(self.prefix + 'tag:' + tag)
+            self.client.set(self.prefix + 'bumped:' + tag, time.time(), ex=REPLICA_LAG_SECONDS + 1)
+
+    def bumped_at(self, tags):
+        if not tags:
+            return 0
+        values = self.client.mget([self.prefix + 'bumped:' + tag for tag in tags])
+        return max([float(value) for value in values if value is not None], default=0)
+
+    def clear(self):
+        self.bump(['all'])
+
+    def size(self):
+        return None
+
+
+'''
+ResponseCache
+Caches successful responses of GET routes. Each response depends on a list
+of tags (e.g. user:5), and is only served while none of them has been
+invalidated since it was stored.
+'''
+class ResponseCache:
+    def __init__(self, backend=None, ttl=60, replica_lag=REPLICA_LAG_SECONDS):
+        self.backend = backend
+        self.ttl = ttl
+        self.replica_lag = replica_lag
+        self.hits = {}
+        self.misses = {}
+        self._lock = threading.Lock()
+
+    # Key for the current request: route, parameters and the permissions of
+    # the token, so users with different rights never share responses
+    @staticmethod
+    def _key(payload):
+        scope = ' '.join(sorted(payload.get('permissions', [])))
+        params = sorted(request.args.items(multi=True))
+        raw = json.dumps([request.method, request.path, params, scope])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _count(self, counters, endpoint):
+        with self._lock:
+            counters[endpoint] = counters.get(endpoint, 0) + 1
+
+    # Decorator caching the responses of a route, to be placed under
+    # requires_auth. tags returns the tags of a response from the route
+    # parameters.
+    def cached(self, tags):
+        def cached_decorator(f):
+            @wraps(f)
+            def wrapper(payload, *args, **kwargs):
+                # Streamed exports are never cached, and clients pinned to
+                # the primary after a write skip responses read from replicas
+                if self.backend is None or 'stream' in request.args or \
+                        g.get('pinned_to_primary'):
+                    return f(payload, *args, **kwargs)
+
+                key = self._key(payload)
+                response_tags = ['all'] + tags(**kwargs)
+                # Versions are read before running the route, so a write
+                # done meanwhile invalidates what is stored below
+                versions = self.backend.versions(response_tags)
+
+                entry = self.backend.get(key)
+                if entry is not None and entry['versions'] == versions:
+                    self._count(self.hits, request.endpoint)
+                    response = Response(entry['body'], headers=entry['headers'])
+                    return response.make_conditional(request)
+
+                self._count(self.misses, request.endpoint)
+                response = f(payload, *args, **kwargs)
+                if response.status_code == 200 and not response.is_streamed and \
+                        not self._maybe_stale(response_tags):
+                    self.backend.set(key, {
+                        'versions': versions,
+                        'headers': list(response.headers.items()),
+                        'body': response.get_data(as_text=True)
+                    }, self.ttl)
+                return response
+            return wrapper
+        return cached_decorator
+
+    # Whether the current request read from a replica that may not have
+    # caught up with a write invalidating the tags of its response yet
+    def _maybe_stale(self, tags):
+        return g.get('read_replica') is not None and \
+            time.time() - self.backend.bumped_at(tags) < self.replica_lag
+
+    # Current versions of the given tags and of the 'all' tag, for other
+    # caches to be invalidated along with the responses
+    def tag_versions(self, tags):
+        return self.backend.versions(['all'] + tags)
+
+    def invalidate(self, tags):
+        if self.backend is not None and tags:
+            self.backend.bump(sorted(set(tags)))
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self):
+        with self._lock:
+            endpoints = sorted(set(self.hits) | set(self.misses))
+            routes = {}
+            for endpoint in endpoints:
+                hits, misses = self.hits.get(endpoint, 0), self.misses.get(endpoint, 0)
+                routes[endpoint] = {
+                    'hits': hits,
+                    'misses': misses,
+                    'hit_ratio': hits / (hits + misses)
+                }
+            hits, misses = sum(self.hits.values()), sum(self.misses.values())
+
+        return {
+            'backend': type(self.backend).__name__ if self.backend is not None else None,
+            'size': self.backend.size() if self.backend is not None else 0,
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': hits / (hits + misses) if hits + misses else None,
+            'routes': routes
+        }
+
+
+def create_backend(name=RESPONSE_CACHE_BACKEND):
+    if name == 'memory':
+        return MemoryBackend(RESPONSE_CACHE_SIZE)
+    if name == 'redis':
+        return SharedBackend.from_url(RESPONSE_CACHE_URL)
+    return None
+
+
+response_cache = ResponseCache(create_backend(), RESPONSE_CACHE_TTL)
@@ -0,0 +1,180 @@
+# Ranked search of users and skills: PostgreSQL full-text search with
+# trigram matching of names for typos, or an in-memory inverted index on
+# other databases (e.g. SQLite test runs)
+
+import os
+import re
+import threading
+from sqlalchemy import func, text
+from models import db, Profile, Skill
+
+# Maximum number of matches ranked per kind and matching method. Bounds the
+# cost of queries matching a large part of the table, whose results are
+# then ranked among the first matches found by the indexes.
+SEARCH_MAX_CANDIDATES = int(os.environ.get('SEARCH_MAX_CANDIDATES', 1000))
+
+# Similarity (0 to 1) above which a word of the in-memory index matches a
+# misspelt query word
+SEARCH_SIMILARITY_THRESHOLD = float(os.environ.get('SEARCH_SIMILARITY_THRESHOLD', 0.4))
+
+# Weights of names, locations and descriptions, the defaults of PostgreSQL
+# ts_rank_cd for the A, B and C weights set by the migration
+NAME_WEIGHT = 1.0
+LOCATION_WEIGHT = 0.4
+DESCRIPTION_WEIGHT = 0.2
+
+# Full-text matches (GIN index on the generated search_vector column), and
+# when they are fewer than requested, as for misspelt queries, trigram
+# matches of the name (GIN trigram index). Both are ranked together, on the
+# sum of ts_rank_cd, normalized by rank / (rank + 1), and the similarity of
+# the query to the closest words of the name, each from 0 to 1.
+SEARCH_SQL = {
+    'users': text("""
+WITH query AS (SELECT websearch_to_tsquery('english', :q) AS tsquery),
+matches AS (
+  SELECT profile.id FROM profile, query
+  WHERE profile.search_vector @@ query.tsquery LIMIT :candidates
+),
+candidates AS (
+  SELECT id FROM matches
+  UNION
+  (SELECT id FROM profile
+   WHERE (SELECT count(*) FROM matches) < :limit
+     AND :q <% (first_name || ' ' || last_name)
+   LIMIT :candidates)
+)
+SELECT profile.id, ts_rank_cd(profile.search_vector, query.tsquery, 32)
+  + word_similarity(:q, profile.first_name || ' ' || profile.last_name) AS score
+FROM candidates JOIN profile ON profile.id = candidates.id, query
+ORDER BY score DESC, profile.id
+LIMIT :limit
+"""),
+    'skills': text("""
+WITH query AS (SELECT websearch_to_tsquery('english', :q) AS tsquery),
+matches AS (
+  SELECT skill.id FROM skill, query
+  WHERE skill.search_vector @@ query.tsquery LIMIT :candidates
+),
+candidates AS (
+  SELECT id FROM matches
+  UNION
+  (SELECT id FROM skill
+   WHERE (SELECT count(*) FROM matches) < :limit AND :q <% name
+   LIMIT :candidates)
+)
+SELECT skill.id, ts_rank_cd(skill.search_vector, query.tsquery, 32)
+  + word_similarity(:q, skill.name) AS score
+FROM candidates JOIN skill ON skill.id = candidates.id, query
+ORDER BY score DESC, skill.id
+LIMIT :limit
+""")
+}
+
+
+def words(value):
+    return re.findall(r'\w+', value.lower()) if value else []
+
+# Trigrams of a word, padded as pg_trgm does
+def trigrams(word):
+    padded = f'  {word} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def similarity(a, b):
+    return len(a & b) / len(a | b)
+
+
+'''
+SearchIndex
+Inverted index of the words of a set of documents, each made of weighted
+fields. Query words missing from the index match the indexed words with
+similar trigrams instead, weighted by their similarity.
+'''
+class SearchIndex:
+    def __init__(self, documents=()):
+        # word -> {document id: weight}
+        self._postings = {}
+        # trigram -> words containing it
+        self._trigrams = {}
+        for id, fields in documents:
+            self.add(id, fields)
+
+    # Index a document given as (text, weight) fields
+    def add(self, id, fields):
+        for value, weight in fields:
+            for word in words(value):
+                postings = self._postings.get(word)
+                if postings is None:
+                    postings = self._postings[word] = {}
+                    for trigram in trigrams(word):
+                        self._trigrams.setdefault(trigram, set()).add(word)
+                postings[id] = postings.get(id, 0.0) + weight
+
+    # Indexed words matching a query word, with their similarity
+    def _matches(self, word):
+        if word in self._postings:
+            return [(word, 1.0)]
+        query_trigrams = trigrams(word)
+        candidates = set()
+        for trigram in query_trigrams:
+            candidates |= self._trigrams.get(trigram, set())
+        matches = [(candidate, similarity(query_trigrams, trigrams(candidate)))
+            for candidate in candidates]
+        return [(candidate, s) for candidate, s in matches if s >= SEARCH_SIMILARITY_THRESHOLD]
+
+    # Up to limit (id, score) pairs, best first. Scores range from 0 to 1.
+    def search(self, query, limit):
+        scores = {}
+        for word in set(words(query)):
+            for match, weight in self._matches(word):
+                for id, field_weight in self._postings[match].items():
+                    scores[id] = scores.get(id, 0.0) + weight * field_weight
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return [(id, score / (score + 1)) for id, score in ranked[:limit]]
+
+
+'''
+TableIndex
+SearchIndex of the rows of a table, rebuilt when the table changed since it
+was built: rows were added, deleted or updated (which bumps their version).
+'''
+class TableIndex:
+    def __init__(self, model, fields):
+        self.model = model
+        self.fields = fields
+        self._index = None
+        self._fingerprint = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        fingerprint = tuple(db.session.query(func.count(self.model.id), func.max(self.model.id),
+            func.sum(self.model.version)).one())
+        with self._lock:
+            if fingerprint != self._fingerprint:
+                columns = [self.model.id] + [column for column, _ in self.fields]
+                weights = [weight for _, weight in self.fields]
+                self._index = SearchIndex((row[0], list(zip(row[1:], weights)))
+                    for row in db.session.query(*columns))
+                self._fingerprint = fingerprint
+            return self._index
+
+
+fallback_indexes = {
+    'users': TableIndex(Profile, [(Profile.first_name, NAME_WEIGHT), (Profile.last_name, NAME_WEIGHT),
+        (Profile.location, LOCATION_WEIGHT), (Profile.description, DESCRIPTION_WEIGHT)]),
+    'skills': TableIndex(Skill, [(Skill.name, NAME_WEIGHT), (Skill.description, DESCRIPTION_WEIGHT)])
+}
+
+
+# Up to limit (kind, id, score) results for a query over the given kinds
+# (users, skills), best first
+def search_matches(query, kinds, limit):
+    results = []
+    for kind in kinds:
+        if db.engine.dialect.name == 'postgresql':
+            rows = db.session.execute(SEARCH_SQL[kind],
+                {'q': query, 'limit': limit, 'candidates': SEARCH_MAX_CANDIDATES})
+        else:
+            rows = fallback_indexes[kind].get().search(query, limit)
+        results += [(kind, id, score) for id, score in rows]
+    results.sort(key=lambda result: (-result[2], result[0], result[1]))
+    return results[:limit]
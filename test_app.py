@@ -1,16 +1,54 @@
 import os
+import io
+import subprocess
+import sys
+import csv
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
+import tempfile
+import threading
+from datetime import date, datetime
+from werkzeug.http import http_date
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from flask import Flask, g, jsonify, request
 
 from app import create_app
-from models import setup_db, Profile, Skill, Endorsement
-import configparser
+import app as app_module
+from models import db, setup_db, Profile, Skill, Endorsement
+import time
+from auth import JWKSKeyStore, TokenCache
+from importer import NDJSONReader
+from graph import Adjacency, TrustGraph
+import graph as graph_module
+from trust import pagerank, skill_scores, compute_trust_scores
+from recommendations import RecommendationCache
+from search import SearchIndex
+from autocomplete import SkillIndex
+from response_cache import ResponseCache, MemoryBackend, SharedBackend
+from pool import InstrumentedQueuePool, pool_stats, engine_options
+from metrics import Histogram, RequestMetrics, QueryBudgetExceeded, timed_encoder, query_budget
+import metrics as metrics_module
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import Pool
+import sqlite3
+import numpy as np
+import auth
+from benchmarks.load import LocalIssuer, JWKSServer, PERMISSIONS, generate_dataset, skewed_choice, summarize
 
-config = configparser.ConfigParser()
-config.read('config.ini')
-auth_header_admin = {'Authorization': 'bearer '+config['TOKEN']['admin']}
-auth_header_user = {'Authorization': 'bearer '+config['TOKEN']['user']}
+# Tokens minted by a local issuer, whose key set is served by a local JWKS
+# server, as the Auth0 tokens of config.ini have expired
+issuer = LocalIssuer()
+jwks_server = JWKSServer(issuer).start()
+auth.jwks_store.url = jwks_server.url
+auth.jwks_store.clear()
+auth_header_admin = {'Authorization': 'bearer '+issuer.token(PERMISSIONS)}
+auth_header_user = {'Authorization': 'bearer '+issuer.token(['read:skill', 'read:user', 'read:endorsement'])}
+
+# Create the tables once for all tests, as the app leaves the schema to the
+# migrations
+def setUpModule():
+    with create_app().app_context():
+        db.create_all()
 
 class EndorsaTestCase(unittest.TestCase):
     """This class represents the trivia test case"""
@@ -18,16 +56,10 @@ class EndorsaTestCase(unittest.TestCase):
     def setUp(self):
         """Define test variables and initialize app."""
         self.app = create_app()
+        # Routes running more SQL statements than their budget fail the test
+        self.app.config['QUERY_BUDGET_STRICT'] = True
+        self.app.config['PROPAGATE_EXCEPTIONS'] = True
         self.client = self.app.test_client
-        self.database_path = os.environ['DATABASE_URL']
-        setup_db(self.app, self.database_path)
-
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
     
     def tearDown(self):
         """Executed after reach test"""
@@ -51,6 +83,33 @@ class EndorsaTestCase(unittest.TestCase):
 
         self.assertEqual(res.status_code, 404)
 
+    # Get user detail again with its ETag, without changes in between
+    def test_get_user_not_modified_admin(self):
+        res = self.client().post('/users', headers = auth_header_admin,
+        json = {"first_name": "Vincent", "last_name": "Vega"})
+        id = json.loads(res.data)['user']['id']
+        res = self.client().get(f'/users/{id}', headers = auth_header_admin)
+        etag = res.headers['ETag']
+        res = self.client().get(f'/users/{id}', headers = dict(auth_header_admin, **{'If-None-Match': etag}))
+        self.client().delete(f'/users/{id}', headers = auth_header_admin)
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+
+    # Error 404 as no users 1000 and 2000 are found for the trust path
+    def test_get_user_1000_path_admin_404(self):
+        res = self.client().get('/users/1000/path/2000', headers = auth_header_admin)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+
+    # Error 422 as the skill to get recommendations for is missing
+    def test_get_user_recommendations_admin_422(self):
+        res = self.client().get('/users/1/recommendations', headers = auth_header_admin)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+
     # Post user
     def test_post_user_admin(self):
         res = self.client().post('/users', headers = auth_header_admin,
@@ -81,6 +140,66 @@ class EndorsaTestCase(unittest.TestCase):
 
         self.assertEqual(res.status_code, 422)
     
+    # Batch with one valid and one invalid user
+    def test_post_users_batch_admin(self):
+        res = self.client().post('/users/batch', headers = auth_header_admin,
+        json = [
+            {
+                "first_name": "Vincent",
+                "last_name": "Vega"
+            },
+            {
+                "first_name": "Jules"
+            }
+        ])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['num_created'], 1)
+        self.assertEqual(data['num_failed'], 1)
+        self.assertTrue(data['results'][0]['success'])
+        self.assertFalse(data['results'][1]['success'])
+
+    # Batch with optional fields of the wrong type, each rejected on its own
+    def test_post_users_batch_types_admin(self):
+        res = self.client().post('/users/batch', headers = auth_header_admin,
+        json = [
+            {"first_name": "Vincent", "last_name": "Vega", "location": "California",
+                "description": "Freelance Gangster", "contact": "123456789"},
+            {"first_name": "Jules", "last_name": "Winnfield", "location": ["Inglewood"]},
+            {"first_name": "Jules", "last_name": "Winnfield", "description": 42},
+            {"first_name": "Jules", "last_name": "Winnfield", "contact": True},
+            {"first_name": "Jules", "last_name": "Winnfield", "contact": 1.5},
+            {"first_name": "Jules", "last_name": "Winnfield", "contact": 2**40}
+        ])
+        data = json.loads(res.data)
+        for result in data['results']:
+            if result['success']:
+                self.client().delete(f'/users/{result["id"]}', headers = auth_header_admin)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['num_created'], 1)
+        self.assertEqual([result.get('error') for result in data['results']], [None,
+            'location must be a string', 'description must be a string', 'contact must be an integer',
+            'contact must be an integer', 'contact is out of range'])
+
+    def test_post_skills_batch_types_admin(self):
+        res = self.client().post('/skills/batch', headers = auth_header_admin,
+        json = [{"name": "Dancing", "description": {"style": "twist"}}])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['num_created'], 0)
+        self.assertEqual(data['results'][0]['error'], 'description must be a string')
+
+    # Error 422 as batch is not a JSON array
+    def test_post_users_batch_admin_422(self):
+        res = self.client().post('/users/batch', headers = auth_header_admin,
+        json = {"first_name": "Vincent", "last_name": "Vega"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+
     # Error 404 as no user 1000 is found
     def test_get_user_1000_admin(self):
         res = self.client().get('/users/1000', headers = auth_header_admin)
@@ -88,6 +207,13 @@ class EndorsaTestCase(unittest.TestCase):
 
         self.assertEqual(res.status_code, 404)
 
+    # Error 422 due to invalid pagination limit
+    def test_get_users_limit_admin_422(self):
+        res = self.client().get('/users?limit=0', headers = auth_header_admin)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+
     # ----SKILLS----
 
     # Delete all skills
@@ -135,6 +261,27 @@ class EndorsaTestCase(unittest.TestCase):
 
         self.assertEqual(res.status_code, 404)
 
+    # Error 404 as no skill 1000 is found for the leaderboard
+    def test_get_skill_1000_top_admin_404(self):
+        res = self.client().get('/skills/1000/top', headers = auth_header_admin)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+
+    # Error 422 due to invalid leaderboard limit
+    def test_get_skill_top_limit_admin_422(self):
+        res = self.client().get('/skills/1/top?limit=0', headers = auth_header_admin)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+
+    # Error 422 due to invalid leaderboard sort
+    def test_get_skill_top_sort_admin_422(self):
+        res = self.client().get('/skills/1/top?sort=name', headers = auth_header_admin)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+
     # ----ENDORSEMENTS----
 
     # Delete all endorsements
@@ -151,6 +298,36 @@ class EndorsaTestCase(unittest.TestCase):
 
         self.assertEqual(res.status_code, 404)
 
+    # Error 422 due to invalid pagination cursor
+    def test_get_endorsements_after_admin_422(self):
+        res = self.client().get('/endorsements?after=abc', headers = auth_header_admin)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+
+    # Batch endorsements referencing non-existing users and skills
+    def test_post_endorsements_batch_admin(self):
+        res = self.client().post('/endorsements/batch', headers = auth_header_admin,
+        json = [
+            {
+                "giver_id": "1000",
+                "receiver_id": "2000",
+                "skill_id": "1000"
+            }
+        ])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['num_created'], 0)
+        self.assertEqual(data['results'][0]['error'], 'user not found')
+
+    # Error 422 due to unsupported streaming format
+    def test_get_endorsements_stream_admin_422(self):
+        res = self.client().get('/endorsements?stream=xml', headers = auth_header_admin)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+
     # Error 404 due to non-existing users and skills
     def test_post_endorsement_admin_422(self):
         res = self.client().post('/endorsements', headers = auth_header_admin,
@@ -197,6 +374,14 @@ class EndorsaTestCase(unittest.TestCase):
 
         self.assertEqual(res.status_code, 401)
 
+    # Error 401 due to no authorization to edit
+    def test_post_users_batch_user_401(self):
+        res = self.client().post('/users/batch', headers = auth_header_user,
+        json = [{"first_name": "Vincent", "last_name": "Vega"}])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 401)
+
     # ----SKILLS----
 
     # Error 401 due to no authorization to edit
@@ -255,6 +440,1399 @@ class EndorsaTestCase(unittest.TestCase):
 
         self.assertEqual(res.status_code, 401)
 
+
+class APITestCase(unittest.TestCase):
+    """Base of the test cases calling the API, with helpers creating the
+    users, skills and endorsements each test needs and deleting them after"""
+
+    def setUp(self):
+        self.app = create_app()
+        # Routes running more SQL statements than their budget fail the test
+        self.app.config['QUERY_BUDGET_STRICT'] = True
+        self.app.config['PROPAGATE_EXCEPTIONS'] = True
+        self.client = self.app.test_client
+        self.created = []
+
+    # Delete in reverse order, so endorsements go before their users and
+    # skills, as SQLite does not cascade the deletes
+    def tearDown(self):
+        for path in reversed(self.created):
+            self.delete(path)
+
+    # Delete after the test a row created other than through create
+    def track(self, collection, id):
+        self.created.append(f'/{collection}/{id}')
+
+    # Create a row through the API, returning its id
+    def create(self, collection, body):
+        res = self.client().post(f'/{collection}', headers = auth_header_admin, json = body)
+        self.assertEqual(res.status_code, 200)
+        id = json.loads(res.data)[collection[:-1]]['id']
+        self.track(collection, id)
+        return id
+
+    def create_user(self, first_name, last_name, **fields):
+        return self.create('users', dict(fields, first_name=first_name, last_name=last_name))
+
+    def create_skill(self, name, **fields):
+        return self.create('skills', dict(fields, name=name))
+
+    def create_endorsement(self, giver_id, receiver_id, skill_id):
+        return self.create('endorsements', {"giver_id": giver_id, "receiver_id": receiver_id,
+            "skill_id": skill_id})
+
+    def get(self, path, headers=auth_header_user):
+        return self.client().get(path, headers = headers)
+
+    def delete(self, path):
+        return self.client().delete(path, headers = auth_header_admin)
+
+
+class PaginationTestCase(APITestCase):
+    """Tests for walking the listings page by page with next_cursor"""
+
+    def setUp(self):
+        super().setUp()
+        self.users = [self.create_user("Jimmie", f"Dimmick{i}") for i in range(7)]
+        self.skill = self.create_skill("Coffee")
+        self.endorsements = [self.create_endorsement(giver, self.users[0], self.skill)
+            for giver in self.users[1:]]
+
+    # Follow next_cursor from right before the given ids, returning the ids
+    # of each page
+    def walk(self, path, collection, ids, limit):
+        pages = []
+        cursor = ids[0] - 1
+        while cursor is not None:
+            res = self.get(f'{path}?limit={limit}&after={cursor}')
+            self.assertEqual(res.status_code, 200)
+            data = json.loads(res.data)
+            pages.append([row['id'] for row in data[collection]])
+            self.assertEqual(data['next_cursor'], pages[-1][-1] if data['next_cursor'] else None)
+            cursor = data['next_cursor']
+        return pages
+
+    def test_walk_pages(self):
+        pages = self.walk('/users', 'users', self.users, 3)
+
+        self.assertEqual(pages, [self.users[:3], self.users[3:6], self.users[6:]])
+
+        pages = self.walk('/endorsements', 'endorsements', self.endorsements, 4)
+
+        self.assertEqual(pages, [self.endorsements[:4], self.endorsements[4:]])
+
+    # A page ending exactly on the last row has no cursor, without an extra
+    # empty page to fetch
+    def test_last_page_without_cursor(self):
+        pages = self.walk('/endorsements', 'endorsements', self.endorsements, 3)
+
+        self.assertEqual(pages, [self.endorsements[:3], self.endorsements[3:]])
+
+        res = self.get(f'/users?limit=3&after={self.users[3]}')
+        data = json.loads(res.data)
+
+        self.assertEqual([user['id'] for user in data['users']], self.users[4:])
+        self.assertIsNone(data['next_cursor'])
+
+
+class StreamTestCase(APITestCase):
+    """Tests for the streamed JSON and NDJSON exports of the listings"""
+
+    def setUp(self):
+        super().setUp()
+        # Small batches, so the rows span several chunks
+        self.batch_size = app_module.STREAM_BATCH_SIZE
+        app_module.STREAM_BATCH_SIZE = 2
+        self.users = [self.create_user("Honey", f"Bunny{i}") for i in range(5)]
+        self.skill = self.create_skill("Robbing")
+        self.endorsements = [self.create_endorsement(giver, self.users[0], self.skill)
+            for giver in self.users[1:]]
+
+    def tearDown(self):
+        app_module.STREAM_BATCH_SIZE = self.batch_size
+        super().tearDown()
+
+    def test_stream_json(self):
+        res = self.get(f'/users?stream=json&after={self.users[0] - 1}')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/json')
+        self.assertEqual([user['id'] for user in data['users']], self.users)
+        self.assertEqual(data['num_users'], 5)
+        self.assertEqual(data['users'][4]['last_name'], 'Bunny4')
+
+    def test_stream_ndjson(self):
+        res = self.get(f'/endorsements?stream=ndjson&after={self.endorsements[0] - 1}')
+        lines = res.data.decode().splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual([json.loads(line)['id'] for line in lines], self.endorsements)
+        self.assertEqual(json.loads(lines[0])['giver_id'], self.users[1])
+
+    # Only the rows after the cursor are streamed, and the count follows them
+    def test_stream_after(self):
+        res = self.get(f'/users?stream=json&after={self.users[2]}')
+        data = json.loads(res.data)
+
+        self.assertEqual([user['id'] for user in data['users']], self.users[3:])
+        self.assertEqual(data['num_users'], 2)
+
+        res = self.get(f'/skills?stream=ndjson&after={self.skill - 1}')
+
+        self.assertEqual([json.loads(line)['id'] for line in res.data.decode().splitlines()], [self.skill])
+
+    def test_stream_404(self):
+        res = self.get(f'/users?stream=json&after={self.users[-1]}')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(self.get(f'/endorsements?stream=ndjson&after={self.endorsements[-1]}').status_code, 404)
+
+
+class UserProfileJSONTestCase(APITestCase):
+    """Tests that the user detail built by PostgreSQL matches the one built
+    from the ORM"""
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            if db.engine.dialect.name != 'postgresql':
+                self.skipTest('The user detail is only built by the database on PostgreSQL')
+        self.users = [self.create_user("Vincent", "Vega", location="Los Angeles",
+            description="Freelance Gangster", contact=123456789), self.create_user("Jules", "Winnfield")]
+        self.skill = self.create_skill("Talking")
+        self.create_endorsement(self.users[0], self.users[1], self.skill)
+        self.create_endorsement(self.users[1], self.users[0], self.skill)
+        with self.app.app_context():
+            Profile.query.get(self.users[0]).trust_score = 0.1 + 0.2
+            db.session.commit()
+
+    # Decoded with the type of each number, so 0 and 0.0 differ
+    @staticmethod
+    def decode(res):
+        return json.loads(res.data, parse_int=lambda s: ('int', int(s)), parse_float=lambda s: ('float', float(s)))
+
+    def test_same_detail(self):
+        fields = ','.join(app_module.USER_DETAIL_FIELDS)
+        for id in self.users:
+            res = self.get(f'/users/{id}')
+            orm = self.get(f'/users/{id}?fields={fields}')
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(self.decode(res), self.decode(orm))
+            self.assertEqual(json.loads(res.data)['endorsements_given'][0]['creation_date'],
+                http_date(datetime.combine(date.today(), datetime.min.time())))
+
+
+class SearchTestCase(APITestCase):
+    """Tests for GET /search, on PostgreSQL or on the in-memory index"""
+
+    def setUp(self):
+        super().setUp()
+        self.create_user("Ada", "Lovelace", location="London", description="Mathematician and writer")
+        self.create_user("Alan", "Turing", location="Manchester",
+            description="Mathematician, computing pioneer")
+        self.create_skill("Mathematics", description="Proofs and analysis")
+
+    def search(self, query_string):
+        return self.get('/search?' + query_string)
+
+    # Names rank above descriptions
+    def test_search_ranked(self):
+        res = self.search('q=lovelace')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['results'][0]['type'], 'user')
+        self.assertEqual(data['results'][0]['user']['last_name'], 'Lovelace')
+
+    def test_search_typo(self):
+        res = self.search('q=Lovelce')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['results'][0]['user']['last_name'], 'Lovelace')
+
+    def test_search_skills_only(self):
+        res = self.search('q=mathematics&type=skills')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual({result['type'] for result in data['results']}, {'skill'})
+        self.assertEqual(data['results'][0]['skill']['name'], 'Mathematics')
+
+    # Pages follow the ranking, with the position of the next result as cursor
+    def test_search_paginated(self):
+        everything = json.loads(self.search('q=mathematician&type=users').data)['results']
+        first = json.loads(self.search('q=mathematician&type=users&limit=1').data)
+        second = json.loads(self.search(f'q=mathematician&type=users&limit=1&after={first["next_cursor"]}').data)
+
+        self.assertEqual(first['next_cursor'], 1)
+        self.assertEqual(first['results'] + second['results'], everything[:2])
+
+    def test_search_422(self):
+        self.assertEqual(self.search('q=').status_code, 422)
+        self.assertEqual(self.search('q=ada&type=endorsements').status_code, 422)
+
+    def test_search_404(self):
+        self.assertEqual(self.search('q=xylophonist').status_code, 404)
+
+    def test_search_index(self):
+        index = SearchIndex([
+            (1, [('Python', 1.0), ('Programming language', 0.2)]),
+            (2, [('Snake handling', 1.0), ('Python and cobra care', 0.2)])
+        ])
+
+        self.assertEqual([id for id, _ in index.search('python', 10)], [1, 2])
+        self.assertEqual([id for id, _ in index.search('pythn', 10)], [1, 2])
+        self.assertEqual(index.search('java', 10), [])
+
+class FieldsTestCase(APITestCase):
+    """Tests for sparse fieldsets on the read routes"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user("Mia", "Wallace", location="Los Angeles", description="Actress")
+        self.skill = self.create_skill("Dancing", description="Twist")
+        self.endorsement = self.create_endorsement(self.user, self.user, self.skill)
+
+    # Response of a GET, and the SQL statements it ran
+    def get_with_statements(self, path):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        with self.app.app_context():
+            engine = db.get_engine(self.app)
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            res = self.get(path)
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+        return res, statements
+
+    # Only the fields requested are selected, with the id
+    def test_get_users_fields(self):
+        res, statements = self.get_with_statements(f'/users?fields=first_name,last_name&after={self.user - 1}&limit=1')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['users'], [{'id': self.user, 'first_name': 'Mia', 'last_name': 'Wallace'}])
+        self.assertNotIn('description', statements[-1])
+
+    def test_get_users_fields_422(self):
+        self.assertEqual(self.get('/users?fields=first_name,password').status_code, 422)
+        self.assertEqual(self.get('/users?fields=').status_code, 422)
+
+    def test_get_skills_fields(self):
+        res = self.get(f'/skills?fields=name&stream=ndjson&after={self.skill - 1}')
+        rows = [json.loads(line) for line in res.data.decode('utf-8').splitlines()]
+
+        self.assertEqual(rows, [{'id': self.skill, 'name': 'Dancing'}])
+
+    # Users and skills are only joined when their fields are requested
+    def test_get_endorsements_fields(self):
+        res, statements = self.get_with_statements('/endorsements?fields=giver_id,name')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(data['endorsements'][-1]), {'id', 'giver_id', 'name'})
+        self.assertNotIn('profile', statements[-1])
+
+    def test_user_profile_fields(self):
+        res, statements = self.get_with_statements(f'/users/{self.user}?fields=first_name,endorsements_received')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['user'], {'id': self.user, 'first_name': 'Mia'})
+        self.assertEqual(data['endorsements_received'][0]['name'], 'Dancing')
+        self.assertNotIn('endorsements_given', data)
+        self.assertEqual(len(statements), 3)
+
+    def test_skill_profile_fields(self):
+        res, statements = self.get_with_statements(f'/skills/{self.skill}?fields=name')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data, {'success': True, 'skill': {'id': self.skill, 'name': 'Dancing'}})
+        self.assertEqual(len(statements), 2)
+
+
+class BatchGetTestCase(APITestCase):
+    """Tests for GET /users?ids= and GET /skills?ids="""
+
+    def setUp(self):
+        super().setUp()
+        self.users = [self.create_user("Butch", f"Coolidge{i}") for i in range(3)]
+        self.skill = self.create_skill("Boxing", description="Prize fights")
+        for giver in self.users[1:]:
+            self.create_endorsement(giver, self.users[0], self.skill)
+
+    # Users come in the order requested, once each, with the missing ids
+    def test_get_users_by_ids(self):
+        missing = self.users[-1] + 1000
+        ids = [self.users[2], missing, self.users[0], self.users[2]]
+        res = self.get('/users?ids=' + ','.join(map(str, ids)))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([user['id'] for user in data['users']], [self.users[2], self.users[0]])
+        self.assertEqual(data['num_users'], 2)
+        self.assertEqual(data['missing_ids'], [missing])
+        self.assertEqual(data['users'][1]['last_name'], 'Coolidge0')
+
+    def test_get_users_by_ids_summaries(self):
+        res = self.get(f'/users?ids={self.users[0]},{self.users[1]}&include=endorsements&fields=first_name')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['users'][0], {'id': self.users[0], 'first_name': 'Butch', 'endorsements': [
+            {'skill_id': self.skill, 'name': 'Boxing', 'num_endorsements': 2}]})
+        self.assertEqual(data['users'][1]['endorsements'], [])
+
+    def test_get_skills_by_ids_summaries(self):
+        res = self.get(f'/skills?ids={self.skill}&include=endorsements')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['skills'][0]['name'], 'Boxing')
+        self.assertEqual(data['skills'][0]['endorsements'], [{'receiver_id': self.users[0],
+            'first_name': 'Butch', 'last_name': 'Coolidge0', 'num_endorsements': 2}])
+
+    def test_get_by_ids_422(self):
+        self.assertEqual(self.get('/users?ids=1,two').status_code, 422)
+        self.assertEqual(self.get('/users?ids=').status_code, 422)
+        self.assertEqual(self.get('/users?ids=1&after=1').status_code, 422)
+        self.assertEqual(self.get(f'/skills?ids={self.skill}&include=everything').status_code, 422)
+
+    def test_get_by_ids_404(self):
+        self.assertEqual(self.get(f'/skills?ids={self.skill + 1000}').status_code, 404)
+
+
+class EndorsementCounterTestCase(APITestCase):
+    """Tests for the endorsement counters kept on users and skills"""
+
+    def setUp(self):
+        super().setUp()
+        self.users = [self.create_user("Mia", f"Wallace{i}") for i in range(3)]
+        self.skills = [self.create_skill(name) for name in ('Dancing', 'Acting')]
+
+    def endorse(self, giver, receiver, skill):
+        return self.create_endorsement(self.users[giver], self.users[receiver], self.skills[skill])
+
+    def received(self, user):
+        return json.loads(self.get(f'/users/{self.users[user]}').data)['user']['num_endorsements_received']
+
+    def skill_endorsements(self, skill):
+        return json.loads(self.get(f'/skills/{self.skills[skill]}').data)['skill']['num_endorsements']
+
+    def test_counters_on_create(self):
+        self.endorse(1, 0, 0)
+        self.endorse(2, 0, 0)
+        self.endorse(0, 1, 1)
+
+        self.assertEqual([self.received(i) for i in range(3)], [2, 1, 0])
+        self.assertEqual([self.skill_endorsements(i) for i in range(2)], [2, 1])
+
+    def test_counters_on_delete(self):
+        id = self.endorse(1, 0, 0)
+        self.endorse(2, 0, 0)
+        res = self.delete(f'/endorsements/{id}')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.received(0), 1)
+        self.assertEqual(self.skill_endorsements(0), 1)
+
+    # Deleting a user removes the endorsements it gave through the foreign
+    # key cascade, which the counters follow
+    def test_counters_on_cascade_delete(self):
+        with self.app.app_context():
+            if db.engine.dialect.name == 'sqlite':
+                self.skipTest('SQLite does not enforce the foreign key cascades')
+        self.endorse(1, 0, 0)
+        self.endorse(1, 0, 1)
+        self.endorse(2, 0, 0)
+        res = self.delete(f'/users/{self.users[1]}')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.received(0), 1)
+        self.assertEqual([self.skill_endorsements(i) for i in range(2)], [1, 0])
+
+        # Deleting a skill updates the counters of the users endorsed for it
+        res = self.delete(f'/skills/{self.skills[0]}')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.received(0), 0)
+
+
+class SkillTopTestCase(APITestCase):
+    """Tests for the ranking of GET /skills/<id>/top"""
+
+    def setUp(self):
+        super().setUp()
+        self.users = [self.create_user("Jules", f"Winnfield{i}") for i in range(5)]
+        self.skill = self.create_skill("Preaching")
+        self.endorsements = []
+
+    # Endorse each receiver by the given givers, optionally at a set date
+    def endorse(self, receiver, givers, creation_date=None):
+        for giver in givers:
+            if creation_date == None:
+                self.endorsements.append(self.create_endorsement(self.users[giver],
+                    self.users[receiver], self.skill))
+                continue
+            # Endorsements only record the day they were given, so the ones
+            # to tell apart by recency are inserted with an explicit date
+            with self.app.app_context():
+                endorsement = Endorsement(self.users[giver], self.users[receiver], self.skill)
+                endorsement.creation_date = creation_date
+                endorsement.insert()
+                self.track('endorsements', endorsement.id)
+                self.endorsements.append(endorsement.id)
+
+    def top(self):
+        res = self.get(f'/skills/{self.skill}/top')
+        self.assertEqual(res.status_code, 200)
+        return [(self.users.index(e['receiver_id']), e['num_endorsements'])
+            for e in json.loads(res.data)['top']]
+
+    def test_top_order(self):
+        self.endorse(0, [1, 2, 3])
+        self.endorse(1, [0])
+        self.endorse(2, [0, 1])
+
+        self.assertEqual(self.top(), [(0, 3), (2, 2), (1, 1)])
+
+    # Ties in the number of endorsements go to the most recently endorsed
+    # user, whatever the order of their ids
+    def test_top_recency_tie_break(self):
+        self.endorse(2, [0], datetime(2020, 1, 1))
+        self.endorse(1, [0], datetime(2020, 6, 1))
+        self.endorse(3, [0], datetime(2020, 3, 1))
+
+        self.assertEqual(self.top(), [(1, 1), (3, 1), (2, 1)])
+
+    def test_top_after_delete(self):
+        self.endorse(0, [2, 3, 4])
+        self.endorse(1, [2, 3])
+        for id in self.endorsements[:2]:
+            self.delete(f'/endorsements/{id}')
+
+        self.assertEqual(self.top(), [(1, 2), (0, 1)])
+
+        # Receivers left without endorsements drop out of the ranking
+        self.delete(f'/endorsements/{self.endorsements[2]}')
+
+        self.assertEqual(self.top(), [(1, 2)])
+
+
+class ETagTestCase(APITestCase):
+    """Tests that the ETags of user and skill details follow their changes"""
+
+    def setUp(self):
+        super().setUp()
+        self.giver = self.create_user("Marsellus", "Wallace")
+        self.receiver = self.create_user("Winston", "Wolfe")
+        self.skill = self.create_skill("Cleaning")
+
+    def endorse(self):
+        return self.create_endorsement(self.giver, self.receiver, self.skill)
+
+    def etags(self):
+        return [self.get(path).headers['ETag']
+            for path in (f'/users/{self.giver}', f'/users/{self.receiver}', f'/skills/{self.skill}')]
+
+    # A client holding the previous ETag gets the new detail
+    def assertChanged(self, before):
+        after = self.etags()
+        for path, old, new in zip(('giver', 'receiver', 'skill'), before, after):
+            self.assertNotEqual(old, new, path)
+        res = self.get(f'/users/{self.giver}', headers = dict(auth_header_user, **{'If-None-Match': before[0]}))
+        self.assertEqual(res.status_code, 200)
+
+    def test_etags_after_endorsement(self):
+        before = self.etags()
+        id = self.endorse()
+
+        self.assertChanged(before)
+
+        before = self.etags()
+        self.delete(f'/endorsements/{id}')
+
+        self.assertChanged(before)
+
+    def test_etags_after_skill_rename(self):
+        self.endorse()
+        before = self.etags()
+        res = self.client().patch(f'/skills/{self.skill}', headers = auth_header_admin, json = {"name": "Fixing"})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertChanged(before)
+
+    def test_etags_after_user_rename(self):
+        self.endorse()
+        for id in (self.giver, self.receiver):
+            before = self.etags()
+            res = self.client().patch(f'/users/{id}', headers = auth_header_admin, json = {"first_name": "Butch"})
+
+            self.assertEqual(res.status_code, 200)
+            self.assertChanged(before)
+
+
+class AutocompleteTestCase(unittest.TestCase):
+    """Tests for the skill name prefix index and GET /skills/autocomplete"""
+
+    def setUp(self):
+        self.index = SkillIndex()
+        self.index.load([(1, 'Python', 5), (2, 'Pyramid schemes', 9), (3, 'Machine learning', 2),
+            (4, 'Résumé writing', 0), (5, 'Java', 7)])
+
+    def names(self, prefix, limit=10):
+        return [name for _, name, _ in self.index.suggest(prefix, limit)]
+
+    # Most endorsed first, matching the start of any word, without accents
+    def test_suggest(self):
+        self.assertEqual(self.names('py'), ['Pyramid schemes', 'Python'])
+        self.assertEqual(self.names('PY', 1), ['Pyramid schemes'])
+        self.assertEqual(self.names('learn'), ['Machine learning'])
+        self.assertEqual(self.names('resume'), ['Résumé writing'])
+        self.assertEqual(self.names('achine'), [])
+        self.assertEqual(self.index.suggest('jav', 10), [(5, 'Java', 7)])
+
+    def test_add_rename_remove(self):
+        self.index.add(6, 'Pytest', 20)
+        self.assertEqual(self.names('py'), ['Pytest', 'Pyramid schemes', 'Python'])
+
+        self.index.add(6, 'Unit testing', 20)
+        self.assertEqual(self.names('py'), ['Pyramid schemes', 'Python'])
+        self.assertEqual(self.names('test'), ['Unit testing'])
+
+        self.index.remove(2)
+        self.assertEqual(self.names('py'), ['Python'])
+        self.assertEqual(self.index.stats()['skills'], 5)
+
+    # Prefixes matching many skills keep their best suggestions until a change
+    def test_suggest_many(self):
+        self.index.load([(id, f'Skill {id}', id % 50) for id in range(1, 1001)])
+
+        self.assertEqual(self.names('skill', 3), ['Skill 149', 'Skill 199', 'Skill 249'])
+        self.assertEqual(self.index.stats()['cached_prefixes'], 1)
+
+        self.index.add(1001, 'Skillet cooking', 100)
+        self.assertEqual(self.names('skill', 1), ['Skillet cooking'])
+
+    def test_autocomplete_route(self):
+        app = create_app()
+        client = app.test_client()
+        res = client.post('/skills', headers = auth_header_admin,
+            json = {"name": "Quantum computing", "description": "Qubits"})
+        skill_id = json.loads(res.data)['skill']['id']
+        try:
+            res = client.get('/skills/autocomplete?q=quant', headers = auth_header_user)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['suggestions'][0]['id'], skill_id)
+
+            client.patch(f'/skills/{skill_id}', headers = auth_header_admin,
+                json = {"name": "Quantum cryptography"})
+            data = json.loads(client.get('/skills/autocomplete?q=quantum cr', headers = auth_header_user).data)
+            self.assertEqual(data['suggestions'][0]['name'], 'Quantum cryptography')
+
+            self.assertEqual(client.get('/skills/autocomplete?q=', headers = auth_header_user).status_code, 422)
+        finally:
+            client.delete(f'/skills/{skill_id}', headers = auth_header_admin)
+
+        res = client.get('/skills/autocomplete?q=quant', headers = auth_header_user)
+        self.assertEqual(res.status_code, 404)
+
+
+class JWKSKeyStoreTestCase(unittest.TestCase):
+    """Tests for the cached JWKS key store, using a local JWKS file"""
+
+    def setUp(self):
+        self.jwks_file = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+        self.write_keys(['key-1'])
+        self.store = JWKSKeyStore('file://' + self.jwks_file.name,
+            ttl=600, min_refresh_interval=30)
+
+    def tearDown(self):
+        os.unlink(self.jwks_file.name)
+
+    def write_keys(self, kids):
+        with open(self.jwks_file.name, 'w') as f:
+            json.dump({'keys': [
+                {'kty': 'RSA', 'kid': kid, 'use': 'sig', 'n': 'abc', 'e': 'AQAB'}
+                for kid in kids]}, f)
+
+    # Keys are fetched once and then served from memory
+    def test_keys_are_cached(self):
+        self.assertEqual(self.store.get_key('key-1')['kid'], 'key-1')
+        self.assertEqual(self.store.get_key('key-1')['kid'], 'key-1')
+        self.assertEqual(self.store.fetch_count, 1)
+
+    # Unknown kid triggers a single refetch, then is rate limited
+    def test_unknown_kid_refetch(self):
+        self.store.get_key('key-1')
+        self.write_keys(['key-1', 'key-2'])
+        self.store._last_fetch -= 60
+        self.assertEqual(self.store.get_key('key-2')['kid'], 'key-2')
+        self.assertIsNone(self.store.get_key('key-3'))
+        self.assertIsNone(self.store.get_key('key-3'))
+        self.assertEqual(self.store.fetch_count, 2)
+
+    def test_unknown_kid_rate_limited(self):
+        self.store.get_key('key-1')
+        self.write_keys(['key-1', 'key-2'])
+        self.assertIsNone(self.store.get_key('key-2'))
+        self.assertEqual(self.store.fetch_count, 1)
+
+    # Expired key set is fetched again
+    def test_expired_keys_refetched(self):
+        self.store.get_key('key-1')
+        self.store._expires_at = 0
+        self.store.get_key('key-1')
+        self.assertEqual(self.store.fetch_count, 2)
+
+    # TTL taken from the Cache-Control header of a stub HTTP server
+    def test_http_cache_control_ttl(self):
+        class JWKSHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps({'keys': [
+                    {'kty': 'RSA', 'kid': 'key-1', 'use': 'sig', 'n': 'abc', 'e': 'AQAB'}
+                ]}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Cache-Control', 'public, max-age=1234')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), JWKSHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            store = JWKSKeyStore(f'http://127.0.0.1:{server.server_port}/jwks.json')
+            self.assertEqual(store.get_key('key-1')['kid'], 'key-1')
+            self.assertAlmostEqual(store._expires_at - store._last_fetch, 1234)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    # Background refresh is not retried more often than min_refresh_interval
+    def test_background_refresh_rate_limited(self):
+        self.store.get_key('key-1')
+        self.store._expires_at = self.store._last_fetch + 10
+        self.store.get_key('key-1')
+        self.assertEqual(self.store.fetch_count, 1)
+
+    def test_cache_control_max_age(self):
+        self.assertEqual(JWKSKeyStore._max_age('public, max-age=15177'), 15177)
+        self.assertIsNone(JWKSKeyStore._max_age('no-store'))
+        self.assertIsNone(JWKSKeyStore._max_age(None))
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """Tests for the verified token cache"""
+
+    def setUp(self):
+        self.cache = TokenCache(maxsize=2)
+
+    def test_hit_and_miss_counters(self):
+        payload = {'permissions': ['read:user'], 'exp': time.time() + 60}
+        self.assertIsNone(self.cache.get('token-a'))
+        self.cache.set('token-a', payload)
+        self.assertEqual(self.cache.get('token-a'), payload)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    # The counters of the process are shown at /cache/stats and /metrics
+    def test_stats_routes(self):
+        client = create_app().test_client()
+        client.get('/cache/stats', headers = auth_header_user)
+        stats = json.loads(client.get('/cache/stats', headers = auth_header_user).data)['token_cache']
+        lines = client.get('/metrics').data.decode().splitlines()
+
+        self.assertGreaterEqual(stats['hits'], 1)
+        self.assertIn(f'endorsa_token_cache_hits_total {auth.token_cache.stats()["hits"]}', lines)
+        self.assertIn(f'endorsa_token_cache_misses_total {auth.token_cache.stats()["misses"]}', lines)
+
+    # Entries are dropped once the token expires
+    def test_expired_token_not_served(self):
+        self.cache.set('token-a', {'exp': time.time() - 1})
+        self.assertIsNone(self.cache.get('token-a'))
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    # Tokens without exp are never cached
+    def test_token_without_exp_not_cached(self):
+        self.cache.set('token-a', {'permissions': []})
+        self.assertIsNone(self.cache.get('token-a'))
+
+    # Least recently used entry is evicted first
+    def test_lru_eviction(self):
+        exp = time.time() + 60
+        self.cache.set('token-a', {'exp': exp})
+        self.cache.set('token-b', {'exp': exp})
+        self.cache.get('token-a')
+        self.cache.set('token-c', {'exp': exp})
+        self.assertIsNotNone(self.cache.get('token-a'))
+        self.assertIsNone(self.cache.get('token-b'))
+        self.assertIsNotNone(self.cache.get('token-c'))
+
+
+class RecommendationCacheTestCase(unittest.TestCase):
+    """Tests for the per-user recommendations cache"""
+
+    def setUp(self):
+        self.cache = RecommendationCache(maxsize=2, ttl=60)
+
+    # Entries of a user are dropped for every skill, other users are kept
+    def test_invalidate_user(self):
+        self.cache.set(1, 10, [{'id': 3}])
+        self.cache.set(1, 20, [{'id': 4}])
+        self.cache.set(2, 10, [{'id': 5}])
+        self.cache.invalidate(1)
+        self.assertIsNone(self.cache.get(1, 10))
+        self.assertIsNone(self.cache.get(1, 20))
+        self.assertEqual(self.cache.get(2, 10), [{'id': 5}])
+
+    def test_expired_entry_not_served(self):
+        self.cache.ttl = 0
+        self.cache.set(1, 10, [])
+        self.assertIsNone(self.cache.get(1, 10))
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    # Least recently used user is evicted first
+    def test_lru_eviction(self):
+        self.cache.set(1, 10, [])
+        self.cache.set(2, 10, [])
+        self.cache.get(1, 10)
+        self.cache.set(3, 10, [])
+        self.assertIsNotNone(self.cache.get(1, 10))
+        self.assertIsNone(self.cache.get(2, 10))
+        self.assertIsNotNone(self.cache.get(3, 10))
+
+    # With shared tag versions, an endorsement written through another
+    # process drops the entries of its giver and of its skill
+    def test_shared_tag_versions(self):
+        shared = ResponseCache(SharedBackend(StandInRedis()))
+        caches = [RecommendationCache(maxsize=2, ttl=60, tag_versions=shared.tag_versions) for _ in range(2)]
+        for cache in caches:
+            cache.set(1, 10, [{'id': 3}], cache.versions(1, 10))
+            cache.set(2, 20, [{'id': 4}], cache.versions(2, 20))
+
+        # The other process bumps the tags of an endorsement by user 5 of
+        # user 6 for skill 20
+        ResponseCache(shared.backend).invalidate(['user:5', 'user:6', 'skill:20'])
+
+        self.assertEqual(caches[0].get(1, 10, caches[0].versions(1, 10)), [{'id': 3}])
+        self.assertIsNone(caches[0].get(2, 20, caches[0].versions(2, 20)))
+        shared.invalidate(['user:1'])
+        self.assertIsNone(caches[1].get(1, 10, caches[1].versions(1, 10)))
+
+
+class StandInRedis:
+    """In-memory stand-in for the Redis client of the shared cache backend"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def incr(self, key):
+        self.data[key] = int(self.data.get(key, 0)) + 1
+        return self.data[key]
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    """Tests for the response cache, on a minimal app"""
+
+    def setUp(self):
+        self.cache = ResponseCache(MemoryBackend(maxsize=10), ttl=60)
+        self.calls = 0
+        app = Flask(__name__)
+
+        @self.cache.cached(lambda id: [f'item:{id}'])
+        def view(payload, id):
+            self.calls += 1
+            return jsonify({'id': id, 'calls': self.calls})
+
+        # Permissions come from the Authorization header in place of a token
+        # The replica read from, if any, comes from a header
+        @app.route('/items/<id>')
+        def item(id):
+            g.read_replica = request.headers.get('Replica')
+            return view({'permissions': request.headers['Authorization'].split()}, id=id)
+
+        self.client = app.test_client
+
+    def get(self, id, permissions='read:item', replica=None):
+        headers = {'Authorization': permissions}
+        if replica:
+            headers['Replica'] = replica
+        return self.client().get(f'/items/{id}', headers = headers)
+
+    def test_hit_until_invalidated(self):
+        self.assertEqual(self.get(1).get_json()['calls'], 1)
+        self.assertEqual(self.get(1).get_json()['calls'], 1)
+        self.cache.invalidate(['item:2'])
+        self.assertEqual(self.get(1).get_json()['calls'], 1)
+        self.cache.invalidate(['item:1'])
+        self.assertEqual(self.get(1).get_json()['calls'], 2)
+
+        stats = self.cache.stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['hit_ratio'], 0.5)
+
+    # Users with different permissions never share responses
+    def test_key_includes_permissions(self):
+        self.get(1)
+        self.assertEqual(self.get(1, 'read:item edit:item').get_json()['calls'], 2)
+
+    def test_clear(self):
+        self.get(1)
+        self.cache.clear()
+        self.assertEqual(self.get(1).get_json()['calls'], 2)
+
+    # Right after an invalidation, replicas may not show the write yet, so
+    # what is read from them is not stored, unlike reads from the primary
+    def test_replica_reads_after_invalidation(self):
+        self.cache.invalidate(['item:1'])
+        self.assertEqual(self.get(1, replica='replica1').get_json()['calls'], 1)
+        self.assertEqual(self.get(1, replica='replica1').get_json()['calls'], 2)
+        self.assertEqual(self.get(1).get_json()['calls'], 3)
+        self.assertEqual(self.get(1, replica='replica1').get_json()['calls'], 3)
+
+        self.cache.replica_lag = 0
+        self.assertEqual(self.get(2, replica='replica1').get_json()['calls'], 4)
+        self.assertEqual(self.get(2, replica='replica1').get_json()['calls'], 4)
+
+    def test_shared_backend_replica_reads(self):
+        self.cache.backend = SharedBackend(StandInRedis())
+        self.cache.invalidate(['item:1'])
+        self.assertEqual(self.get(1, replica='replica1').get_json()['calls'], 1)
+        self.assertEqual(self.get(1, replica='replica1').get_json()['calls'], 2)
+        self.assertEqual(self.get(2, replica='replica1').get_json()['calls'], 3)
+        self.assertEqual(self.get(2, replica='replica1').get_json()['calls'], 3)
+
+    def test_shared_backend(self):
+        self.cache.backend = SharedBackend(StandInRedis())
+        self.assertEqual(self.get(1).get_json()['calls'], 1)
+        self.assertEqual(self.get(1).get_json()['calls'], 1)
+        self.cache.invalidate(['item:1'])
+        self.assertEqual(self.get(1).get_json()['calls'], 2)
+
+
+class NDJSONReaderTestCase(unittest.TestCase):
+    """Tests for the NDJSON to CSV conversion used by the bulk import"""
+
+    def test_read_in_chunks(self):
+        lines = [json.dumps({'name': 'Skill, "quoted"', 'id': i}) for i in range(100)]
+        reader = NDJSONReader(io.StringIO('\n'.join(lines) + '\n\n'), ['id', 'name', 'description'])
+
+        chunks = []
+        chunk = reader.read(64)
+        while chunk:
+            self.assertLessEqual(len(chunk), 64)
+            chunks.append(chunk)
+            chunk = reader.read(64)
+
+        rows = list(csv.reader(io.StringIO(''.join(chunks))))
+        self.assertEqual(len(rows), 100)
+        self.assertEqual(rows[0], ['0', 'Skill, "quoted"', ''])
+
+class TrustGraphTestCase(unittest.TestCase):
+    """Tests for the in-memory endorsement graph, built without a database"""
+
+    def setUp(self):
+        # 1 -> 2 -> 3 -> 4 for skill 1, and 1 -> 5 -> 4 for skill 2
+        edges = [(1, 2, 1), (2, 3, 1), (3, 4, 1), (1, 5, 2), (5, 4, 2)]
+        self.graph = TrustGraph()
+        self.graph._reset(
+            Adjacency.from_sorted_rows(sorted(edges), 5),
+            Adjacency.from_sorted_rows(sorted((r, g, s) for g, r, s in edges), 5),
+            len(edges))
+
+    def test_shortest_path(self):
+        self.assertEqual(self.graph.shortest_path(1, 4), [1, 5, 4])
+        self.assertEqual(self.graph.shortest_path(2, 2), [2])
+        self.assertIsNone(self.graph.shortest_path(4, 1))
+
+    def test_shortest_path_skill(self):
+        self.assertEqual(self.graph.shortest_path(1, 4, skill_id=1), [1, 2, 3, 4])
+        self.assertIsNone(self.graph.shortest_path(1, 4, skill_id=1, max_depth=2))
+        self.assertIsNone(self.graph.shortest_path(1, 3, skill_id=2))
+
+    def test_add_and_remove_edges(self):
+        self.graph.remove_edge(1, 5, 2)
+        self.assertEqual(self.graph.shortest_path(1, 4), [1, 2, 3, 4])
+
+        self.graph.add_edge(6, 2, 4, 1)
+        self.graph.add_edge(7, 4, 10, 1)
+        self.assertEqual(self.graph.shortest_path(1, 10), [1, 2, 4, 10])
+        self.assertEqual(self.graph.num_edges, 6)
+
+    # A deletion replayed from the log keeps a newer endorsement of the same
+    # users and skill
+    def test_replayed_deletion(self):
+        self.graph.add_edge(8, 4, 1, 3)
+        self.graph.remove_edge(4, 1, 3, endorsement_id=7)
+        self.assertEqual(self.graph.shortest_path(4, 2), [4, 1, 2])
+
+        self.graph.remove_edge(4, 1, 3, endorsement_id=8)
+        self.assertIsNone(self.graph.shortest_path(4, 2))
+
+    # Endorsements created and deleted in the database after the load, as
+    # by other processes, are picked up by sync
+    def test_sync_changes(self):
+        app = create_app()
+        client = app.test_client()
+        users = [json.loads(client.post('/users', headers = auth_header_admin,
+            json = {"first_name": "Marsellus", "last_name": f"Wallace{i}"}).data)['user']['id']
+            for i in range(2)]
+        skill = json.loads(client.post('/skills', headers = auth_header_admin,
+            json = {"name": "Trust", "description": "Loyalty"}).data)['skill']['id']
+        try:
+            with app.app_context():
+                graph = TrustGraph()
+                graph.load()
+                endorsement = Endorsement(users[0], users[1], skill)
+                endorsement.insert()
+                graph.synced_at -= graph_module.TRUST_GRAPH_SYNC_INTERVAL
+                graph.sync()
+                self.assertEqual(graph.shortest_path(users[0], users[1]), users)
+
+                endorsement.delete()
+                graph.synced_at -= graph_module.TRUST_GRAPH_SYNC_INTERVAL
+                graph.sync()
+                self.assertIsNone(graph.shortest_path(users[0], users[1]))
+        finally:
+            for id in users:
+                client.delete(f'/users/{id}', headers = auth_header_admin)
+            client.delete(f'/skills/{skill}', headers = auth_header_admin)
+
+    # Endorsements committed late with ids below the highest one already
+    # seen are picked up, and each sync only reads the trailing window again
+    def test_sync_late_commits(self):
+        app = create_app()
+        client = app.test_client()
+        users = [json.loads(client.post('/users', headers = auth_header_admin,
+            json = {"first_name": "Marsellus", "last_name": f"Wallace{i}"}).data)['user']['id']
+            for i in range(3)]
+        skill = json.loads(client.post('/skills', headers = auth_header_admin,
+            json = {"name": "Trust", "description": "Loyalty"}).data)['skill']['id']
+        try:
+            with app.app_context():
+                endorsements = [Endorsement(users[0], users[1], skill), Endorsement(users[0], users[2], skill),
+                    Endorsement(users[1], users[2], skill)]
+                for endorsement in endorsements:
+                    endorsement.insert()
+                late_id = endorsements[1].id
+                endorsements[1].delete()
+                graph = TrustGraph()
+                graph.load()
+                num_edges = graph.num_edges
+
+                # A transaction that got its id before the load commits after it
+                late = Endorsement(users[2], users[0], skill)
+                late.id = late_id
+                late.insert()
+                graph.synced_at -= graph_module.TRUST_GRAPH_SYNC_INTERVAL
+                graph.sync()
+
+                self.assertEqual(graph.shortest_path(users[2], users[1]), [users[2], users[0], users[1]])
+                self.assertEqual(graph.num_edges, num_edges + 1)
+                self.assertEqual(graph.max_synced_id, endorsements[2].id)
+
+                newer = Endorsement(users[1], users[0], skill)
+                newer.insert()
+                graph.synced_at -= graph_module.TRUST_GRAPH_SYNC_INTERVAL
+                graph.sync()
+
+                self.assertEqual(graph.num_edges, num_edges + 2)
+                self.assertEqual(graph.max_synced_id, newer.id)
+                for endorsement in (late, newer, endorsements[0], endorsements[2]):
+                    endorsement.delete()
+        finally:
+            for id in users:
+                client.delete(f'/users/{id}', headers = auth_header_admin)
+            client.delete(f'/skills/{skill}', headers = auth_header_admin)
+
+    # Expired graphs are reloaded in a background thread, while requests go
+    # on with the current graph
+    def test_background_reload(self):
+        loaded = threading.Event()
+        release = threading.Event()
+        def load():
+            release.wait(5)
+            loaded.set()
+        self.graph.load = load
+        self.graph.loaded_at = self.graph.synced_at = time.monotonic() - graph_module.TRUST_GRAPH_RELOAD_INTERVAL
+        with create_app().app_context():
+            self.graph.sync()
+
+        self.assertFalse(loaded.is_set())
+        self.assertEqual(self.graph.shortest_path(1, 4), [1, 5, 4])
+        release.set()
+        self.graph.reloader.join()
+        self.assertTrue(loaded.is_set())
+
+    # Threads finding the graph expired don't all reload it
+    def test_single_reload(self):
+        loads = []
+        self.graph.load = lambda: loads.append(time.sleep(0.1))
+        self.graph.loaded_at = self.graph.synced_at = time.monotonic() - graph_module.TRUST_GRAPH_RELOAD_INTERVAL
+        app = create_app()
+        def sync():
+            with app.app_context():
+                self.graph.sync()
+        threads = [threading.Thread(target=sync) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.graph.reloader.join()
+        self.assertEqual(len(loads), 1)
+
+class TrustScoreTestCase(unittest.TestCase):
+    """Tests for the PageRank trust scores"""
+
+    def setUp(self):
+        # 0 -> 1 -> 2 -> 3 for skill 1, and 0 -> 4 -> 3 for skill 2
+        self.givers = np.array([0, 1, 2, 0, 4])
+        self.receivers = np.array([1, 2, 3, 4, 3])
+        self.skills = np.array([1, 1, 1, 2, 2])
+
+    def test_pagerank(self):
+        trust, iterations, change = pagerank(self.givers, self.receivers, 5)
+
+        self.assertAlmostEqual(trust.sum(), 5)
+        self.assertLess(change, 1e-6)
+        # Endorsed by two users, and by the end of the longer chain
+        self.assertEqual(trust.argmax(), 3)
+        self.assertAlmostEqual(trust[1], trust[4])
+
+    def test_pagerank_warm_start(self):
+        trust, iterations, change = pagerank(self.givers, self.receivers, 5)
+        warm, warm_iterations, change = pagerank(self.givers, self.receivers, 5, initial=trust)
+
+        self.assertLess(warm_iterations, iterations)
+        np.testing.assert_allclose(warm, trust, atol=1e-5)
+
+    def test_skill_scores(self):
+        trust, iterations, change = pagerank(self.givers, self.receivers, 5)
+        receivers, skills, scores = skill_scores(trust, self.givers, self.receivers, self.skills, 5)
+        scores = dict(zip(zip(receivers.tolist(), skills.tolist()), scores.tolist()))
+
+        self.assertEqual(set(scores), {(1, 1), (2, 1), (3, 1), (4, 2), (3, 2)})
+        # User 0 splits their trust between their two endorsements
+        self.assertAlmostEqual(scores[(1, 1)], trust[0] / 2)
+        self.assertAlmostEqual(scores[(3, 1)], trust[2])
+
+    # The scores are saved, and every cursor opened is closed
+    def test_compute_trust_scores(self):
+        closed = []
+        class Cursor(sqlite3.Cursor):
+            def close(self):
+                closed.append(self)
+                super().close()
+        opened = []
+        class Connection(sqlite3.Connection):
+            def cursor(self):
+                opened.append(super().cursor(Cursor))
+                return opened[-1]
+
+        connection = sqlite3.connect(':memory:', factory=Connection)
+        connection.executescript('''
+            CREATE TABLE profile (id integer, trust_score float);
+            CREATE TABLE endorsement (giver_id integer, receiver_id integer, skill_id integer);
+            CREATE TABLE skill_ranking (skill_id integer, receiver_id integer, trust_score float);''')
+        connection.executemany('INSERT INTO profile VALUES (?, 0)', [(id,) for id in range(5)])
+        connection.executemany('INSERT INTO endorsement VALUES (?, ?, ?)',
+            zip(self.givers.tolist(), self.receivers.tolist(), self.skills.tolist()))
+        connection.executemany('INSERT INTO skill_ranking VALUES (?, ?, 0)',
+            set(zip(self.skills.tolist(), self.receivers.tolist())))
+        compute_trust_scores(connection, False)
+
+        trust, iterations, change = pagerank(self.givers, self.receivers, 5)
+        saved = [score for (score,) in connection.execute('SELECT trust_score FROM profile ORDER BY id')]
+        np.testing.assert_allclose(saved, trust, atol=1e-5)
+        self.assertEqual(len(opened), 2)
+        self.assertEqual(set(closed), set(opened))
+
+class PoolTestCase(unittest.TestCase):
+    """Tests for the connection pool settings and instrumentation"""
+
+    def setUp(self):
+        self.pool = InstrumentedQueuePool(lambda: sqlite3.connect(':memory:', check_same_thread=False),
+            pool_size=1, max_overflow=1, timeout=0.1)
+
+    def test_engine_options(self):
+        self.assertEqual(engine_options('sqlite:////tmp/endorsa.db'), {})
+        options = engine_options('postgresql://localhost/endorsa')
+        self.assertIs(options['poolclass'], InstrumentedQueuePool)
+        self.assertIn('pool_pre_ping', options)
+
+    def test_checkouts_counted(self):
+        before = pool_stats.stats()
+        first = self.pool.connect()
+        second = self.pool.connect()
+        stats = pool_stats.stats(self.pool)
+
+        self.assertEqual(stats['checkouts'], before['checkouts'] + 2)
+        self.assertEqual(stats['checked_out'], 2)
+        self.assertEqual(stats['overflow'], 1)
+        self.assertGreaterEqual(stats['peak_checked_out'], 2)
+        first.close()
+        second.close()
+        self.assertEqual(pool_stats.stats(self.pool)['checked_out'], 0)
+
+    # With every connection in use, a checkout waits and then times out
+    def test_exhausted_pool_times_out(self):
+        before = pool_stats.stats()
+        connections = [self.pool.connect(), self.pool.connect()]
+        with self.assertRaises(Exception):
+            self.pool.connect()
+        stats = pool_stats.stats()
+
+        self.assertEqual(stats['timeouts'], before['timeouts'] + 1)
+        self.assertGreaterEqual(stats['wait_ms']['max'], 0)
+        for connection in connections:
+            connection.close()
+
+        # Once a connection is back, a checkout made while exhausted succeeds
+        connections = [self.pool.connect(), self.pool.connect()]
+        threading.Timer(0.02, connections[0].close).start()
+        connection = self.pool.connect()
+        self.assertEqual(pool_stats.stats()['exhausted'], before['exhausted'] + 2)
+        connection.close()
+        connections[1].close()
+
+class ReplicaRoutingTestCase(unittest.TestCase):
+    """Tests for the routing of reads to a replica, with a second SQLite
+    file standing in for it"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = create_app()
+        setup_db(self.app, f'sqlite:///{self.directory.name}/primary.db',
+            [f'sqlite:///{self.directory.name}/replica.db'])
+
+        # Same schema on both, with a different user in each
+        with self.app.app_context():
+            db.create_all(bind=None)
+            replica = db.get_engine(self.app, bind='replica_0')
+            db.Model.metadata.create_all(replica)
+            Profile('Primary', 'User', None, None, None).insert()
+            replica.execute(Profile.__table__.insert().values(first_name='Replica', last_name='User'))
+
+    def tearDown(self):
+        setup_db(self.app, os.environ['DATABASE_URL'], [])
+        self.directory.cleanup()
+
+    def first_name(self, method='GET', headers={}):
+        with self.app.test_request_context('/users', method=method, headers=headers):
+            self.app.preprocess_request()
+            return Profile.query.one().first_name
+
+    def test_get_reads_from_replica(self):
+        self.assertEqual(self.first_name(), 'Replica')
+
+    def test_write_uses_primary(self):
+        self.assertEqual(self.first_name('POST'), 'Primary')
+
+    # A successful write pins the next reads of the client to the primary
+    def test_read_your_writes(self):
+        with self.app.test_request_context('/users', method='POST'):
+            response = self.app.process_response(self.app.response_class(status=200))
+        cookie = response.headers['Set-Cookie']
+        self.assertIn('endorsa_primary=1', cookie)
+
+        self.assertEqual(self.first_name(headers={'Cookie': cookie.split(';')[0]}), 'Primary')
+
+    # Clients without cookies echo the pin header back instead, until it expires
+    def test_read_your_writes_header(self):
+        with self.app.test_request_context('/users', method='POST'):
+            response = self.app.process_response(self.app.response_class(status=200))
+        pin = response.headers['Endorsa-Primary-Until']
+
+        self.assertEqual(self.first_name(headers={'Endorsa-Primary-Until': pin}), 'Primary')
+        self.assertEqual(self.first_name(headers={'Endorsa-Primary-Until': str(int(time.time()) - 1)}), 'Replica')
+        self.assertEqual(self.first_name(headers={'Endorsa-Primary-Until': 'soon'}), 'Replica')
+
+class MetricsTestCase(unittest.TestCase):
+    """Tests for the per-request metrics, on a minimal app"""
+
+    def setUp(self):
+        self.metrics = RequestMetrics()
+        engine = create_engine('sqlite://')
+        app = Flask(__name__)
+        app.json_encoder = timed_encoder(app.json_encoder)
+        app.before_request(self.metrics.start)
+        app.after_request(self.metrics.finish)
+
+        @app.route('/items/<int:id>')
+        def item(id):
+            values = [engine.execute('SELECT 1').scalar() for _ in range(id)]
+            return jsonify({'values': values})
+
+        @app.route('/budget/<int:id>')
+        @query_budget(2)
+        def budget(id):
+            return item(id)
+
+        self.app = app
+        self.client = app.test_client
+
+    def test_server_timing(self):
+        timing = self.client().get('/items/3').headers['Server-Timing']
+        entries = dict(entry.split(';')[0:2] for entry in timing.split(', '))
+
+        self.assertEqual(set(entries), {'db', 'auth', 'serialize', 'total'})
+        self.assertIn('desc="SQL statements: 3"', timing)
+        self.assertGreater(float(entries['db'].split('=')[1]), 0)
+
+    # Requests are aggregated per route pattern
+    def test_histograms(self):
+        self.client().get('/items/1')
+        self.client().get('/items/2')
+        lines = self.metrics.lines()
+
+        self.assertIn('endorsa_request_sql_statements_count{method="GET",route="/items/<int:id>"} 2', lines)
+        self.assertIn('endorsa_request_sql_statements_bucket{method="GET",route="/items/<int:id>",le="1"} 1', lines)
+        self.assertIn('endorsa_request_sql_statements_sum{method="GET",route="/items/<int:id>"} 3', lines)
+
+    def test_query_budget_exceeded(self):
+        self.app.config['QUERY_BUDGET_STRICT'] = True
+        self.app.config['PROPAGATE_EXCEPTIONS'] = True
+        with self.assertRaises(QueryBudgetExceeded) as raised:
+            self.client().get('/budget/3')
+
+        # The statements are listed in the error
+        self.assertEqual(len(raised.exception.statements), 3)
+        self.assertIn('3. SELECT 1', str(raised.exception))
+        self.assertEqual(self.client().get('/budget/2').status_code, 200)
+
+    # Past the budget and a margin, statements are counted but not listed
+    def test_query_budget_listed_statements(self):
+        self.app.config['QUERY_BUDGET_STRICT'] = True
+        self.app.config['PROPAGATE_EXCEPTIONS'] = True
+        with self.assertRaises(QueryBudgetExceeded) as raised:
+            self.client().get('/budget/20')
+
+        self.assertEqual(raised.exception.count, 20)
+        self.assertEqual(len(raised.exception.statements), 2 + metrics_module.LISTED_STATEMENTS_MARGIN)
+        self.assertIn('... and 13 more', str(raised.exception))
+
+    # Without the strict check, the text of the statements is not kept
+    def test_statements_not_kept(self):
+        with self.app.test_request_context('/budget/3'):
+            self.app.full_dispatch_request()
+            self.assertEqual(g.sql_count, 3)
+            self.assertEqual(g.sql_statements, [])
+
+    # Requests over budget are only counted unless the check is strict
+    def test_query_budget_counted(self):
+        self.assertEqual(self.client().get('/budget/4').status_code, 200)
+        self.assertIn('endorsa_query_budget_exceeded_total{method="GET",route="/budget/<int:id>"} 1',
+            self.metrics.lines())
+
+    # The request duration covers every other after_request hook, CORS included
+    def test_finish_metrics_runs_last(self):
+        app = create_app()
+        self.assertEqual(app.after_request_funcs[None][0].__name__, 'finish_metrics')
+
+    # Every route of the API declares its budget
+    def test_every_route_has_budget(self):
+        app = create_app()
+        for rule in app.url_map.iter_rules():
+            if rule.endpoint != 'static':
+                self.assertTrue(hasattr(app.view_functions[rule.endpoint], 'query_budget'), rule.rule)
+
+    def test_histogram_buckets_cumulative(self):
+        histogram = Histogram('h', 'Test', ('route',), (1, 5))
+        for value in (0.5, 1, 3, 7):
+            histogram.observe(('/a',), value)
+        lines = list(histogram.lines())
+
+        self.assertIn('h_bucket{route="/a",le="1"} 2', lines)
+        self.assertIn('h_bucket{route="/a",le="5"} 3', lines)
+        self.assertIn('h_bucket{route="/a",le="+Inf"} 4', lines)
+        self.assertIn('h_sum{route="/a"} 11.5', lines)
+
+class StartupTestCase(unittest.TestCase):
+    """Tests for the side effects of importing and creating the app"""
+
+    # The database is only configured when the app is created
+    def test_import_without_database_url(self):
+        env = {name: value for name, value in os.environ.items() if name != 'DATABASE_URL'}
+        result = subprocess.run([sys.executable, '-c', 'import app, manage'],
+            env=env, cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+    # Workers forked from a created app must not share its connections
+    def test_create_app_does_not_connect(self):
+        connections = []
+        def connect(dbapi_connection, connection_record):
+            connections.append(dbapi_connection)
+        event.listen(Pool, 'connect', connect)
+        try:
+            create_app()
+        finally:
+            event.remove(Pool, 'connect', connect)
+        self.assertEqual(connections, [])
+
+class BenchmarkTestCase(unittest.TestCase):
+    """Tests for the local token issuer and synthetic dataset of the benchmark"""
+
+    def test_local_token_verified(self):
+        token = issuer.token(['read:user'], subject='benchmark|test')
+        payload = auth.verify_decode_jwt(token)
+        self.assertEqual(payload['sub'], 'benchmark|test')
+        self.assertEqual(payload['permissions'], ['read:user'])
+
+    def test_generate_dataset(self):
+        with tempfile.TemporaryDirectory() as directory:
+            paths, num_endorsements = generate_dataset(directory, profiles=200, skills=20,
+                endorsements=2000, skew=1.0, seed=1)
+            with open(paths['endorsements']) as f:
+                rows = list(csv.DictReader(f))
+
+        edges = [(r['giver_id'], r['receiver_id'], r['skill_id']) for r in rows]
+        self.assertEqual(len(edges), num_endorsements)
+        self.assertEqual(len(set(edges)), len(edges))
+        self.assertFalse(any(giver == receiver for giver, receiver, _ in edges))
+
+        # A few users receive most endorsements
+        received = sorted(np.unique([r for _, r, _ in edges], return_counts=True)[1], reverse=True)
+        self.assertGreater(sum(received[:20]), len(edges) / 3)
+
+    def test_skewed_choice_within_ids(self):
+        ids = np.array([5, 7, 9])
+        picks = skewed_choice(np.random.default_rng(0), ids, 100, 1.0)
+        self.assertTrue(set(picks.tolist()) <= {5, 7, 9})
+
+    def test_summarize(self):
+        summary = summarize([0.001] * 98 + [0.1, 0.2], [200] * 97 + [404, 500, None], 0.5)
+
+        self.assertEqual(summary['requests'], 100)
+        self.assertEqual(summary['errors'], 2)
+        self.assertEqual(summary['rps'], 200)
+        self.assertAlmostEqual(summary['p50_ms'], 1)
+        self.assertGreater(summary['p99_ms'], 100)
+        self.assertEqual(summary['statuses'], {'200': 97, '404': 1, '500': 1, 'None': 1})
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
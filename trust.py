@@ -0,0 +1,173 @@
+# Trust scores computed offline with PageRank over the endorsement graph
+
+import csv
+import io
+import time
+import numpy as np
+from scipy import sparse
+
+# Probability of following an endorsement rather than jumping to a random
+# user, and convergence settings of the power iteration
+DAMPING = 0.85
+TOLERANCE = 1e-6
+MAX_ITERATIONS = 100
+
+# Scores are saved rounded, so that rows whose score did not change beyond
+# the precision of the iteration are not rewritten
+SCORE_DECIMALS = 6
+
+# Rows fetched per database round trip
+FETCH_SIZE = 100000
+
+
+# Global trust of each user, as a PageRank over the endorsement graph where
+# each user splits their trust evenly between all the endorsements they gave.
+# givers and receivers are user indexes in [0, n). Starts from initial (e.g.
+# the previous scores) if given. Scores are scaled so the average user has 1.
+# Returns the scores, the number of iterations run and the final L1 change.
+def pagerank(givers, receivers, n, initial=None, damping=DAMPING,
+             tolerance=TOLERANCE, max_iterations=MAX_ITERATIONS):
+    if n == 0:
+        return np.zeros(0), 0, 0.0
+
+    out_degree = np.bincount(givers, minlength=n).astype(np.float64)
+    # Duplicated (giver, receiver) pairs, one per skill, are summed up
+    matrix = sparse.csr_matrix(
+        (1.0 / out_degree[givers], (receivers, givers)), shape=(n, n))
+    dangling = out_degree == 0
+
+    if initial is None:
+        scores = np.full(n, 1.0 / n)
+    else:
+        scores = initial / initial.sum()
+
+    iterations, change = 0, 0.0
+    for iterations in range(1, max_iterations + 1):
+        # Trust of users who endorsed nobody is spread across everyone
+        base = (1 - damping + damping * scores[dangling].sum()) / n
+        new_scores = damping * (matrix @ scores) + base
+        change = np.abs(new_scores - scores).sum()
+        scores = new_scores
+        if change < tolerance:
+            break
+
+    return scores * n, iterations, change
+
+# Trust of each user for each skill: the sum of the trust passed along the
+# endorsements of that skill they received. Returns the receiver indexes,
+# skill ids and scores of every (user, skill) pair endorsed at least once.
+def skill_scores(trust, givers, receivers, skills, n):
+    out_degree = np.bincount(givers, minlength=n)
+    skill_ids, skill_index = np.unique(skills, return_inverse=True)
+    scores = sparse.csr_matrix(
+        (trust[givers] / out_degree[givers], (receivers, skill_index)),
+        shape=(n, len(skill_ids))).tocoo()
+    return scores.row, skill_ids[scores.col], scores.data
+
+# Run a query and return its integer or float columns as NumPy arrays,
+# fetching rows in chunks
+def fetch_arrays(cursor, query, dtype):
+    cursor.execute(query)
+    chunks = []
+    rows = cursor.fetchmany(FETCH_SIZE)
+    while rows:
+        chunks.append(np.array(rows, dtype=dtype))
+        rows = cursor.fetchmany(FETCH_SIZE)
+    if not chunks:
+        return [np.zeros(0, dtype=dtype) for _ in range(len(cursor.description))]
+    return np.concatenate(chunks).T
+
+# Positions of ids in the sorted array of known ids, and whether each was found
+def index_of(known_ids, ids):
+    positions = np.searchsorted(known_ids, ids)
+    found = positions < len(known_ids)
+    found[found] = known_ids[positions[found]] == ids[found]
+    return positions, found
+
+# Copy rows into a temporary table, with COPY on PostgreSQL
+def fill_table(cursor, table, columns, rows, postgresql):
+    cursor.execute(f'CREATE TEMP TABLE {table} ({", ".join(columns)})')
+    if postgresql:
+        data = io.StringIO()
+        csv.writer(data).writerows(rows)
+        data.seek(0)
+        cursor.copy_expert(f'COPY {table} FROM STDIN WITH (FORMAT csv)', data)
+    else:
+        placeholders = ', '.join('?' for _ in columns)
+        cursor.executemany(f'INSERT INTO {table} VALUES ({placeholders})', rows)
+
+def report(name, seconds, details=''):
+    print(f'{name:<14} {seconds:7.2f}s  {details}')
+
+# Compute the trust scores of all users and write them to profile and
+# skill_ranking in a single transaction. Unless warm_start is False, the
+# power iteration starts from the scores saved by the previous run, so only
+# a few iterations are needed when the graph changed little since then.
+def compute_trust_scores(connection, postgresql, warm_start=True, damping=DAMPING,
+                         tolerance=TOLERANCE, max_iterations=MAX_ITERATIONS):
+    cursor = connection.cursor()
+    started = start = time.perf_counter()
+
+    try:
+        profile_ids, previous = fetch_arrays(cursor,
+            'SELECT id, trust_score FROM profile ORDER BY id', np.float64)
+        profile_ids = profile_ids.astype(np.int64)
+        n = len(profile_ids)
+
+        # A server-side cursor keeps PostgreSQL from sending all rows at once
+        edges = connection.cursor('trust_edges') if postgresql else connection.cursor()
+        try:
+            givers, receivers, skills = fetch_arrays(edges,
+                'SELECT giver_id, receiver_id, skill_id FROM endorsement', np.int64)
+        finally:
+            edges.close()
+
+        # Map user ids to indexes, skipping endorsements of missing users
+        givers, giver_found = index_of(profile_ids, givers)
+        receivers, receiver_found = index_of(profile_ids, receivers)
+        found = giver_found & receiver_found
+        givers, receivers, skills = givers[found], receivers[found], skills[found]
+        report('load', time.perf_counter() - start, f'{n} users, {len(givers)} endorsements')
+
+        start = time.perf_counter()
+        initial = None
+        if warm_start and previous.any():
+            # Users created since the previous run start with the average
+            initial = np.where(previous > 0, previous, 1.0)
+        trust, iterations, change = pagerank(givers, receivers, n, initial,
+            damping, tolerance, max_iterations)
+        skill_receivers, skill_ids, scores = skill_scores(trust, givers, receivers, skills, n)
+        trust = np.round(trust, SCORE_DECIMALS)
+        scores = np.round(scores, SCORE_DECIMALS)
+        report('pagerank', time.perf_counter() - start,
+            f'{iterations} iterations, final change {change:.2e}')
+
+        start = time.perf_counter()
+        fill_table(cursor, 'trust_profile', ['id integer', 'score float'],
+            zip(profile_ids.tolist(), trust.tolist()), postgresql)
+        fill_table(cursor, 'trust_skill', ['skill_id integer', 'receiver_id integer', 'score float'],
+            zip(skill_ids.tolist(), profile_ids[skill_receivers].tolist(), scores.tolist()),
+            postgresql)
+        cursor.execute('''
+            UPDATE profile SET trust_score = t.score
+            FROM trust_profile t WHERE profile.id = t.id AND profile.trust_score <> t.score''')
+        updated = cursor.rowcount
+        cursor.execute('''
+            UPDATE skill_ranking SET trust_score = t.score
+            FROM trust_skill t
+            WHERE skill_ranking.skill_id = t.skill_id AND skill_ranking.receiver_id = t.receiver_id
+              AND skill_ranking.trust_score <> t.score''')
+        updated += cursor.rowcount
+        cursor.execute('DROP TABLE trust_profile')
+        cursor.execute('DROP TABLE trust_skill')
+        connection.commit()
+        report('save', time.perf_counter() - start,
+            f'{len(scores)} skill scores, {updated} rows updated')
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    report('total', time.perf_counter() - started)
+    return iterations